@@ -1,12 +1,22 @@
 from django.contrib import admin
-from .models import UploadedFile, SecureLink, ShareLink
+from django.db.models import Q
+from .models import AccessLog, UploadedFile, SecureLink, ShareLink
+from .search import search_files
 
 @admin.register(UploadedFile)
 class UploadedFileAdmin(admin.ModelAdmin):
-    list_display = ('original_name', 'user', 'size', 'uploaded_at', 'expires_at')
+    list_display = ('original_name', 'user', 'size', 'uploaded_at', 'expires_at', 'download_count')
+    readonly_fields = ('download_count', 'bytes_served', 'last_accessed_at')
     search_fields = ('original_name', 'user__username')
     list_filter = ('uploaded_at', 'user')
 
+    def get_search_results(self, request, queryset, search_term):
+        # File names go through the trigram search; usernames stay a plain lookup.
+        if not search_term:
+            return queryset, False
+        matches = search_files(queryset, search_term).values('pk')
+        return queryset.filter(Q(pk__in=matches) | Q(user__username__icontains=search_term)), False
+
 @admin.register(SecureLink)
 class SecureLinkAdmin(admin.ModelAdmin):
     list_display = ('file', 'token', 'expiry_time', 'is_active')
@@ -14,5 +24,13 @@ class SecureLinkAdmin(admin.ModelAdmin):
 
 @admin.register(ShareLink)
 class ShareLinkAdmin(admin.ModelAdmin):
-    list_display = ('file', 'link_id', 'expires_at')
+    list_display = ('file', 'link_id', 'expires_at', 'download_count', 'last_accessed_at')
     list_filter = ('expires_at',)
+    readonly_fields = ('download_count', 'bytes_served', 'last_accessed_at')
+
+@admin.register(AccessLog)
+class AccessLogAdmin(admin.ModelAdmin):
+    list_display = ('file', 'link', 'status', 'bytes_served', 'ip_address', 'accessed_at')
+    list_filter = ('status',)
+    list_select_related = ('file', 'link')
+    raw_id_fields = ('file', 'link')
@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Sum
+
+from .models import UploadedFile, UserProfile, get_dedup_stats
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'admin_dashboard_snapshot'
+REFRESH_LOCK_KEY = 'admin_dashboard_snapshot_refreshing'
+CHART_USERS = 10
+
+
+def refresh_dashboard_snapshot():
+    total_bytes = UserProfile.objects.aggregate(total=Sum('bytes_used'))['total'] or 0
+    top_users = (
+        UserProfile.objects.filter(bytes_used__gt=0)
+        .order_by('-bytes_used')
+        .values_list('user__username', 'bytes_used')[:CHART_USERS]
+    )
+    snapshot = {
+        'total_users': User.objects.count(),
+        'total_storage': round(total_bytes / (1024 * 1024), 2),
+        'total_files': UploadedFile.objects.count(),
+        'dedup': get_dedup_stats(),
+        'chart': [(username, round(used / (1024 * 1024), 2)) for username, used in top_users],
+        'generated_at': time.time(),
+    }
+    cache.set(SNAPSHOT_KEY, snapshot, timeout=settings.ADMIN_SNAPSHOT_TTL * 10)
+    return snapshot
+
+
+def _refresh_in_background():
+    try:
+        refresh_dashboard_snapshot()
+    except Exception:
+        logger.exception("Admin dashboard snapshot refresh failed")
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+        close_old_connections()
+
+
+def get_dashboard_snapshot():
+    """
+    Returns the cached global totals. A stale snapshot is served as-is while a
+    single background thread rebuilds it; only a cold cache blocks the request.
+    """
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        return refresh_dashboard_snapshot()
+    if time.time() - snapshot['generated_at'] > settings.ADMIN_SNAPSHOT_TTL:
+        if cache.add(REFRESH_LOCK_KEY, True, timeout=60):
+            threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return snapshot
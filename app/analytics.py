@@ -0,0 +1,265 @@
+import atexit
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .bandwidth import client_ip
+from .models import AccessLog, ShareLink, UploadedFile
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {ShareLink: {}, UploadedFile: {}}
+_rows = []
+_timer = None
+_exit_hook = False
+
+
+class _Counter:
+    __slots__ = ('downloads', 'bytes', 'last')
+
+    def __init__(self):
+        self.downloads = 0
+        self.bytes = 0
+        self.last = None
+
+    def add(self, downloads, nbytes, at):
+        self.downloads += downloads
+        self.bytes += nbytes
+        if self.last is None or at > self.last:
+            self.last = at
+
+
+def is_download(request, response):
+    # Only a GET that sends the file counts: HEAD and 304 send no body, and
+    # a Range request for a later part of the file is a resumed download.
+    if request.method != 'GET':
+        return False
+    if response.status_code == 200:
+        return True
+    return response.status_code == 206 and response.get('Content-Range', '').startswith('bytes 0-')
+
+
+def record_access(request, link, status, nbytes, download):
+    """
+    Buffers one share-link request. Nothing is written here; the buffer is
+    flushed as one batch every ANALYTICS_FLUSH_INTERVAL seconds, or sooner
+    once ANALYTICS_FLUSH_SIZE requests are waiting.
+    """
+    now = timezone.now()
+    row = AccessLog(
+        file_id=link.file_id,
+        link_id=link.pk,
+        status=status,
+        bytes_served=nbytes,
+        ip_address=client_ip(request) or None,
+        user_agent=request.META.get('HTTP_USER_AGENT', '')[:255],
+        accessed_at=now,
+    )
+    with _lock:
+        for model, pk in ((ShareLink, link.pk), (UploadedFile, link.file_id)):
+            counters = _counters[model]
+            counter = counters.get(pk)
+            if counter is None:
+                counter = counters[pk] = _Counter()
+            counter.add(int(download), nbytes, now)
+        _rows.append(row)
+        full = len(_rows) >= settings.ANALYTICS_FLUSH_SIZE
+    _schedule_flush(0 if full else settings.ANALYTICS_FLUSH_INTERVAL)
+
+
+def _take():
+    global _counters, _rows
+    with _lock:
+        taken = _counters, _rows
+        _counters = {ShareLink: {}, UploadedFile: {}}
+        _rows = []
+    return taken
+
+
+def _put_back(counters, rows):
+    # Counters are small and merge into whatever arrived meanwhile; log rows
+    # are kept only up to ANALYTICS_MAX_PENDING so a dead database cannot
+    # grow the buffer without bound.
+    with _lock:
+        for model, pending in counters.items():
+            for pk, counter in pending.items():
+                current = _counters[model].get(pk)
+                if current is None:
+                    _counters[model][pk] = counter
+                else:
+                    current.add(counter.downloads, counter.bytes, counter.last)
+        room = max(settings.ANALYTICS_MAX_PENDING - len(_rows), 0)
+        _rows[:0] = rows[-room:] if room else []
+
+
+def _apply_counters(model, counters):
+    """
+    One UPDATE per ANALYTICS_FLUSH_SIZE rows of model, each row with its own
+    increments. Every row costs nine bind parameters, and Postgres takes at
+    most 65535 in one statement, so a large backlog is written in slices.
+    last_accessed_at only moves forward, in case another process flushed a
+    later hit first.
+    """
+    def case(chunk, attr, output):
+        return Case(*(When(pk=pk, then=Value(getattr(c, attr))) for pk, c in chunk), output_field=output)
+    items = list(counters.items())
+    for start in range(0, len(items), settings.ANALYTICS_FLUSH_SIZE):
+        chunk = items[start:start + settings.ANALYTICS_FLUSH_SIZE]
+        last = model._meta.get_field('last_accessed_at')
+        model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(
+            download_count=F('download_count') + case(chunk, 'downloads', model._meta.get_field('download_count')),
+            bytes_served=F('bytes_served') + case(chunk, 'bytes', model._meta.get_field('bytes_served')),
+            # GREATEST is NULL on SQLite and MySQL when an argument is, hence the Coalesce.
+            last_accessed_at=Greatest(
+                Coalesce(F('last_accessed_at'), case(chunk, 'last', last)), case(chunk, 'last', last), output_field=last
+            ),
+        )
+
+
+def flush():
+    """
+    Writes everything buffered: one UPDATE per table with the summed
+    increments, then the access-log rows in bulk. Returns the number of
+    requests written.
+    """
+    counters, rows = _take()
+    if not rows:
+        return 0
+    try:
+        with transaction.atomic():
+            # Skip rows whose link or file was deleted while buffered.
+            files = set(UploadedFile.objects.filter(pk__in=counters[UploadedFile]).values_list('pk', flat=True))
+            links = set(ShareLink.objects.filter(pk__in=counters[ShareLink]).values_list('pk', flat=True))
+            _apply_counters(UploadedFile, counters[UploadedFile])
+            _apply_counters(ShareLink, counters[ShareLink])
+            rows = [row for row in rows if row.file_id in files]
+            for row in rows:
+                if row.link_id not in links:
+                    row.link_id = None
+            AccessLog.objects.bulk_create(rows, batch_size=settings.ANALYTICS_FLUSH_SIZE)
+    except Exception:
+        _put_back(counters, rows)
+        raise
+    return len(rows)
+
+
+def _flush_in_background():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        flush()
+    except Exception:
+        logger.exception("Access log flush failed; will retry")
+        _schedule_flush(settings.ANALYTICS_FLUSH_INTERVAL)
+    finally:
+        close_old_connections()
+
+
+def _schedule_flush(delay):
+    global _timer, _exit_hook
+    with _lock:
+        if not _exit_hook:
+            # Only processes that have buffered something flush on exit.
+            atexit.register(_flush_on_exit)
+            _exit_hook = True
+        if _timer is not None:
+            if delay or _timer.interval == 0:
+                return
+            _timer.cancel()
+        _timer = threading.Timer(delay, _flush_in_background)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush_on_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Could not flush the access log on exit")
+
+
+class _Tally:
+    def __init__(self, request, links, response):
+        self.request = request
+        self.links = links
+        self.status = response.status_code
+        self.download = is_download(request, response)
+        self.bytes = 0
+        self.done = False
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        # An archive's bytes are shared out between its files by size.
+        total = sum(link.file.size for link in self.links) or 1
+        for link in self.links:
+            nbytes = self.bytes if len(self.links) == 1 else self.bytes * link.file.size // total
+            record_access(self.request, link, self.status, nbytes, self.download)
+
+
+class _Counted:
+    def __init__(self, chunks, tally):
+        self._chunks = chunks
+        self._tally = tally
+        # Records what was sent even if the client goes away mid-download.
+        self._finalizer = weakref.finalize(self, tally.finish)
+
+    def close(self):
+        self._finalizer()
+
+
+class _CountedStream(_Counted):
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                self._tally.bytes += len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+
+class _AsyncCountedStream(_Counted):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._chunks:
+                self._tally.bytes += len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+
+def track(request, link, response):
+    """
+    Counts a share-link response towards the link's and file's statistics.
+    Streaming bodies are counted as they are sent and recorded when done.
+    """
+    return track_many(request, [link], response)
+
+
+def track_many(request, links, response):
+    """track() for a response carrying several links' files, such as a ZIP."""
+    if not settings.ANALYTICS_ENABLED:
+        return response
+    tally = _Tally(request, links, response)
+    if not response.streaming:
+        if request.method == 'HEAD':
+            tally.bytes = 0
+        elif response.has_header('X-Accel-Redirect') or response.has_header('X-Sendfile'):
+            # The proxy sends the bytes; assume the whole file.
+            tally.bytes = sum(link.file.size for link in links)
+        else:
+            tally.bytes = len(response.content)
+        tally.finish()
+        return response
+    stream = _AsyncCountedStream if response.is_async else _CountedStream
+    response.streaming_content = stream(response.streaming_content, tally)
+    return response
@@ -0,0 +1,324 @@
+import asyncio
+import time
+import uuid
+import weakref
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .models import UserProfile
+
+# rate is bytes per second and concurrency a number of downloads; 0 means unlimited.
+Scope = namedtuple('Scope', 'key rate concurrency')
+
+
+class DownloadsBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def plan_download_limits(storage_limit_mb):
+    """
+    Returns the DOWNLOAD_PLAN_LIMITS entry for a storage plan: the one with
+    the largest threshold not above storage_limit_mb.
+    """
+    tiers = settings.DOWNLOAD_PLAN_LIMITS
+    threshold = max((mb for mb in tiers if mb <= storage_limit_mb), default=min(tiers))
+    return tiers[threshold]
+
+
+def owner_download_limits(user):
+    try:
+        storage_limit_mb = user.profile.storage_limit_mb
+    except UserProfile.DoesNotExist:
+        storage_limit_mb = 0
+    return plan_download_limits(storage_limit_mb)
+
+
+def client_ip(request):
+    """
+    The address the request came from. Behind TRUSTED_PROXY_COUNT proxies
+    REMOTE_ADDR is the nearest proxy, so the client is taken from the
+    X-Forwarded-For entry the outermost trusted proxy appended; entries to
+    its left are whatever the client sent and are ignored.
+    """
+    proxies = settings.TRUSTED_PROXY_COUNT
+    forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+    if proxies and len(forwarded) >= proxies:
+        return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def share_link_scopes(request, link):
+    """
+    The limits a share-link download counts against: the link itself, the
+    file's owner (both from the owner's plan) and the client address. Links
+    from resolve_share_link carry the owner's profile, so this reads nothing.
+    """
+    limits = owner_download_limits(link.file.user) if link.file.user_id else plan_download_limits(0)
+    return [
+        Scope(f"link:{link.link_id.hex}", limits['link_rate'], limits['link_concurrency']),
+        Scope(f"user:{link.file.user_id}", limits['owner_rate'], limits['owner_concurrency']),
+        Scope(f"ip:{client_ip(request)}", settings.DOWNLOAD_IP_RATE, settings.DOWNLOAD_IP_CONCURRENCY),
+    ]
+
+
+def _slot_keys(scope):
+    return [f"dlslot:{scope.key}:{i}" for i in range(scope.concurrency)]
+
+
+def _period(at=None):
+    """The heartbeat period a time falls in; a third of DOWNLOAD_SLOT_TTL long."""
+    return int((time.time() if at is None else at) * 3 // settings.DOWNLOAD_SLOT_TTL)
+
+
+def _active_key(scope, period):
+    return f"dlactive:{scope.key}:{period}"
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.set_rate(rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * settings.DOWNLOAD_BURST_SECONDS, 64 * 1024)
+
+    def delay(self, amount):
+        """Takes amount tokens and returns how long to wait before sending them."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class DownloadLease:
+    """
+    Concurrency slots held by one download, and its share of each scope's
+    bandwidth. Slots are cache keys taken with add(); they expire after
+    DOWNLOAD_SLOT_TTL unless the stream refreshes them, which also frees the
+    slots of a crashed process.
+
+    Every download in a rated scope, whatever its concurrency, also counts
+    itself once per heartbeat period in a dlactive counter and takes itself
+    off on release. The share is the scope's rate over the larger of the
+    current and previous periods' counts, recomputed every
+    DOWNLOAD_RATE_REFRESH seconds, so the streams of a scope stay within its
+    rate together. Limits are only global when CACHES is shared between
+    processes (shared_cache.cache_is_shared); with a per-process cache each
+    process enforces them on its own.
+    """
+
+    def __init__(self, scopes, slots):
+        self.scopes = scopes
+        self.slots = slots
+        self.buckets = {}
+        self.counted = []
+        self.touched = time.monotonic()
+        self.shared = 0.0
+        self.released = False
+
+    def count(self, periods):
+        """Adds this download to each rated scope's count for the given periods."""
+        for scope in self.scopes:
+            if not scope.rate:
+                continue
+            for period in periods:
+                key = _active_key(scope, period)
+                if key in self.counted:
+                    continue
+                cache.add(key, 0, settings.DOWNLOAD_SLOT_TTL * 2)
+                cache.incr(key)
+                self.counted.append(key)
+
+    def refresh_due(self):
+        return time.monotonic() - self.shared >= settings.DOWNLOAD_RATE_REFRESH
+
+    def refresh(self):
+        """
+        Keeps the slots and the count alive and splits each scope's rate
+        evenly between its active downloads.
+        """
+        now = time.monotonic()
+        if now - self.touched >= settings.DOWNLOAD_SLOT_TTL / 3:
+            self.touched = now
+            for key in self.slots:
+                cache.touch(key, settings.DOWNLOAD_SLOT_TTL)
+        self.shared = now
+        period = _period()
+        self.count([period])
+        rated = [scope for scope in self.scopes if scope.rate]
+        counts = cache.get_many([_active_key(scope, p) for scope in rated for p in (period - 1, period)])
+        for scope in rated:
+            active = max(counts.get(_active_key(scope, p), 0) for p in (period - 1, period))
+            rate = scope.rate / max(active, 1)
+            bucket = self.buckets.get(scope.key)
+            if bucket is None:
+                self.buckets[scope.key] = TokenBucket(rate)
+            else:
+                bucket.set_rate(rate)
+
+    def delay(self, amount):
+        return max((bucket.delay(amount) for bucket in self.buckets.values()), default=0)
+
+    def rate(self):
+        """The slowest of this download's per-scope rates, or 0 if none applies."""
+        return min((bucket.rate for bucket in self.buckets.values()), default=0)
+
+    def hold(self):
+        """
+        Keeps this download's slots and count for DOWNLOAD_SLOT_TTL without
+        heartbeats, for a body another server sends after Django is done.
+        """
+        self.count(range(_period(), _period(time.time() + settings.DOWNLOAD_SLOT_TTL) + 1))
+        self.refresh()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            cache.delete_many(self.slots)
+            for key in self.counted:
+                try:
+                    cache.decr(key)
+                except ValueError:
+                    pass
+
+
+def acquire(scopes):
+    """
+    Takes a download slot in every scope, or raises DownloadsBusy when one is
+    full.
+    """
+    token = uuid.uuid4().hex
+    slots = []
+    for scope in scopes:
+        if not scope.concurrency:
+            continue
+        slot = next((key for key in _slot_keys(scope) if cache.add(key, token, settings.DOWNLOAD_SLOT_TTL)), None)
+        if slot is None:
+            cache.delete_many(slots)
+            raise DownloadsBusy(settings.DOWNLOAD_RETRY_AFTER)
+        slots.append(slot)
+    lease = DownloadLease(scopes, slots)
+    lease.count([_period()])
+    return lease
+
+
+class ShapedStream:
+    def __init__(self, chunks, lease):
+        self._chunks = chunks
+        self._lease = lease
+        # Frees the slots even if the server never closes the response.
+        self._finalizer = weakref.finalize(self, lease.release)
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                if self._lease.refresh_due():
+                    self._lease.refresh()
+                pause = self._lease.delay(len(chunk))
+                if pause:
+                    time.sleep(pause)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self._finalizer()
+
+
+class AsyncShapedStream:
+    def __init__(self, chunks, lease):
+        self._chunks = chunks
+        self._lease = lease
+        self._finalizer = weakref.finalize(self, lease.release)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._chunks:
+                if self._lease.refresh_due():
+                    await sync_to_async(self._lease.refresh)()
+                pause = self._lease.delay(len(chunk))
+                if pause:
+                    await asyncio.sleep(pause)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self._finalizer()
+
+
+def _acquire_for(request, link):
+    return acquire(share_link_scopes(request, link))
+
+
+def limited(request, link, respond):
+    """
+    Runs respond() under the share-link download limits: a 429 when a
+    concurrency cap is reached, otherwise its response paced to fit.
+    """
+    if not settings.DOWNLOAD_SHAPING_ENABLED:
+        return respond()
+    try:
+        lease = _acquire_for(request, link)
+    except DownloadsBusy as busy:
+        return too_many_downloads(busy)
+    try:
+        response = respond()
+    except BaseException:
+        lease.release()
+        raise
+    if not response.streaming:
+        if response.has_header('X-Accel-Redirect'):
+            _limit_offloaded(response, lease)
+        else:
+            lease.release()
+        return response
+    response.streaming_content = ShapedStream(response.streaming_content, lease)
+    return response
+
+
+def _limit_offloaded(response, lease):
+    # nginx sends X-Accel-Redirect bodies itself once the view has returned, so
+    # the download stays counted until its slots expire and nginx gets its share.
+    lease.hold()
+    rate = lease.rate()
+    if rate:
+        response['X-Accel-Limit-Rate'] = str(int(rate))
+
+
+async def alimited(request, link, respond):
+    """limited() for async views; respond() must return an async-streaming response."""
+    if not settings.DOWNLOAD_SHAPING_ENABLED:
+        return respond()
+    try:
+        lease = await sync_to_async(_acquire_for)(request, link)
+    except DownloadsBusy as busy:
+        return too_many_downloads(busy)
+    try:
+        response = respond()
+    except BaseException:
+        await sync_to_async(lease.release)()
+        raise
+    if not response.streaming:
+        if response.has_header('X-Accel-Redirect'):
+            await sync_to_async(_limit_offloaded)(response, lease)
+        else:
+            await sync_to_async(lease.release)()
+        return response
+    response.streaming_content = AsyncShapedStream(response.streaming_content, lease)
+    return response
+
+
+def too_many_downloads(busy):
+    response = HttpResponse("Too many downloads in progress, try again shortly.", status=429, content_type='text/plain')
+    response['Retry-After'] = str(busy.retry_after)
+    return response
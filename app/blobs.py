@@ -0,0 +1,228 @@
+import hashlib
+import os
+import shutil
+import uuid
+from collections import namedtuple
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .compression import store_blob_file
+from .fileops import reserve_storage_name
+from .models import Blob, StorageDeletion, UploadedFile, charge_storage
+
+BLOB_TMP_DIR = 'blobs/tmp/'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def blob_name(sha256):
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def hash_path(path):
+    with open(path, 'rb') as fh:
+        return hashlib.file_digest(fh, 'sha256').hexdigest()
+
+
+def reserve_temp(filename):
+    """
+    Returns (path, fd) for a scratch file inside storage, so ingesting it is a rename.
+    """
+    name, fd = reserve_storage_name(filename, upload_to=BLOB_TMP_DIR)
+    return default_storage.path(name), fd
+
+
+def add_reference(blob):
+    Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    return blob
+
+
+def _apply_permissions(path):
+    # Bytes arrive by rename, which skips FileSystemStorage._save and with it
+    # FILE_UPLOAD_PERMISSIONS; temp files are 0600 and the proxy could not
+    # read them under X-Accel-Redirect/X-Sendfile delivery.
+    mode = default_storage.file_permissions_mode
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+# A blob's bytes, written and compressed under a scratch name and ready to be
+# renamed into place; path is None when the content was already stored.
+Prepared = namedtuple('Prepared', 'sha256 size path encoding stored_size')
+
+
+def _prepare(sha256, size, place, force=False):
+    """
+    Does the slow part of storing content, outside any transaction: place(name)
+    writes the bytes to a scratch name, which is then compressed if that pays.
+    Skipped when a blob for sha256 exists already, unless force is set.
+    """
+    if not force and Blob.objects.filter(sha256=sha256).exists():
+        return Prepared(sha256, size, None, '', size)
+    name = blob_name(sha256)
+    token = uuid.uuid4().hex
+    staging = f"{name}.{token}.part"
+    ready = default_storage.path(f"{name}.{token}.ready")
+    place(staging)
+    encoding, stored_size = store_blob_file(default_storage.path(staging), ready, size)
+    _apply_permissions(ready)
+    return Prepared(sha256, size, ready, encoding, stored_size)
+
+
+def _discard(prepared):
+    if prepared.path and os.path.exists(prepared.path):
+        os.remove(prepared.path)
+
+
+def _claim(prepared):
+    """
+    Returns the Blob for prepared.sha256 holding one new reference, renaming
+    the prepared bytes into place if it is new. Returns None when the blob
+    went away after _prepare skipped writing it. Call inside a transaction.
+    """
+    blob = Blob.objects.select_for_update().filter(sha256=prepared.sha256).first()
+    if blob is not None:
+        return add_reference(blob)
+    if prepared.path is None:
+        return None
+
+    # A drain may be removing the bytes of an earlier blob with this content
+    # from the same name. Its log rows are locked by the drain
+    # (deletion_log.process_deletions), so wait for it, and hold them until
+    # the new Blob commits so a later drain sees it and keeps them.
+    list(StorageDeletion.objects.select_for_update().filter(sha256=prepared.sha256).order_by('pk'))
+
+    name = blob_name(prepared.sha256)
+    os.replace(prepared.path, default_storage.path(name))
+    try:
+        with transaction.atomic():
+            return Blob.objects.create(
+                sha256=prepared.sha256, file=name, size=prepared.size, stored_size=prepared.stored_size,
+                encoding=prepared.encoding, ref_count=1,
+            )
+    except IntegrityError:
+        # An identical upload won the race; the bytes at name are the same either way.
+        return add_reference(Blob.objects.select_for_update().get(sha256=prepared.sha256))
+
+
+def _store(sha256, size, place, user=None, original_name=None):
+    """
+    Prepares the content, then in one short transaction charges user for it,
+    takes a reference to its blob and creates user's file. Only that
+    transaction holds row locks, so a slow write or compression blocks
+    nobody. Without a user, returns the referenced Blob instead.
+    """
+    prepared = _prepare(sha256, size, place)
+    try:
+        with transaction.atomic():
+            if user is not None:
+                # Charged before any bytes are renamed into place, so a
+                # refused upload leaves nothing behind.
+                charge_storage(user, size)
+            blob = _claim(prepared)
+            if blob is None:
+                # The blob was dropped since _prepare saw it; rare enough to
+                # write the bytes under the lock.
+                prepared = _prepare(sha256, size, place, force=True)
+                blob = _claim(prepared)
+            if user is None:
+                return blob
+            return create_file(user, blob, original_name)
+    finally:
+        _discard(prepared)
+
+
+def _place_path(path):
+    def place(name):
+        target = default_storage.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        file_move_safe(path, target, allow_overwrite=True)
+    return place
+
+
+def _place_upload(upload):
+    if hasattr(upload, 'temporary_file_path'):
+        upload.file.flush()
+        return _place_path(upload.temporary_file_path())
+
+    def place(name):
+        path, fd = reserve_temp(upload.name)
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in upload.chunks(HASH_BLOCK_SIZE):
+                out.write(chunk)
+        target = default_storage.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    return place
+
+
+def upload_sha256(upload):
+    """
+    The upload's hash, from the upload handlers when they were active, so the
+    bytes are only read once.
+    """
+    sha256 = getattr(upload, 'sha256', None)
+    if sha256 is None:
+        digest = hashlib.sha256()
+        for chunk in upload.chunks(HASH_BLOCK_SIZE):
+            digest.update(chunk)
+        sha256 = digest.hexdigest()
+    return sha256
+
+
+def create_file(user, blob, original_name, **extra):
+    return UploadedFile.objects.create(
+        user=user,
+        blob=blob,
+        file=blob.file.name,
+        original_name=original_name,
+        size=blob.size,
+        encoding=blob.encoding,
+        **extra
+    )
+
+
+def store_upload(user, upload):
+    """Stores a request.FILES entry as a new file of user's."""
+    return _store(upload_sha256(upload), upload.size, _place_upload(upload), user, upload.name)
+
+
+def store_path(user, path, original_name, sha256=None):
+    """
+    Takes ownership of a local file: it becomes the blob or is discarded as a
+    duplicate.
+    """
+    try:
+        return _store(sha256 or hash_path(path), os.path.getsize(path), _place_path(path), user, original_name)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def share_blob(user, blob, original_name):
+    with transaction.atomic():
+        charge_storage(user, blob.size)
+        return create_file(user, add_reference(blob), original_name)
+
+
+def adopt_stored_file(name):
+    """
+    Brings a file stored outside the blob layer in as a blob, leaving the
+    original name in place for the caller to remove.
+    """
+    path = default_storage.path(name)
+
+    def place(target_name):
+        target = default_storage.path(target_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.adopt"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+
+    return _store(hash_path(path), os.path.getsize(path), place)
+
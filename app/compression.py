@@ -0,0 +1,201 @@
+import bisect
+import io
+import os
+import struct
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The zstd seekable format: independent frames, then a skippable frame holding
+# a (compressed, uncompressed) size per frame. zlib frames use the same layout.
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SKIPPABLE_HEADER = struct.Struct('<II')
+SEEK_FOOTER = struct.Struct('<IBI')
+SEEK_ENTRY = struct.Struct('<II')
+SEEK_ENTRY_CHECKSUM = struct.Struct('<III')
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def _compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    return lambda data: zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is needed to read zstd-compressed files.")
+        return zstandard.ZstdDecompressor().decompress
+    if codec == 'zlib':
+        return zlib.decompress
+    raise ValueError(f"Unknown storage encoding: {codec!r}")
+
+
+def worth_compressing(path, size, codec):
+    """
+    Compresses a few blocks spread through the file and reports whether they
+    shrank by at least STORAGE_COMPRESSION_MIN_SAVING.
+    """
+    if size < settings.STORAGE_COMPRESSION_MIN_SIZE:
+        return False
+    compress = _compressor(codec)
+    raw = packed = 0
+    step = max(size // SAMPLE_COUNT, SAMPLE_SIZE)
+    with open(path, 'rb') as fh:
+        for offset in range(0, size, step)[:SAMPLE_COUNT]:
+            fh.seek(offset)
+            block = fh.read(SAMPLE_SIZE)
+            raw += len(block)
+            packed += len(compress(block))
+    return packed <= raw * (1 - settings.STORAGE_COMPRESSION_MIN_SAVING)
+
+
+def write_seekable(src, dst, codec, frame_size):
+    """
+    Compresses src into dst as independent frames of frame_size bytes plus a
+    seek table. Returns the number of bytes written.
+    """
+    compress = _compressor(codec)
+    entries = []
+    while True:
+        block = src.read(frame_size)
+        if not block:
+            break
+        frame = compress(block)
+        dst.write(frame)
+        entries.append((len(frame), len(block)))
+    table = b''.join(SEEK_ENTRY.pack(*entry) for entry in entries) + SEEK_FOOTER.pack(len(entries), 0, SEEKABLE_MAGIC)
+    dst.write(SKIPPABLE_HEADER.pack(SKIPPABLE_MAGIC, len(table)) + table)
+    return sum(packed for packed, _ in entries) + SKIPPABLE_HEADER.size + len(table)
+
+
+def store_blob_file(src_path, target_path, size):
+    """
+    Moves src_path to target_path, compressed when STORAGE_COMPRESSION is on
+    and a sample shows it pays. Returns (encoding, stored_size); encoding is
+    '' for bytes kept as uploaded.
+    """
+    codec = default_codec()
+    if settings.STORAGE_COMPRESSION and worth_compressing(src_path, size, codec):
+        tmp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                stored_size = write_seekable(src, dst, codec, settings.STORAGE_COMPRESSION_FRAME_SIZE)
+            if stored_size < size:
+                os.replace(tmp_path, target_path)
+                os.remove(src_path)
+                return codec, stored_size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    os.replace(src_path, target_path)
+    return '', size
+
+
+class SeekableReader(io.RawIOBase):
+    """
+    Read-only file over the uncompressed content of a seekable-frame file.
+    Only the frame being read is held in memory, and seeking decompresses
+    just the frame that holds the new position.
+    """
+
+    def __init__(self, raw, codec):
+        self._raw = raw
+        self._decompress = _decompressor(codec)
+        raw.seek(-SEEK_FOOTER.size, io.SEEK_END)
+        count, descriptor, magic = SEEK_FOOTER.unpack(raw.read(SEEK_FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError("Compressed file has no seek table.")
+        entry = SEEK_ENTRY_CHECKSUM if descriptor & 0x80 else SEEK_ENTRY
+        raw.seek(-(SEEK_FOOTER.size + count * entry.size), io.SEEK_END)
+        table = raw.read(count * entry.size)
+
+        self._offsets, self._lengths, self._starts = [], [], []
+        packed_total = size = 0
+        for packed, unpacked, *_ in entry.iter_unpack(table):
+            self._offsets.append(packed_total)
+            self._lengths.append(packed)
+            self._starts.append(size)
+            packed_total += packed
+            size += unpacked
+        self.size = size
+        self._pos = 0
+        self._frame = None
+        self._data = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._pos = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        index = bisect.bisect_right(self._starts, self._pos) - 1
+        if index != self._frame:
+            self._raw.seek(self._offsets[index])
+            self._data = self._decompress(self._raw.read(self._lengths[index]))
+            self._frame = index
+        start = self._pos - self._starts[index]
+        chunk = memoryview(self._data)[start:start + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+            self._data = b''
+        super().close()
+
+
+def open_stored_name(name, encoding=''):
+    """
+    Opens a stored file for reading its content, decompressing transparently
+    when encoding is set. Each call gets its own handle.
+    """
+    handle = default_storage.open(name, 'rb')
+    if not encoding:
+        return handle
+    try:
+        return SeekableReader(handle, encoding)
+    except Exception:
+        handle.close()
+        raise
+
+
+def open_stored(uploaded_file):
+    # Not uploaded_file.file.open(): cached instances are shared between
+    # requests and a FieldFile holds a single handle.
+    return open_stored_name(uploaded_file.file.name, uploaded_file.encoding)
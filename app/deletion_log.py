@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Blob, StorageDeletion
+from .variants import variant_names
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_DELAY = 60 * 60
+
+_pool = None
+_pool_lock = threading.Lock()
+_draining = threading.Event()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.STORAGE_DELETE_WORKERS, thread_name_prefix='blob-delete')
+    return _pool
+
+
+def claim_deletions(limit):
+    """
+    Leases up to limit due entries to this worker. Other workers skip them
+    until the lease runs out, which is also how a crashed worker's entries
+    come back.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            StorageDeletion.objects.select_for_update(skip_locked=True)
+            .filter(next_attempt_at__lte=now).order_by('next_attempt_at', 'id')[:limit]
+        )
+        if entries:
+            StorageDeletion.objects.filter(pk__in=[e.pk for e in entries]).update(
+                next_attempt_at=now + timedelta(seconds=settings.STORAGE_DELETE_LEASE),
+                attempts=F('attempts') + 1,
+            )
+    for entry in entries:
+        entry.attempts += 1
+    return entries
+
+
+def _remove(name, sha256):
+    default_storage.delete(name)
+    if sha256:
+        # Precompressed copies of a blob are stored beside it.
+        for variant in variant_names(name):
+            default_storage.delete(variant)
+
+
+def process_deletions(entries, pool):
+    """
+    Removes the bytes for entries, storage calls in parallel on pool. Finished
+    entries are dropped in one DELETE; failures are retried with backoff.
+    Returns the number finished.
+    """
+    with transaction.atomic():
+        # Content uploaded again since its blob was dropped lives at the same
+        # name. blobs._claim locks these same rows before placing bytes, so
+        # an upload either committed its Blob before the check below or waits
+        # until the old bytes are gone.
+        list(StorageDeletion.objects.select_for_update().filter(pk__in=[e.pk for e in entries]).order_by('pk'))
+        revived = set(
+            Blob.objects.filter(sha256__in=[e.sha256 for e in entries if e.sha256]).values_list('sha256', flat=True)
+        )
+        pending = [e for e in entries if e.sha256 not in revived]
+        futures = {e.pk: pool.submit(_remove, e.name, e.sha256) for e in pending}
+
+        done = [e.pk for e in entries if e.sha256 in revived]
+        failed = []
+        for entry in pending:
+            error = futures[entry.pk].exception()
+            if error is None:
+                done.append(entry.pk)
+            else:
+                logger.warning("Could not remove %s (attempt %s): %s", entry.name, entry.attempts, error)
+                failed.append((entry, error))
+
+        StorageDeletion.objects.filter(pk__in=done).delete()
+    now = timezone.now()
+    for entry, error in failed:
+        delay = min(settings.STORAGE_DELETE_RETRY_BACKOFF * 2 ** (entry.attempts - 1), MAX_RETRY_DELAY)
+        StorageDeletion.objects.filter(pk=entry.pk).update(
+            last_error=str(error), next_attempt_at=now + timedelta(seconds=delay)
+        )
+    return len(done)
+
+
+def drain_deletions(batch_size=None, pool=None):
+    """
+    Processes due entries batch by batch until none are left. Returns the
+    number of entries finished.
+    """
+    batch_size = batch_size or settings.STORAGE_DELETE_BATCH_SIZE
+    pool = pool or _get_pool()
+    finished = 0
+    while True:
+        entries = claim_deletions(batch_size)
+        if not entries:
+            return finished
+        finished += process_deletions(entries, pool)
+
+
+def _drain_in_background():
+    try:
+        drain_deletions()
+    except Exception:
+        logger.exception("Deletion log drain failed")
+    finally:
+        _draining.clear()
+        close_old_connections()
+
+
+def drain_soon():
+    """
+    Starts draining right after a delete commits so bytes usually go within
+    moments; the worker command remains the backstop for anything missed.
+    """
+    if not _draining.is_set():
+        _draining.set()
+        threading.Thread(target=_drain_in_background, daemon=True).start()
+
+
+def run_worker(poll_interval=5.0, once=False):
+    while True:
+        drain_deletions()
+        if once:
+            return
+        time.sleep(poll_interval)
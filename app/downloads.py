@@ -0,0 +1,294 @@
+import asyncio
+import mimetypes
+import os
+import re
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from .compression import open_stored
+from .variants import is_negotiable, select_variant
+
+STREAM_BLOCK_SIZE = 64 * 1024
+ASYNC_STREAM_BLOCK_SIZE = 256 * 1024
+MAX_RANGES = 16
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def file_etag(uploaded_file):
+    # Stored bytes never change for a row, so its identity and size make a strong validator.
+    return f'"{uploaded_file.link_id.hex}-{uploaded_file.size:x}"'
+
+
+def file_last_modified(uploaded_file):
+    return int(uploaded_file.uploaded_at.timestamp())
+
+
+def parse_range_header(header, size):
+    """
+    Returns a list of (start, end) inclusive byte ranges, [] when none are
+    satisfiable, or None when the header should be ignored.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        elif last:
+            start = max(size - int(last), 0)
+            end = size - 1
+            if int(last) == 0:
+                continue
+        else:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _if_range_passes(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _read_range(file_handle, start, length):
+    file_handle.seek(start)
+    while length > 0:
+        block = file_handle.read(min(STREAM_BLOCK_SIZE, length))
+        if not block:
+            break
+        length -= len(block)
+        yield block
+
+
+def _single_range_body(file_handle, start, end):
+    try:
+        yield from _read_range(file_handle, start, end - start + 1)
+    finally:
+        file_handle.close()
+
+
+async def _aread_range(file_handle, start, length):
+    # Each block is a single positional read on the shared executor, so a slow
+    # client holds no thread while it waits for the socket to drain.
+    loop = asyncio.get_running_loop()
+    try:
+        fd = file_handle.fileno()
+    except OSError:
+        # Compressed files decode through a reader with no descriptor of its own.
+        fd = None
+    offset = start
+    while length > 0:
+        size = min(ASYNC_STREAM_BLOCK_SIZE, length)
+        if fd is not None and hasattr(os, 'pread'):
+            block = await loop.run_in_executor(None, os.pread, fd, size, offset)
+        else:
+            block = await loop.run_in_executor(None, _seek_read, file_handle, offset, size)
+        if not block:
+            break
+        offset += len(block)
+        length -= len(block)
+        yield block
+
+
+def _seek_read(file_handle, offset, size):
+    file_handle.seek(offset)
+    return file_handle.read(size)
+
+
+async def _async_single_range_body(file_handle, start, end):
+    try:
+        async for block in _aread_range(file_handle, start, end - start + 1):
+            yield block
+    finally:
+        file_handle.close()
+
+
+def _multipart_parts(ranges, size, content_type, boundary):
+    parts = []
+    for start, end in ranges:
+        header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        parts.append((header, start, end))
+    return parts, f"\r\n--{boundary}--\r\n".encode()
+
+
+def _multipart_body(file_handle, parts, trailer):
+    try:
+        for header, start, end in parts:
+            yield header
+            yield from _read_range(file_handle, start, end - start + 1)
+        yield trailer
+    finally:
+        file_handle.close()
+
+
+async def _async_multipart_body(file_handle, parts, trailer):
+    try:
+        for header, start, end in parts:
+            yield header
+            async for block in _aread_range(file_handle, start, end - start + 1):
+                yield block
+        yield trailer
+    finally:
+        file_handle.close()
+
+
+def _content_type(filename):
+    content_type, encoding = mimetypes.guess_type(filename)
+    if encoding:
+        return 'application/octet-stream'
+    return content_type or 'application/octet-stream'
+
+
+def _offload_response(uploaded_file, filename, as_attachment):
+    """
+    Lets the front proxy send the bytes; the view has already authorised access.
+    """
+    mode = settings.FILE_DELIVERY_MODE
+    response = HttpResponse(content_type=_content_type(filename))
+    if mode == 'x-accel-redirect':
+        prefix = settings.FILE_DELIVERY_ACCEL_PREFIX.rstrip('/')
+        response['X-Accel-Redirect'] = f"{prefix}/{quote(uploaded_file.file.name)}"
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = uploaded_file.file.path
+    else:
+        raise ImproperlyConfigured(f"Unknown FILE_DELIVERY_MODE: {mode!r}")
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def _variant_response(variant, filename, content_type, as_attachment, asynchronous):
+    file_handle = default_storage.open(variant.name, 'rb')
+    body = _async_single_range_body if asynchronous else _single_range_body
+    response = StreamingHttpResponse(body(file_handle, 0, variant.size - 1), content_type=content_type)
+    response['Content-Encoding'] = variant.coding
+    response['Content-Length'] = str(variant.size)
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def serve_file(request, uploaded_file, as_attachment=True, asynchronous=False):
+    """
+    Streams an UploadedFile honouring Range, If-Range and conditional GET
+    headers. Raises FileNotFoundError if the stored file is missing.
+
+    With asynchronous=True the body is an async iterator for ASGI views; it
+    does not touch the database, so async views may call it directly.
+    """
+    size = uploaded_file.size
+    filename = uploaded_file.original_name or uploaded_file.file.name
+    content_type = _content_type(filename)
+    etag = file_etag(uploaded_file)
+    last_modified = file_last_modified(uploaded_file)
+
+    # Precompressed variants are only offered to full responses from this
+    # process; Range requests always address the identity bytes.
+    negotiable = settings.FILE_DELIVERY_MODE == 'stream' and is_negotiable(uploaded_file, content_type)
+    variant = None
+    if negotiable and not request.META.get('HTTP_RANGE'):
+        variant = select_variant(request, uploaded_file)
+    if variant is not None:
+        etag = f'{etag[:-1]}-{variant.coding}"'
+
+    validators = HttpResponse()
+    validators['ETag'] = etag
+    validators['Last-Modified'] = http_date(last_modified)
+    validators['Accept-Ranges'] = 'bytes'
+    if negotiable:
+        validators['Vary'] = 'Accept-Encoding'
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified, response=validators)
+    if conditional is not validators:
+        return conditional
+
+    if settings.FILE_DELIVERY_MODE != 'stream' and not uploaded_file.encoding:
+        # The proxy answers Range requests itself when serving the redirect.
+        # Compressed files are decoded here, so they always stream.
+        response = _offload_response(uploaded_file, filename, as_attachment)
+        for header in ('ETag', 'Last-Modified', 'Accept-Ranges'):
+            response[header] = validators[header]
+        return response
+
+    if variant is not None:
+        response = _variant_response(variant, filename, content_type, as_attachment, asynchronous)
+        for header in ('ETag', 'Last-Modified', 'Accept-Ranges', 'Vary'):
+            response[header] = validators[header]
+        return response
+
+    ranges = None
+    if request.method in ('GET', 'HEAD') and _if_range_passes(request, etag, last_modified):
+        ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        response['Accept-Ranges'] = 'bytes'
+        if negotiable:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+    file_handle = open_stored(uploaded_file)
+
+    single_range_body = _async_single_range_body if asynchronous else _single_range_body
+    multipart_body = _async_multipart_body if asynchronous else _multipart_body
+
+    if not ranges and not asynchronous:
+        response = FileResponse(file_handle, as_attachment=as_attachment, filename=filename)
+    elif not ranges:
+        response = StreamingHttpResponse(_async_single_range_body(file_handle, 0, size - 1), content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            single_range_body(file_handle, start, end), status=206, content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        parts, trailer = _multipart_parts(ranges, size, content_type, boundary)
+        length = sum(len(header) + end - start + 1 for header, start, end in parts) + len(trailer)
+        response = StreamingHttpResponse(
+            multipart_body(file_handle, parts, trailer), status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}'
+        )
+        response['Content-Length'] = str(length)
+
+    if ranges or asynchronous:
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    for header in ('ETag', 'Last-Modified', 'Accept-Ranges', 'Vary'):
+        if header in validators:
+            response[header] = validators[header]
+    return response
@@ -0,0 +1,126 @@
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .link_filter import link_might_exist
+from .lru import LRUCache
+from .models import ShareLink, UploadedFile, UserProfile
+from .shared_cache import cache_is_shared
+
+
+_local = LRUCache(settings.LINK_CACHE_LOCAL_SIZE)
+
+
+def _key(link_id):
+    return f"sharelink:{link_id}"
+
+
+def _storage_limit_mb(user):
+    try:
+        return user.profile.storage_limit_mb
+    except UserProfile.DoesNotExist:
+        return None
+
+
+def _serialize(link):
+    file = link.file
+    return {
+        'id': link.id,
+        'link_id': link.link_id.hex,
+        'expires_at': link.expires_at.isoformat(),
+        'file': {
+            'id': file.id,
+            'user_id': file.user_id,
+            'username': file.user.username if file.user_id else None,
+            'storage_limit_mb': _storage_limit_mb(file.user) if file.user_id else None,
+            'blob_id': file.blob_id,
+            'name': file.file.name,
+            'original_name': file.original_name,
+            'size': file.size,
+            'encoding': file.encoding,
+            'link_id': file.link_id.hex,
+            'uploaded_at': file.uploaded_at.isoformat(),
+            'expires_at': file.expires_at.isoformat(),
+        },
+    }
+
+
+def _hydrate(data):
+    # Rebuilt instances carry everything the download views read, so serving
+    # a cached link never lazy-loads a relation.
+    meta = data['file']
+    file = UploadedFile(
+        id=meta['id'],
+        blob_id=meta['blob_id'],
+        file=meta['name'],
+        original_name=meta['original_name'],
+        size=meta['size'],
+        encoding=meta.get('encoding', ''),
+        link_id=uuid.UUID(meta['link_id']),
+        uploaded_at=datetime.fromisoformat(meta['uploaded_at']),
+        expires_at=datetime.fromisoformat(meta['expires_at']),
+    )
+    file._state.adding = False
+    file.user = User(id=meta['user_id'], username=meta['username']) if meta['user_id'] else None
+    if meta.get('storage_limit_mb') is not None:
+        file.user.profile = UserProfile(user_id=meta['user_id'], storage_limit_mb=meta['storage_limit_mb'])
+    link = ShareLink(id=data['id'], link_id=uuid.UUID(data['link_id']), expires_at=datetime.fromisoformat(data['expires_at']))
+    link._state.adding = False
+    link.file = file
+    return link
+
+
+def _ttl(expires_at, limit):
+    remaining = (expires_at - timezone.now()).total_seconds()
+    if remaining <= 0:
+        return limit  # Expired links still resolve so the view can answer 410.
+    return max(1, min(limit, int(remaining)))
+
+
+def resolve_share_link(link_id):
+    """
+    Returns the ShareLink (with its file) for link_id, or None. Hot links are
+    answered from the in-process LRU, then the shared cache, then the database.
+    Without a shared cache the second tier would be just another per-process
+    copy that other processes cannot invalidate, so it is skipped.
+    Tokens the link filter has never seen are refused before any lookup.
+    """
+    if not link_might_exist(link_id):
+        return None
+    key = _key(link_id)
+    shared = cache_is_shared()
+    data = _local.get(key)
+    if data is None:
+        data = cache.get(key) if shared else None
+        if data is None:
+            link = ShareLink.objects.select_related('file', 'file__user', 'file__user__profile').filter(link_id=link_id).first()
+            if link is None:
+                return None
+            data = _serialize(link)
+            if shared:
+                cache.set(key, data, timeout=_ttl(link.expires_at, settings.LINK_CACHE_TTL))
+        expires_at = datetime.fromisoformat(data['expires_at'])
+        _local.set(key, data, _ttl(expires_at, settings.LINK_CACHE_LOCAL_TTL))
+    return _hydrate(data)
+
+
+def invalidate_share_link(link_id):
+    _local.delete(_key(link_id))
+    cache.delete(_key(link_id))
+
+
+@receiver(post_save, sender=ShareLink)
+@receiver(post_delete, sender=ShareLink)
+def _invalidate_on_change(sender, instance, **kwargs):
+    # Deleting a file cascades to its links, so this also covers delete_file.
+    # Dropping the entry again on commit stops a concurrent reader from
+    # re-caching the row we are about to change.
+    invalidate_share_link(instance.link_id)
+    transaction.on_commit(lambda: invalidate_share_link(instance.link_id))
@@ -0,0 +1,220 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import SecureLink, ShareLink
+from .shared_cache import cache_is_shared
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'linkfilter:gen'
+ADDED_KEY = 'linkfilter:add:{}'
+ADDED_TTL = 24 * 60 * 60
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # Kirsch-Mitzenmacher: two 64-bit halves of one digest stand in for k hashes.
+        digest = hashlib.blake2b(value, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+    def estimated_error_rate(self):
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class LinkFilter:
+    """
+    Every ShareLink.link_id and SecureLink.token this process has seen. A
+    negative answer means the token does not exist, so callers can 404 without
+    a query. Links created elsewhere reach us through an additions log in the
+    shared cache, written once they commit; deletions only leave stale bits
+    until the next rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._generation = 0
+        self._built_at = 0.0
+        self._rebuilding = False
+        self.checks = 0
+        self.rejections = 0
+
+    def rebuild(self):
+        share_ids = ShareLink.objects.values_list('link_id', flat=True)
+        secure_ids = SecureLink.objects.values_list('token', flat=True)
+        # Read the generation first so additions racing with the scan are replayed.
+        # Seeding it lets _catch_up tell a flushed cache from an unused one.
+        cache.add(GENERATION_KEY, 0, timeout=None)
+        generation = cache.get(GENERATION_KEY, 0)
+        count = share_ids.count() + secure_ids.count()
+        bloom = BloomFilter(max(count * 2, settings.LINK_FILTER_MIN_CAPACITY), settings.LINK_FILTER_ERROR_RATE)
+        for token in share_ids.iterator(chunk_size=5000):
+            bloom.add(token.bytes)
+        for token in secure_ids.iterator(chunk_size=5000):
+            bloom.add(token.bytes)
+        with self._lock:
+            self._filter = bloom
+            self._generation = generation
+            self._built_at = time.monotonic()
+        self._catch_up()
+        return bloom
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Link filter rebuild failed")
+        finally:
+            self._rebuilding = False
+            close_old_connections()
+
+    def _catch_up(self):
+        """
+        Replays additions made by other processes. Returns False when part of
+        the log has been evicted and the filter can no longer be trusted.
+        """
+        generation = cache.get(GENERATION_KEY)
+        with self._lock:
+            if generation is None or generation < self._generation:
+                return False  # The shared cache was flushed.
+            if generation == self._generation:
+                return True
+            keys = [ADDED_KEY.format(n) for n in range(self._generation + 1, generation + 1)]
+            added = cache.get_many(keys)
+            if len(added) != len(keys):
+                return False
+            for token in added.values():
+                self._filter.add(token)
+            self._generation = generation
+        return True
+
+    def add(self, token):
+        self.add_many([token])
+
+    def add_many(self, tokens):
+        # bulk_create() sends no post_save, so bulk link creation calls this directly.
+        if not tokens or not link_filter_enabled():
+            return
+        with self._lock:
+            if self._filter is not None:
+                for token in tokens:
+                    self._filter.add(token.bytes)
+        # Other processes learn of the links only once the rows are committed:
+        # a rebuild there that read the new generation before the rows were
+        # visible would otherwise skip them for good.
+        transaction.on_commit(lambda: self._publish(tokens))
+
+    def _publish(self, tokens):
+        try:
+            generation = cache.incr(GENERATION_KEY, len(tokens))
+        except ValueError:
+            cache.add(GENERATION_KEY, 0, timeout=None)
+            generation = cache.incr(GENERATION_KEY, len(tokens))
+        first = generation - len(tokens) + 1
+        cache.set_many(
+            {ADDED_KEY.format(first + i): token.bytes for i, token in enumerate(tokens)}, timeout=ADDED_TTL
+        )
+
+    def _needs_rebuild(self):
+        # Past capacity the false-positive rate climbs quickly, so size up early.
+        return (
+            time.monotonic() - self._built_at > settings.LINK_FILTER_REBUILD_INTERVAL
+            or self._filter.count > self._filter.capacity
+        )
+
+    def _rebuild_soon(self):
+        if not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def might_exist(self, token):
+        if self._filter is None:
+            self.rebuild()
+        elif self._needs_rebuild():
+            self._rebuild_soon()
+
+        self.checks += 1
+        if token.bytes in self._filter:
+            return True
+        if not self._catch_up():
+            # The log has a gap, often just another process between its incr
+            # and set_many. Let the database answer rather than scanning every
+            # token on the request thread.
+            self._rebuild_soon()
+            return True
+        if token.bytes in self._filter:
+            return True
+        self.rejections += 1
+        return False
+
+    def stats(self):
+        bloom = self._filter
+        if bloom is None:
+            return {'built': False, 'checks': self.checks, 'rejections': self.rejections}
+        return {
+            'built': True,
+            'items': bloom.count,
+            'capacity': bloom.capacity,
+            'bits': bloom.num_bits,
+            'hashes': bloom.num_hashes,
+            'memory_bytes': len(bloom.bits),
+            'target_error_rate': bloom.error_rate,
+            'estimated_error_rate': bloom.estimated_error_rate(),
+            'age_seconds': round(time.monotonic() - self._built_at),
+            'checks': self.checks,
+            'rejections': self.rejections,
+        }
+
+
+link_filter = LinkFilter()
+
+
+def link_filter_enabled():
+    # Without a shared cache other processes never hear of new links and
+    # would 404 them until their next rebuild.
+    return settings.LINK_FILTER_ENABLED and cache_is_shared()
+
+
+def link_might_exist(token):
+    if not link_filter_enabled():
+        return True
+    return link_filter.might_exist(token)
+
+
+@receiver(post_save, sender=ShareLink)
+def _add_share_link(sender, instance, created, **kwargs):
+    if created:
+        link_filter.add(instance.link_id)
+
+
+@receiver(post_save, sender=SecureLink)
+def _add_secure_link(sender, instance, created, **kwargs):
+    if created:
+        link_filter.add(instance.token)
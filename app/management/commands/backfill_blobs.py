@@ -0,0 +1,60 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.blobs import adopt_stored_file
+from app.models import (
+    StorageQuotaExceeded, UploadedFile, charge_storage, get_dedup_stats, queue_storage_deletions, release_storage,
+)
+
+
+class Command(BaseCommand):
+    help = "Moves files stored under media/uploads into the deduplicated blob store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be migrated.")
+
+    def handle(self, *args, **options):
+        pending = UploadedFile.objects.filter(blob__isnull=True).exclude(file='').order_by('id')
+        migrated = missing = 0
+        last_id = 0
+
+        while True:
+            batch = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            for uploaded in batch:
+                last_id = uploaded.id
+                name = uploaded.file.name
+                if not default_storage.exists(name):
+                    missing += 1
+                    self.stderr.write(f"Missing file for #{uploaded.id}: {name}")
+                    continue
+                if options['dry_run']:
+                    migrated += 1
+                    continue
+
+                try:
+                    with transaction.atomic():
+                        blob = adopt_stored_file(name)
+                        # The recorded size may be stale; bring the owner's counters along.
+                        delta = blob.size - uploaded.size
+                        if delta > 0:
+                            charge_storage(uploaded.user, delta, files=0)
+                        elif delta < 0:
+                            release_storage(uploaded.user_id, -delta, files=0)
+                        UploadedFile.objects.filter(pk=uploaded.pk).update(blob=blob, file=blob.file.name, size=blob.size, encoding=blob.encoding)
+                        if not UploadedFile.objects.filter(file=name).exists():
+                            queue_storage_deletions([(name, '')])
+                except StorageQuotaExceeded:
+                    self.stderr.write(f"Over quota, left as is: #{uploaded.id}: {name}")
+                    continue
+                migrated += 1
+
+        stats = get_dedup_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {migrated} file(s), {missing} missing. "
+            f"{stats['blobs']} blob(s), {stats['logical_bytes']} logical / {stats['physical_bytes']} physical bytes "
+            f"(dedup ratio {stats['ratio']}x)."
+        ))
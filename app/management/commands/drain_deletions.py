@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app.deletion_log import run_worker
+
+
+class Command(BaseCommand):
+    help = "Removes stored bytes queued in the deletion log, retrying failures with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5.0)
+        parser.add_argument('--once', action='store_true', help="Exit once nothing is due.")
+
+    def handle(self, *args, **options):
+        try:
+            run_worker(options['poll_interval'], options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write("Deletion worker stopped.")
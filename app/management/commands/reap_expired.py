@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.reaper import reap_expired
+
+
+class Command(BaseCommand):
+    help = "Deletes expired share links, secure links and files, and abandoned uploads, in throttled batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.REAPER_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=settings.REAPER_WORKERS,
+                            help="Threads removing stored bytes.")
+        parser.add_argument('--rate', type=float, default=settings.REAPER_MAX_DELETES_PER_SECOND,
+                            help="Maximum rows deleted per second (0 = unlimited).")
+        parser.add_argument('--grace', type=int, default=settings.REAPER_GRACE_PERIOD,
+                            help="Seconds past expiry before a row is purged.")
+        parser.add_argument('--loop', action='store_true', help="Keep running, one pass every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=300.0)
+
+    def handle(self, *args, **options):
+        while True:
+            links, files, uploads = reap_expired(
+                options['batch_size'], options['workers'], options['rate'], options['grace']
+            )
+            self.stdout.write(self.style.SUCCESS(f"Reaped {links} link(s) and {files} file(s)."))
+            if uploads:
+                self.stdout.write(f"Removed {uploads} abandoned upload(s).")
+            if not options['loop']:
+                return
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                self.stdout.write("Reaper stopped.")
+                return
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from app.models import UploadedFile, UserProfile
+
+
+class Command(BaseCommand):
+    help = "Repairs drift between UserProfile usage counters and the files users actually own."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report drifted profiles.")
+
+    def _actual_usage(self, user_id):
+        usage = UploadedFile.objects.filter(user_id=user_id).aggregate(total=Sum('size'), count=Count('id'))
+        return usage['total'] or 0, usage['count']
+
+    def handle(self, *args, **options):
+        actual = {
+            row['user']: (row['total'] or 0, row['count'])
+            for row in UploadedFile.objects.filter(user__isnull=False)
+            .values('user').annotate(total=Sum('size'), count=Count('id'))
+        }
+
+        repaired = 0
+        for profile in UserProfile.objects.only('id', 'user_id', 'bytes_used', 'file_count').iterator():
+            if (profile.bytes_used, profile.file_count) == actual.get(profile.user_id, (0, 0)):
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"Drift for user #{profile.user_id}: {profile.bytes_used} bytes / {profile.file_count} files")
+                repaired += 1
+                continue
+
+            # Recount under the row lock so uploads landing meanwhile are not lost.
+            with transaction.atomic():
+                locked = UserProfile.objects.select_for_update().get(pk=profile.pk)
+                bytes_used, file_count = self._actual_usage(locked.user_id)
+                if (locked.bytes_used, locked.file_count) != (bytes_used, file_count):
+                    UserProfile.objects.filter(pk=locked.pk).update(bytes_used=bytes_used, file_count=file_count)
+                    repaired += 1
+
+        verb = "drifted" if options['dry_run'] else "repaired"
+        self.stdout.write(self.style.SUCCESS(f"{repaired} profile(s) {verb}."))
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.url_import import run_worker
+
+
+class Command(BaseCommand):
+    help = "Processes queued URL imports on a bounded pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.URL_IMPORT_WORKERS)
+        parser.add_argument('--poll-interval', type=float, default=2.0)
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Import worker started with {options['concurrency']} slot(s).")
+        try:
+            run_worker(options['concurrency'], options['poll_interval'], options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write("Import worker stopped.")
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_usage(apps, schema_editor):
+    UploadedFile = apps.get_model('app', 'UploadedFile')
+    UserProfile = apps.get_model('app', 'UserProfile')
+    usage = UploadedFile.objects.filter(user__isnull=False).values('user').annotate(total=Sum('size'), count=Count('id'))
+    for row in usage:
+        UserProfile.objects.filter(user_id=row['user']).update(bytes_used=row['total'] or 0, file_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='bytes_used',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='file_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_uploadedfile_name_trgm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['user', 'created_at'], name='importjob_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(condition=models.Q(('status', 'QUEUED')), fields=['next_attempt_at', 'created_at'], name='importjob_queued_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(condition=models.Q(('status', 'RUNNING')), fields=['updated_at'], name='importjob_running_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['user', 'created_at'], name='payment_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='securelink',
+            index=models.Index(fields=['expiry_time'], name='securelink_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharelink',
+            index=models.Index(fields=['file', 'expires_at'], name='sharelink_file_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharelink',
+            index=models.Index(fields=['expires_at'], name='sharelink_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'uploaded_at', 'id'], name='file_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'original_name', 'id'], name='file_user_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'size', 'id'], name='file_user_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['expires_at'], name='file_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(condition=models.Q(('bytes_used__gt', 0)), fields=['bytes_used'], name='profile_bytes_used_idx'),
+        ),
+    ]
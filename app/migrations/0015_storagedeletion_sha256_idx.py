@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_importjob_resume_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storagedeletion',
+            index=models.Index(fields=['sha256'], name='storagedeletion_sha256_idx'),
+        ),
+    ]
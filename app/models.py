@@ -1,11 +1,22 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+import os
+import threading
 import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import Case, ExpressionWrapper, F, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
+class StorageQuotaExceeded(Exception):
+    pass
+
 def default_expiry():
     return timezone.now() + timedelta(days=1)
 
@@ -13,18 +24,57 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     storage_limit_mb = models.FloatField(default=1024.0)  # Default 1GB
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    # Maintained by charge_storage/release_storage; repair with `manage.py reconcile_storage`
+    bytes_used = models.BigIntegerField(default=0)
+    file_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Admin storage chart: heaviest users first, idle profiles left out.
+            models.Index(fields=['bytes_used'], condition=models.Q(bytes_used__gt=0), name='profile_bytes_used_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+class Blob(models.Model):
+    """Content-addressed file bytes shared by every UploadedFile with the same SHA-256."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to="blobs/")
+    size = models.BigIntegerField(default=0)
+    # Bytes on disk; differs from size when stored compressed. Null for blobs older than the field.
+    stored_size = models.BigIntegerField(null=True, blank=True)
+    encoding = models.CharField(max_length=8, blank=True, default='')
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
 class UploadedFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     file = models.FileField(upload_to="uploads/")
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='uploads')
     original_name = models.CharField(max_length=255, blank=True)
     size = models.BigIntegerField(default=0)
+    # Copied from the blob so readers know how to decode the stored bytes without loading it.
+    encoding = models.CharField(max_length=8, blank=True, default='')
     link_id = models.UUIDField(default=uuid.uuid4, unique=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(default=default_expiry)
+    # Share-link traffic, written in batches by app.analytics; never set these on save().
+    download_count = models.PositiveIntegerField(default=0)
+    bytes_served = models.BigIntegerField(default=0)
+    last_accessed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # One per file_list sort; the trailing id is the keyset tie-breaker.
+            models.Index(fields=['user', 'uploaded_at', 'id'], name='file_user_uploaded_idx'),
+            models.Index(fields=['user', 'original_name', 'id'], name='file_user_name_idx'),
+            models.Index(fields=['user', 'size', 'id'], name='file_user_size_idx'),
+            models.Index(fields=['expires_at'], name='file_expires_idx'),
+        ]
 
     def __str__(self):
         return self.original_name
@@ -35,6 +85,11 @@ class SecureLink(models.Model):
     expiry_time = models.DateTimeField()
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['expiry_time'], name='securelink_expiry_idx'),
+        ]
+
     def is_expired(self):
         return timezone.now() > self.expiry_time
 
@@ -45,10 +100,128 @@ class ShareLink(models.Model):
     file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE)
     link_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     expires_at = models.DateTimeField()
+    # Links created together share a batch_id and can be downloaded as one ZIP.
+    batch_id = models.UUIDField(null=True, blank=True, db_index=True)
+    download_count = models.PositiveIntegerField(default=0)
+    bytes_served = models.BigIntegerField(default=0)
+    last_accessed_at = models.DateTimeField(null=True, blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['file', 'expires_at'], name='sharelink_file_expires_idx'),
+            models.Index(fields=['expires_at'], name='sharelink_expires_idx'),
+        ]
+
     def is_expired(self):
         return timezone.now() > self.expires_at
 
+class AccessLog(models.Model):
+    """One share-link request, written in batches by app.analytics."""
+    file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='access_logs')
+    link = models.ForeignKey(ShareLink, on_delete=models.SET_NULL, null=True, blank=True, related_name='access_logs')
+    status = models.PositiveSmallIntegerField()
+    bytes_served = models.BigIntegerField(default=0)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    user_agent = models.CharField(max_length=255, blank=True)
+    accessed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['file', 'accessed_at'], name='accesslog_file_accessed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.file_id} {self.status} {self.accessed_at}"
+
+class UploadSession(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    upload_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def part_dir(self):
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, str(self.upload_id))
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.total_size // self.chunk_size))
+
+    def expected_chunk_size(self, index):
+        if index == self.chunk_count - 1:
+            return self.total_size - index * self.chunk_size
+        return self.chunk_size
+
+    def __str__(self):
+        return f"{self.filename} ({self.upload_id})"
+
+class ImportJob(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    job_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    url = models.URLField(max_length=2048)
+    status = models.CharField(max_length=20, default='QUEUED')  # QUEUED, RUNNING, SUCCESS, FAILED
+    filename = models.CharField(max_length=255, blank=True)
+    bytes_done = models.BigIntegerField(default=0)
+    total_bytes = models.BigIntegerField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    partial_path = models.CharField(max_length=500, blank=True)
+    # Strong ETag or Last-Modified of the partial bytes; sent as If-Range on resume.
+    source_validator = models.CharField(max_length=255, blank=True)
+    # Set on every claim; a worker only writes while the job still holds its lease.
+    lease = models.UUIDField(null=True, blank=True)
+    file = models.ForeignKey(UploadedFile, on_delete=models.SET_NULL, null=True, blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='importjob_user_created_idx'),
+            # Workers only ever look at the small QUEUED and RUNNING slices.
+            models.Index(
+                fields=['next_attempt_at', 'created_at'], condition=models.Q(status='QUEUED'), name='importjob_queued_idx'
+            ),
+            models.Index(fields=['updated_at'], condition=models.Q(status='RUNNING'), name='importjob_running_idx'),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in ('SUCCESS', 'FAILED')
+
+    @property
+    def percent(self):
+        if not self.total_bytes:
+            return None
+        return min(100, round(self.bytes_done * 100 / self.total_bytes))
+
+    def __str__(self):
+        return f"{self.url} - {self.status}"
+
+class StorageDeletion(models.Model):
+    """
+    Stored bytes waiting to be removed, written in the same transaction that
+    dropped their last reference. Drained by `manage.py drain_deletions`.
+    """
+    name = models.CharField(max_length=255)
+    sha256 = models.CharField(max_length=64, blank=True)  # Blobs only; skipped if the content came back
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at', 'id'], name='storagedeletion_due_idx'),
+            # Every new blob locks the entries for its content (blobs._claim).
+            models.Index(fields=['sha256'], name='storagedeletion_sha256_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
 class PaymentTransaction(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     order_id = models.CharField(max_length=100, unique=True)
@@ -58,12 +231,63 @@ class PaymentTransaction(models.Model):
     status = models.CharField(max_length=20, default='PENDING')  # PENDING, SUCCESS, FAILED
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='payment_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.order_id} - {self.status}"
 
+def get_user_storage_usage(user):
+    usage = UserProfile.objects.filter(user=user).values('bytes_used', 'file_count').first()
+    return usage or {'bytes_used': 0, 'file_count': 0}
+
 def get_user_storage_used(user):
-    total = UploadedFile.objects.filter(user=user).aggregate(models.Sum("size"))["size__sum"]
-    return total or 0
+    return get_user_storage_usage(user)['bytes_used']
+
+def charge_storage(user, size, files=1):
+    """
+    Adds to user's usage counters in one conditional UPDATE that refuses to go
+    over their limit, so concurrent uploads cannot overshoot it. Call inside
+    the transaction that creates the file rows.
+    """
+    for _ in range(2):
+        updated = UserProfile.objects.filter(
+            user=user,
+            bytes_used__lte=ExpressionWrapper(
+                F('storage_limit_mb') * 1024 * 1024 - size, output_field=models.FloatField()
+            ),
+        ).update(bytes_used=F('bytes_used') + size, file_count=F('file_count') + files)
+        if updated:
+            return
+        _, created = UserProfile.objects.get_or_create(user=user)
+        if not created:
+            break
+    raise StorageQuotaExceeded('Not enough storage space for this file.')
+
+def release_storage(user_id, size, files=1):
+    UserProfile.objects.filter(user_id=user_id).update(
+        bytes_used=Greatest(F('bytes_used') - size, 0),
+        file_count=Greatest(F('file_count') - files, 0),
+    )
+
+def get_dedup_stats():
+    logical = UploadedFile.objects.filter(blob__isnull=False).aggregate(models.Sum("size"))["size__sum"] or 0
+    blobs = Blob.objects.aggregate(
+        count=models.Count("id"),
+        unique=Coalesce(models.Sum("size"), 0),
+        physical=Coalesce(models.Sum(Coalesce("stored_size", "size")), 0),
+    )
+    unique, physical = blobs["unique"], blobs["physical"]
+    return {
+        "blobs": blobs["count"],
+        "logical_bytes": logical,
+        "unique_bytes": unique,
+        "physical_bytes": physical,
+        "ratio": round(logical / unique, 2) if unique else 1.0,
+        "compression_ratio": round(unique / physical, 2) if physical else 1.0,
+    }
 
 def get_total_storage():
     total = UploadedFile.objects.aggregate(models.Sum("size"))["size__sum"]
@@ -86,3 +310,114 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
     except UserProfile.DoesNotExist:
         UserProfile.objects.create(user=instance)
+
+_cleanup = threading.local()
+
+
+def queue_storage_deletions(entries):
+    """
+    Records (name, sha256) pairs in the deletion log as part of the current
+    transaction, so the bytes are removed if and only if it commits.
+    """
+    if not entries:
+        return
+    StorageDeletion.objects.bulk_create([StorageDeletion(name=name, sha256=sha256) for name, sha256 in entries])
+    if settings.STORAGE_DELETE_DRAIN_ON_COMMIT:
+        from .deletion_log import drain_soon  # deletion_log imports this module
+        transaction.on_commit(drain_soon)
+
+
+class StorageCleanupBatch:
+    """
+    Counter releases, blob references and byte deletions collected from
+    UploadedFile deletes. Call apply() inside the deleting transaction.
+    """
+
+    def __init__(self):
+        self.usage = defaultdict(lambda: [0, 0])
+        self.blob_refs = Counter()
+        self.deletions = []
+
+    def release(self, user_id, size):
+        self.usage[user_id][0] += size
+        self.usage[user_id][1] += 1
+
+    def release_usage(self):
+        for user_id, (size, files) in self.usage.items():
+            release_storage(user_id, size, files)
+        self.usage.clear()
+
+    def release_blobs(self):
+        # One locking read, one UPDATE and one DELETE however many blobs lost references.
+        if not self.blob_refs:
+            return
+        blobs = Blob.objects.select_for_update().filter(pk__in=list(self.blob_refs)).order_by('pk')
+        kept, emptied = [], []
+        for blob in blobs:
+            (emptied if blob.ref_count <= self.blob_refs[blob.pk] else kept).append(blob)
+        if kept:
+            Blob.objects.filter(pk__in=[b.pk for b in kept]).update(ref_count=Case(
+                *[When(pk=b.pk, then=F('ref_count') - self.blob_refs[b.pk]) for b in kept],
+                default=F('ref_count'),
+                output_field=models.PositiveIntegerField(),
+            ))
+        if emptied:
+            Blob.objects.filter(pk__in=[b.pk for b in emptied]).delete()
+            self.deletions.extend((b.file.name, b.sha256) for b in emptied)
+        self.blob_refs.clear()
+
+    def apply(self):
+        self.release_usage()
+        self.release_blobs()
+        queue_storage_deletions(self.deletions)
+        self.deletions = []
+
+
+@contextmanager
+def batched_storage_cleanup():
+    batch = StorageCleanupBatch()
+    _cleanup.batch = batch
+    try:
+        yield batch
+    finally:
+        _cleanup.batch = None
+
+
+def _queue_deletion(name, sha256=''):
+    batch = getattr(_cleanup, 'batch', None)
+    if batch is not None:
+        batch.deletions.append((name, sha256))
+    else:
+        queue_storage_deletions([(name, sha256)])
+
+@receiver(post_delete, sender=UploadedFile)
+def release_file_storage(sender, instance, **kwargs):
+    """
+    Drops this row's reference to its bytes; they are queued for removal with
+    the last one. Runs inside the delete's transaction.
+    """
+    batch = getattr(_cleanup, 'batch', None)
+    if instance.user_id is not None:
+        if batch is not None:
+            batch.release(instance.user_id, instance.size)
+        else:
+            release_storage(instance.user_id, instance.size)
+
+    if instance.blob_id is None:
+        if instance.file:
+            _queue_deletion(instance.file.name)
+        return
+
+    if batch is not None:
+        batch.blob_refs[instance.blob_id] += 1
+        return
+
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(pk=instance.blob_id).first()
+        if blob is None:
+            return
+        if blob.ref_count <= 1:
+            blob.delete()
+            _queue_deletion(blob.file.name, blob.sha256)
+        else:
+            Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
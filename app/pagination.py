@@ -0,0 +1,79 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(row, field, direction):
+    value = getattr(row, field)
+    if isinstance(value, datetime):
+        value = value.isoformat()  # Full precision; DjangoJSONEncoder drops microseconds.
+    payload = json.dumps([value, row.pk, direction]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor, model, field):
+    """
+    Returns (value, pk, direction), or None for a missing or malformed cursor
+    so a bad link falls back to the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        value, pk, direction = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        value = model._meta.get_field(field).to_python(value)
+        pk = model._meta.pk.to_python(pk)
+    except (binascii.Error, ValueError, TypeError, ValidationError):
+        return None
+    if direction not in ('next', 'prev'):
+        return None
+    return value, pk, direction
+
+
+def keyset_page(queryset, field, descending=False, cursor=None, per_page=50):
+    """
+    One page of queryset ordered by field with the primary key as tie-breaker.
+    Pages are located by seeking past the cursor row rather than with OFFSET,
+    so every page costs the same however deep it is.
+    """
+    position = decode_cursor(cursor, queryset.model, field)
+    backwards = position is not None and position[2] == 'prev'
+    # Walking backwards means scanning the opposite order and flipping the result.
+    scan_descending = descending != backwards
+    ordered = queryset.order_by(f'-{field}', '-pk') if scan_descending else queryset.order_by(field, 'pk')
+    if position is not None:
+        value, pk, _ = position
+        op = 'lt' if scan_descending else 'gt'
+        ordered = ordered.filter(Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'pk__{op}': pk}))
+
+    rows = list(ordered[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    has_next = True if backwards else more
+    has_prev = more if backwards else position is not None
+    if not rows:
+        return KeysetPage(rows)
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1], field, 'next') if has_next else None,
+        prev_cursor=encode_cursor(rows[0], field, 'prev') if has_prev else None,
+    )
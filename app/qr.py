@@ -0,0 +1,36 @@
+import io
+
+import qrcode
+import qrcode.image.svg
+from django.conf import settings
+from django.utils import timezone
+
+from .lru import LRUCache
+
+QR_CONTENT_TYPES = {'svg': 'image/svg+xml', 'png': 'image/png'}
+
+_rendered = LRUCache(settings.QR_CACHE_SIZE)
+
+
+def render_qr(data, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'svg':
+        qrcode.make(data, image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qrcode.make(data, box_size=8, border=2).save(buffer)
+    return buffer.getvalue()
+
+
+def get_qr(data, fmt, expires_at):
+    """
+    Returns the encoded QR image for data, kept in-process until expires_at
+    so entries go away with the link they point to.
+    """
+    key = (data, fmt)
+    image = _rendered.get(key)
+    if image is None:
+        image = render_qr(data, fmt)
+        ttl = (expires_at - timezone.now()).total_seconds()
+        if ttl > 0:
+            _rendered.set(key, image, ttl)
+    return image
@@ -0,0 +1,126 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .deletion_log import drain_deletions
+from .models import SecureLink, ShareLink, UploadSession, UploadedFile, batched_storage_cleanup
+
+
+class Throttle:
+    """
+    Caps the long-run delete rate so a continuous reaper leaves I/O headroom
+    for request traffic. A rate of 0 disables it.
+    """
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.started = time.monotonic()
+        self.done = 0
+
+    def wait(self, count):
+        self.done += count
+        if not self.per_second:
+            return
+        ahead = self.done / self.per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _expired_batches(model, field, cutoff, batch_size):
+    # Walk the expiry index; ordering by pk alone would scan the whole table.
+    queryset = model.objects.filter(**{f'{field}__lt': cutoff}).order_by(field, 'pk')
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+
+
+def reap_links(cutoff, batch_size, throttle):
+    deleted = 0
+    for model, field in ((ShareLink, 'expires_at'), (SecureLink, 'expiry_time')):
+        for ids in _expired_batches(model, field, cutoff, batch_size):
+            count, _ = model.objects.filter(pk__in=ids).delete()
+            deleted += count
+            throttle.wait(len(ids))
+    return deleted
+
+
+def reap_files(cutoff, batch_size, pool, throttle):
+    """
+    Deletes expired files one batch per transaction. Usage counters, blob
+    references and deletion-log entries are written in bulk in the same
+    transaction; the log is then drained on the pool before the next batch.
+    """
+    deleted = 0
+    for ids in _expired_batches(UploadedFile, 'expires_at', cutoff, batch_size):
+        with transaction.atomic(), batched_storage_cleanup() as batch:
+            UploadedFile.objects.filter(pk__in=ids).delete()
+            batch.apply()
+        drain_deletions(batch_size, pool)
+        deleted += len(ids)
+        throttle.wait(len(ids))
+    return deleted
+
+
+def _last_activity(session):
+    # Every chunk is renamed into the part directory, which bumps its mtime.
+    try:
+        return max(session.created_at.timestamp(), os.path.getmtime(session.part_dir))
+    except OSError:
+        return session.created_at.timestamp()
+
+
+def reap_upload_sessions(cutoff, batch_size, throttle):
+    """
+    Deletes chunked uploads that received no chunk since cutoff, with their
+    parts. Sessions being finalized hold a row lock and are skipped.
+    """
+    deleted = 0
+    last = None
+    queryset = UploadSession.objects.filter(created_at__lt=cutoff).order_by('created_at', 'pk')
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], pk__gt=last[1]))
+        sessions = list(page[:batch_size])
+        if not sessions:
+            return deleted
+        last = (sessions[-1].created_at, sessions[-1].pk)
+        stale = [s.pk for s in sessions if _last_activity(s) < cutoff.timestamp()]
+        with transaction.atomic():
+            locked = list(UploadSession.objects.select_for_update(skip_locked=True).filter(pk__in=stale))
+            UploadSession.objects.filter(pk__in=[s.pk for s in locked]).delete()
+        for session in locked:
+            shutil.rmtree(session.part_dir, ignore_errors=True)
+        deleted += len(locked)
+        throttle.wait(len(locked))
+
+
+def reap_expired(batch_size=None, workers=None, rate=None, grace=None):
+    """
+    One pass over everything that expired more than `grace` seconds ago, and
+    over abandoned chunked uploads. Returns (links, files, uploads) deleted.
+    """
+    batch_size = batch_size or settings.REAPER_BATCH_SIZE
+    workers = workers or settings.REAPER_WORKERS
+    rate = settings.REAPER_MAX_DELETES_PER_SECOND if rate is None else rate
+    grace = settings.REAPER_GRACE_PERIOD if grace is None else grace
+
+    # Links that just expired keep answering 410 until the grace period is over.
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    throttle = Throttle(rate)
+    links = reap_links(cutoff, batch_size, throttle)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reaper') as pool:
+        files = reap_files(cutoff, batch_size, pool, throttle)
+    uploads = reap_upload_sessions(
+        timezone.now() - timedelta(seconds=settings.CHUNKED_UPLOAD_SESSION_TTL), batch_size, throttle
+    )
+    return links, files, uploads
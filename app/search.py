@@ -0,0 +1,162 @@
+import re
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Upper
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .lru import LRUCache
+from .models import UploadedFile
+
+WORD_SPLIT = re.compile(r'[\W_]+')
+
+
+def trigrams(text):
+    # Split and padded like pg_trgm so each word's start weighs in.
+    grams = set()
+    for word in WORD_SPLIT.split(text.lower()):
+        if not word:
+            continue
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NgramIndex:
+    """
+    Trigram postings for one user's file names (or every file when the user
+    is None). Used where pg_trgm is not available.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.names = {}
+        self.postings = {}
+        self._lock = threading.Lock()
+        files = UploadedFile.objects.all()
+        if user_id is not None:
+            files = files.filter(user_id=user_id)
+        for pk, name in files.values_list('pk', 'original_name').iterator():
+            self._add(pk, name)
+
+    def _add(self, pk, name):
+        self.names[pk] = name.lower()
+        for gram in trigrams(name):
+            self.postings.setdefault(gram, set()).add(pk)
+
+    def _remove(self, pk):
+        name = self.names.pop(pk, None)
+        if name is None:
+            return
+        for gram in trigrams(name):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(pk)
+                if not ids:
+                    del self.postings[gram]
+
+    def update(self, pk, name):
+        with self._lock:
+            self._remove(pk)
+            self._add(pk, name)
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def search(self, term, limit):
+        """
+        Returns up to limit ids, best first: prefix matches, then substring
+        matches, then names sharing enough trigrams to be a likely typo.
+        """
+        term = term.lower()
+        query = trigrams(term)
+        with self._lock:
+            if len(term) < 3:
+                # Too short for trigrams to narrow anything down.
+                candidates = Counter({pk: 0 for pk in self.names})
+            else:
+                candidates = Counter()
+                for gram in query:
+                    for pk in self.postings.get(gram, ()):
+                        candidates[pk] += 1
+            scored = []
+            for pk, shared in candidates.items():
+                name = self.names[pk]
+                similarity = shared / len(query) if query else 0
+                if name.startswith(term):
+                    tier = 2
+                elif term in name:
+                    tier = 1
+                elif similarity >= settings.SEARCH_SIMILARITY_THRESHOLD:
+                    tier = 0
+                else:
+                    continue
+                scored.append((tier, similarity, pk))
+        scored.sort(reverse=True)
+        return [pk for _, _, pk in scored[:limit]]
+
+
+# Bounded, so a process serving many users keeps only the recently searched
+# ones; entries expire after SEARCH_INDEX_TTL to pick up writes made by other
+# processes.
+_indexes = LRUCache(settings.SEARCH_INDEX_MAX_USERS)
+
+
+def _get_index(user_id):
+    index = _indexes.get(user_id)
+    if index is None:
+        index = NgramIndex(user_id)
+        _indexes.set(user_id, index, settings.SEARCH_INDEX_TTL)
+    return index
+
+
+def search_files(queryset, term, user=None, limit=None):
+    """
+    Narrows queryset to files whose name matches term by prefix, substring or
+    a close misspelling, best matches first. Uses the pg_trgm index on
+    Postgres and an in-process trigram index elsewhere; `user` picks which
+    index (None searches every file). The fallback keeps only the best
+    `limit` matches; slice the Postgres queryset yourself.
+    """
+    term = term.strip()
+    limit = limit or settings.SEARCH_MAX_RESULTS
+    if not term:
+        return queryset.none()
+
+    if connection.vendor == 'postgresql':
+        # UPPER(original_name) is what both lookups compare, so one GIN index serves them.
+        return (
+            queryset.alias(search_name=Upper('original_name'))
+            .filter(Q(search_name__contains=term.upper()) | Q(search_name__trigram_word_similar=term))
+            .annotate(
+                prefix=Case(When(original_name__istartswith=term, then=Value(1)), default=Value(0), output_field=IntegerField()),
+                rank=TrigramWordSimilarity(term, 'original_name'),
+            )
+            .order_by('-prefix', '-rank', '-pk')
+        )
+
+    ids = _get_index(user.pk if user is not None else None).search(term, limit)
+    order = Case(*[When(pk=pk, then=Value(pos)) for pos, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(order) if ids else queryset.none()
+
+
+@receiver(post_save, sender=UploadedFile)
+def _index_file(sender, instance, **kwargs):
+    for user_id in (instance.user_id, None):
+        index = _indexes.get(user_id)
+        if index is not None:
+            index.update(instance.pk, instance.original_name)
+
+
+@receiver(post_delete, sender=UploadedFile)
+def _unindex_file(sender, instance, **kwargs):
+    for user_id in (instance.user_id, None):
+        index = _indexes.get(user_id)
+        if index is not None:
+            index.remove(instance.pk)
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def cache_is_shared():
+    """
+    True when the default cache is seen by every worker process. Features that
+    coordinate processes through the cache (the link filter's additions log,
+    the shared link-cache tier, download slots) are only correct when it is.
+    """
+    if settings.CACHE_IS_SHARED is not None:
+        return settings.CACHE_IS_SHARED
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
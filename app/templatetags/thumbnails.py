@@ -0,0 +1,22 @@
+from django import template
+from django.urls import reverse
+
+from app.thumbnails import is_previewable, thumbnail_key
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail_url(uploaded_file, size='md'):
+    if not is_previewable(uploaded_file.original_name):
+        return ''
+    return reverse('file_thumbnail', args=[uploaded_file.pk, size])
+
+
+@register.filter
+def avatar_url(profile, size='sm'):
+    if not profile.avatar:
+        return ''
+    # A new avatar gets a new name, so the version busts the immutable cache entry.
+    version = thumbnail_key(profile.avatar.name, 0)[:12]
+    return f"{reverse('avatar_thumbnail', args=[profile.user_id, size])}?v={version}"
@@ -1,12 +1,57 @@
-from django.test import TestCase, Client, RequestFactory
+from django.test import TestCase, Client, RequestFactory, AsyncRequestFactory, override_settings
+from django.http import Http404
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.conf import settings
 from django.utils import timezone
-from .models import UploadedFile, ShareLink
+from .models import (
+    AccessLog, UploadedFile, ShareLink, SecureLink, Blob, ImportJob, UserProfile, StorageDeletion, StorageQuotaExceeded,
+    UploadSession, charge_storage, get_dedup_stats, get_user_storage_usage,
+)
+from . import analytics, bandwidth, blobs, deletion_log, link_cache, qr, search, thumbnails, variants, views_async
+from .admin_stats import refresh_dashboard_snapshot
+from .compression import SeekableReader, default_codec, write_seekable
+from .link_cache import resolve_share_link
+from .lru import LRUCache
+from .link_filter import BloomFilter, LinkFilter, link_filter
+from .deletion_log import claim_deletions, drain_deletions, process_deletions
+from .reaper import Throttle, reap_expired, reap_upload_sessions
+from .search import search_files
+from .url_import import claim_job, heartbeat, requeue_stale_jobs, run_job, run_next_job
+from .zipstream import stream_zip
 from unittest.mock import patch, MagicMock
+from concurrent.futures.process import BrokenProcessPool
+import requests
 from datetime import timedelta
 import uuid
+import hashlib
+import json
+import io
+import os
+import shutil
+import tempfile
+import gc
+import gzip
+import zipfile
+
+# Flush timers would write from another thread, outside each test's
+# transaction; DownloadAnalyticsTests turns analytics back on.
+_analytics_off = override_settings(ANALYTICS_ENABLED=False)
+
+
+def setUpModule():
+    _analytics_off.enable()
+
+
+def tearDownModule():
+    _analytics_off.disable()
+
 
 class ModelTests(TestCase):
     def setUp(self):
@@ -76,24 +121,71 @@ class ViewTests(TestCase):
         with patch('requests.get') as mock_get:
             mock_response = MagicMock()
             mock_response.status_code = 200
-            mock_response.content = b"remote content"
+            mock_response.iter_content.return_value = [b"remote ", b"content"]
             mock_response.headers = {'Content-Disposition': 'attachment; filename="remote.txt"'}
             mock_get.return_value = mock_response
 
             response = self.client.post(reverse('upload_from_url'), {'url': 'http://example.com/test.txt'})
             
             self.assertEqual(response.status_code, 302) # Redirects to file_list
-            self.assertTrue(UploadedFile.objects.filter(original_name="remote.txt").exists())
+            mock_get.assert_not_called()
+            job = run_next_job()
+
+            self.assertEqual(job.status, 'SUCCESS')
+            imported = UploadedFile.objects.get(original_name="remote.txt")
+            self.assertEqual(job.file, imported)
+            self.assertEqual(imported.size, len(b"remote content"))
+            with imported.file.open('rb') as fh:
+                self.assertEqual(fh.read(), b"remote content")
+            mock_response.close.assert_called_once()
+
+    def test_upload_from_url_rejects_content_length_over_quota(self):
+        self.user.profile.storage_limit_mb = 1
+        self.user.profile.save()
+        with patch('requests.get') as mock_get:
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            mock_response.headers = {'Content-Length': str(5 * 1024 * 1024)}
+            mock_get.return_value = mock_response
+
+            self.client.post(reverse('upload_from_url'), {'url': 'http://example.com/big.iso'})
+            job = run_next_job()
+
+            self.assertEqual(job.status, 'FAILED')
+            mock_response.iter_content.assert_not_called()
+            self.assertFalse(UploadedFile.objects.filter(original_name="big.iso").exists())
+
+    def test_upload_from_url_aborts_stream_over_quota(self):
+        self.user.profile.storage_limit_mb = 1
+        self.user.profile.save()
+        with patch('requests.get') as mock_get:
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            mock_response.headers = {}
+            mock_response.iter_content.return_value = iter([b"x" * (512 * 1024)] * 4)
+            mock_get.return_value = mock_response
+
+            self.client.post(reverse('upload_from_url'), {'url': 'http://example.com/big.iso'})
+            job = run_next_job()
+
+            self.assertEqual(job.status, 'FAILED')
+            self.assertIn('storage', job.error)
+            self.assertFalse(UploadedFile.objects.filter(original_name="big.iso").exists())
+            self.assertFalse(os.path.exists(job.partial_path or os.path.join(settings.MEDIA_ROOT, 'blobs', 'tmp', 'big.iso')))
 
     def test_upload_from_url_failure(self):
         with patch('requests.get') as mock_get:
             mock_get.side_effect = Exception("Connection error")
             
             response = self.client.post(reverse('upload_from_url'), {'url': 'http://bad-url.com'})
-            
             self.assertEqual(response.status_code, 302)
-            messages = list(response.wsgi_request._messages)
-            self.assertTrue(any("Failed to download file" in str(m) for m in messages))
+            job = run_next_job()
+
+            self.assertEqual(job.status, 'FAILED')
+            self.assertEqual(job.error, "Connection error")
+            status = self.client.get(reverse('import_job_status', args=[job.job_id])).json()
+            self.assertEqual(status['status'], 'FAILED')
+            self.assertTrue(status['finished'])
 
 class TemplateTests(TestCase):
     def setUp(self):
@@ -105,3 +197,1741 @@ class TemplateTests(TestCase):
         response = self.client.get(reverse('downloader'))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'downloader.html')
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.chunk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.chunk_dir, ignore_errors=True)
+        override = override_settings(CHUNKED_UPLOAD_DIR=self.chunk_dir, CHUNKED_UPLOAD_CHUNK_SIZE=4)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _init(self, data=b"0123456789"):
+        response = self.client.post(reverse('chunked_upload_init'), {'filename': 'big.bin', 'size': len(data)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def _put(self, upload_id, index, body):
+        return self.client.put(
+            reverse('chunked_upload_chunk', args=[upload_id, index]), body,
+            content_type='application/octet-stream'
+        )
+
+    def test_out_of_order_chunks_assemble_into_uploaded_file(self):
+        data = b"0123456789"
+        session = self._init(data)
+        self.assertEqual(session['chunk_count'], 3)
+
+        for index in (2, 0, 1):
+            response = self._put(session['upload_id'], index, data[index * 4:(index + 1) * 4])
+            self.assertEqual(response.status_code, 200)
+
+        # The hash is taken while the parts are assembled, not by reading the file back.
+        with patch('app.blobs.hash_path', side_effect=AssertionError):
+            response = self.client.post(reverse('chunked_upload_finalize', args=[session['upload_id']]))
+        self.assertEqual(response.status_code, 201)
+        uploaded = UploadedFile.objects.get(id=response.json()['file_id'])
+        self.assertEqual(uploaded.size, len(data))
+        self.assertEqual(uploaded.blob.sha256, hashlib.sha256(data).hexdigest())
+        with uploaded.file.open('rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertFalse(os.path.exists(os.path.join(self.chunk_dir, session['upload_id'])))
+
+    def test_status_reports_received_ranges_and_finalize_requires_all_chunks(self):
+        session = self._init()
+        self._put(session['upload_id'], 0, b"0123")
+        self._put(session['upload_id'], 2, b"89")
+
+        status = self.client.get(reverse('chunked_upload_status', args=[session['upload_id']])).json()
+        self.assertEqual(status['chunks'], [0, 2])
+        self.assertEqual(status['ranges'], [[0, 3], [8, 9]])
+        self.assertFalse(status['complete'])
+
+        response = self.client.post(reverse('chunked_upload_finalize', args=[session['upload_id']]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['missing'], [1])
+
+    def test_chunk_with_wrong_length_is_rejected(self):
+        session = self._init()
+        response = self._put(session['upload_id'], 1, b"45")
+        self.assertEqual(response.status_code, 400)
+
+    def test_init_rejects_upload_over_quota(self):
+        self.user.profile.storage_limit_mb = 0
+        self.user.profile.save()
+        response = self.client.post(reverse('chunked_upload_init'), {'filename': 'big.bin', 'size': 10})
+        self.assertEqual(response.status_code, 413)
+
+    def test_reaper_drops_abandoned_uploads(self):
+        abandoned = UploadSession.objects.get(upload_id=self._init()['upload_id'])
+        self._put(abandoned.upload_id, 0, b"0123")
+        active = UploadSession.objects.get(upload_id=self._init()['upload_id'])
+        old = timezone.now() - timedelta(days=2)
+        UploadSession.objects.update(created_at=old)
+        os.utime(abandoned.part_dir, (old.timestamp(), old.timestamp()))
+        self._put(active.upload_id, 0, b"0123")
+
+        self.assertEqual(reap_upload_sessions(timezone.now() - timedelta(days=1), 10, Throttle(0)), 1)
+        self.assertEqual(list(UploadSession.objects.all()), [active])
+        self.assertFalse(os.path.exists(abandoned.part_dir))
+        self.assertTrue(os.path.exists(active.part_dir))
+
+class RangeDownloadTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.data = b"0123456789abcdef"
+        self.uploaded_file = UploadedFile.objects.create(
+            user=self.user,
+            original_name="range.txt",
+            file=SimpleUploadedFile("range.txt", self.data),
+            size=len(self.data)
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        self.urls = [
+            reverse('download_file_direct', args=[self.uploaded_file.id]),
+            reverse('share_download', args=[self.link.link_id]),
+            reverse('secure_download', args=[self.link.link_id]),
+        ]
+
+    def test_full_download_advertises_validators(self):
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.data)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertTrue(response['ETag'].startswith('"'))
+            self.assertIn('Last-Modified', response)
+
+    def test_single_range(self):
+        for url in self.urls:
+            response = self.client.get(url, HTTP_RANGE='bytes=2-5')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 2-5/16')
+            self.assertEqual(response['Content-Length'], '4')
+            self.assertEqual(b"".join(response.streaming_content), b"2345")
+
+    def test_suffix_and_open_ended_ranges(self):
+        response = self.client.get(self.urls[0], HTTP_RANGE='bytes=-3')
+        self.assertEqual(b"".join(response.streaming_content), b"def")
+        response = self.client.get(self.urls[0], HTTP_RANGE='bytes=14-')
+        self.assertEqual(response['Content-Range'], 'bytes 14-15/16')
+
+    def test_multiple_ranges_use_multipart_byteranges(self):
+        response = self.client.get(self.urls[1], HTTP_RANGE='bytes=0-1,10-11')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b"Content-Range: bytes 0-1/16\r\n\r\n01", body)
+        self.assertIn(b"Content-Range: bytes 10-11/16\r\n\r\nab", body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.urls[0], HTTP_RANGE='bytes=100-200')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */16')
+
+    def test_if_range_mismatch_returns_full_body(self):
+        response = self.client.get(self.urls[0], HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(self.urls[0], HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_conditional_get_returns_not_modified(self):
+        first = self.client.get(self.urls[1])
+        response = self.client.get(self.urls[1], HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+        response = self.client.get(self.urls[2], HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+class OffloadDeliveryTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.uploaded_file = UploadedFile.objects.create(
+            user=self.user,
+            original_name="report final.pdf",
+            file=SimpleUploadedFile("report.pdf", b"%PDF-1.4"),
+            size=8
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+
+    @override_settings(FILE_DELIVERY_MODE='x-accel-redirect', FILE_DELIVERY_ACCEL_PREFIX='/protected-media/')
+    def test_x_accel_redirect_hands_off_to_proxy(self):
+        response = self.client.get(reverse('share_download', args=[self.link.link_id]), HTTP_RANGE='bytes=0-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.uploaded_file.file.name)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('attachment;', response['Content-Disposition'])
+        self.assertIn('ETag', response)
+
+    @override_settings(FILE_DELIVERY_MODE='x-sendfile')
+    def test_x_sendfile_sends_absolute_path(self):
+        response = self.client.get(reverse('download_file_direct', args=[self.uploaded_file.id]))
+        self.assertEqual(response['X-Sendfile'], self.uploaded_file.file.path)
+        self.assertEqual(response.content, b"")
+
+    @override_settings(FILE_DELIVERY_MODE='x-accel-redirect')
+    def test_expired_link_is_not_offloaded(self):
+        self.link.expires_at = timezone.now() - timedelta(hours=1)
+        self.link.save()
+        response = self.client.get(reverse('share_download', args=[self.link.link_id]))
+        self.assertEqual(response.status_code, 410)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+class ShareLinkImportTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='password')
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client = Client()
+        self.client.login(username='testuser', password='password')
+        self.source = UploadedFile.objects.create(
+            user=self.owner,
+            original_name="shared.bin",
+            file=SimpleUploadedFile("shared.bin", b"shared bytes"),
+            size=12
+        )
+        self.link = ShareLink.objects.create(file=self.source, expires_at=timezone.now() + timedelta(hours=1))
+        self.url = f"http://testserver/s/{self.link.link_id}/"
+
+    def _imported(self):
+        return UploadedFile.objects.get(user=self.user, original_name="shared.bin")
+
+    def test_import_links_to_source_blob_without_reading_it(self):
+        with patch('django.core.files.storage.FileSystemStorage.open') as storage_open:
+            response = self.client.post(reverse('upload_from_url'), {'url': self.url})
+        self.assertEqual(response.status_code, 302)
+        storage_open.assert_not_called()
+
+        imported = self._imported()
+        self.assertNotEqual(imported.file.name, self.source.file.name)
+        self.assertTrue(os.path.samefile(imported.file.path, self.source.file.path))
+        self.assertEqual(imported.size, 12)
+
+    def test_import_falls_back_to_kernel_copy(self):
+        with patch('app.fileops.os.link', side_effect=OSError), \
+                patch('app.fileops.fcntl.ioctl', side_effect=OSError):
+            self.client.post(reverse('upload_from_url'), {'url': self.url})
+        imported = self._imported()
+        self.assertFalse(os.path.samefile(imported.file.path, self.source.file.path))
+        with imported.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"shared bytes")
+
+    def test_deleting_source_keeps_imported_copy(self):
+        self.client.post(reverse('upload_from_url'), {'url': self.url})
+        self.source.file.delete()
+        with self._imported().file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"shared bytes")
+
+class BlobStoreTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+
+    def _upload(self, username, content=b"same bytes", name="doc.txt"):
+        client = Client()
+        client.login(username=username, password='password')
+        client.post(reverse('upload'), {'file': SimpleUploadedFile(name, content)})
+        return UploadedFile.objects.filter(user__username=username).latest('id')
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self._upload('alice')
+        second = self._upload('bob', name="copy.txt")
+
+        self.assertEqual(Blob.objects.count(), 1)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.sha256, hashlib.sha256(b"same bytes").hexdigest())
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.original_name, "copy.txt")
+        self.assertEqual(get_dedup_stats()['ratio'], 2.0)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1, FILE_UPLOAD_PERMISSIONS=0o644)
+    def test_disk_spooled_upload_is_moved_into_blob(self):
+        uploaded = self._upload('alice', content=b"spooled to disk")
+        self.assertEqual(uploaded.blob.sha256, hashlib.sha256(b"spooled to disk").hexdigest())
+        with uploaded.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"spooled to disk")
+        # Temp files are 0600; the front proxy must be able to read blobs.
+        self.assertEqual(os.stat(uploaded.file.path).st_mode & 0o777, 0o644)
+
+    def test_blob_is_written_before_the_charge_transaction(self):
+        outer = len(connection.atomic_blocks)
+        depths = []
+        real = blobs.store_blob_file
+        def spy(*args):
+            depths.append(len(connection.atomic_blocks))
+            return real(*args)
+        with patch('app.blobs.store_blob_file', side_effect=spy):
+            blobs.store_upload(self.alice, SimpleUploadedFile("w.txt", b"written first"))
+        self.assertEqual(depths, [outer])
+
+    def test_refused_upload_leaves_no_bytes(self):
+        UserProfile.objects.filter(user=self.alice).update(storage_limit_mb=0)
+        with self.assertRaises(StorageQuotaExceeded):
+            blobs.store_upload(self.alice, SimpleUploadedFile("q.txt", b"over quota"))
+        self.assertFalse(Blob.objects.exists())
+        name = blobs.blob_name(hashlib.sha256(b"over quota").hexdigest())
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(name))), [])
+
+    def test_bytes_removed_only_with_last_reference(self):
+        first = self._upload('alice')
+        second = self._upload('bob')
+        path = first.file.path
+
+        first.delete()
+        drain_deletions()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        second.delete()
+        drain_deletions()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_share_link_import_adds_reference(self):
+        source = self._upload('alice')
+        link = ShareLink.objects.create(file=source, expires_at=timezone.now() + timedelta(hours=1))
+        client = Client()
+        client.login(username='bob', password='password')
+        client.post(reverse('upload_from_url'), {'url': f"http://testserver/s/{link.link_id}/"})
+
+        imported = UploadedFile.objects.get(user=self.bob)
+        self.assertEqual(imported.blob_id, source.blob_id)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_backfill_moves_legacy_files_into_blobs(self):
+        legacy = [
+            UploadedFile.objects.create(user=self.alice, file=SimpleUploadedFile("a.txt", b"dup"), original_name="a.txt"),
+            UploadedFile.objects.create(user=self.bob, file=SimpleUploadedFile("b.txt", b"dup"), original_name="b.txt"),
+        ]
+        legacy_paths = [f.file.path for f in legacy]
+
+        call_command('backfill_blobs', stdout=io.StringIO())
+        self.assertEqual(StorageDeletion.objects.count(), 2)
+        drain_deletions()
+
+        blob = Blob.objects.get()
+        self.assertEqual(get_user_storage_usage(self.alice)['bytes_used'], 3)
+        self.assertEqual(blob.ref_count, 2)
+        for uploaded in UploadedFile.objects.all():
+            self.assertEqual(uploaded.blob, blob)
+            self.assertEqual(uploaded.size, 3)
+        for path in legacy_paths:
+            self.assertFalse(os.path.exists(path))
+        with blob.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"dup")
+
+class AsyncDownloadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.data = b"async streamed bytes"
+        self.uploaded_file = UploadedFile.objects.create(
+            user=self.user,
+            original_name="async.txt",
+            file=SimpleUploadedFile("async.txt", self.data),
+            size=len(self.data)
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        self.factory = AsyncRequestFactory()
+
+    async def _body(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_full_download_is_async_stream(self):
+        response = await views_async.download_now(self.factory.get('/'), self.link.link_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="async.txt"')
+        self.assertEqual(await self._body(response), self.data)
+
+    async def test_range_request(self):
+        request = self.factory.get('/', headers={'Range': 'bytes=6-13'})
+        response = await views_async.download_file(request, self.link.link_id)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(await self._body(response), b"streamed")
+
+    async def test_unknown_and_expired_links(self):
+        with self.assertRaises(Http404):
+            await views_async.download_now(self.factory.get('/'), uuid.uuid4())
+
+        self.link.expires_at = timezone.now() - timedelta(hours=1)
+        await self.link.asave()
+        response = await views_async.download_now(self.factory.get('/'), self.link.link_id)
+        self.assertEqual(response.status_code, 410)
+
+class ImportJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.job = ImportJob.objects.create(user=self.user, url='http://example.com/data.bin')
+
+    def _response(self, status, chunks, headers=None):
+        response = MagicMock()
+        response.status_code = status
+        response.headers = headers or {}
+        response.iter_content.return_value = iter(chunks)
+        return response
+
+    def _broken_stream(self, *chunks):
+        yield from chunks
+        raise requests.exceptions.ChunkedEncodingError("connection reset")
+
+    def test_transient_failure_is_retried_and_resumed_with_range(self):
+        first = self._response(200, [], {'Content-Length': '10', 'ETag': '"v1"'})
+        first.iter_content.return_value = self._broken_stream(b"01234")
+        second = self._response(206, [b"56789"], {'Content-Length': '5', 'Content-Range': 'bytes 5-9/10'})
+
+        with patch('requests.get', side_effect=[first, second]) as mock_get:
+            job = run_next_job()
+            self.assertEqual(job.status, 'QUEUED')
+            self.assertEqual(job.attempts, 1)
+            self.assertGreater(job.next_attempt_at, timezone.now())
+
+            ImportJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+            job = run_next_job()
+
+        self.assertEqual(job.status, 'SUCCESS')
+        self.assertEqual(mock_get.call_args_list[1].kwargs['headers'], {'Range': 'bytes=5-', 'If-Range': '"v1"'})
+        with job.file.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"0123456789")
+        self.assertEqual(job.file.blob.sha256, hashlib.sha256(b"0123456789").hexdigest())
+
+    def _interrupted_then(self, *responses):
+        first = self._response(200, [], {'Content-Length': '10', 'ETag': '"v1"'})
+        first.iter_content.return_value = self._broken_stream(b"01234")
+        with patch('requests.get', side_effect=[first, *responses]) as mock_get:
+            run_next_job()
+            ImportJob.objects.filter(pk=self.job.pk).update(next_attempt_at=timezone.now())
+            job = run_next_job()
+        return job, mock_get
+
+    def test_changed_source_restarts_from_zero(self):
+        # If-Range did not match, so the server sent the whole new file.
+        job, _ = self._interrupted_then(self._response(200, [b"abcdefghij"], {'Content-Length': '10', 'ETag': '"v2"'}))
+        self.assertEqual(job.status, 'SUCCESS')
+        with job.file.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"abcdefghij")
+
+    def test_wrong_content_range_is_refetched(self):
+        job, mock_get = self._interrupted_then(
+            self._response(206, [b"3456789"], {'Content-Length': '7', 'Content-Range': 'bytes 3-9/10'}),
+            self._response(200, [b"0123456789"], {'Content-Length': '10', 'ETag': '"v1"'}),
+        )
+        self.assertEqual(job.status, 'SUCCESS')
+        self.assertEqual(mock_get.call_args_list[2].kwargs['headers'], {})
+        with job.file.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"0123456789")
+
+    def _complete_then(self, *responses):
+        first = self._response(200, [], {'Content-Length': '10', 'ETag': '"v1"'})
+        first.iter_content.return_value = self._broken_stream(b"0123456789")
+        with patch('requests.get', side_effect=[first, *responses]) as mock_get:
+            run_next_job()
+            ImportJob.objects.filter(pk=self.job.pk).update(next_attempt_at=timezone.now())
+            job = run_next_job()
+        return job, mock_get
+
+    def test_fully_downloaded_partial_is_stored_on_416(self):
+        job, mock_get = self._complete_then(
+            self._response(416, [b"<html>not satisfiable</html>"], {'Content-Range': 'bytes */10', 'ETag': '"v1"'})
+        )
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(job.status, 'SUCCESS')
+        with job.file.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"0123456789")
+
+    def test_416_for_a_different_length_restarts(self):
+        job, mock_get = self._complete_then(
+            self._response(416, [], {'Content-Range': 'bytes */12', 'ETag': '"v1"'}),
+            self._response(200, [b"0123456789ab"], {'Content-Length': '12', 'ETag': '"v1"'}),
+        )
+        self.assertEqual(mock_get.call_args_list[2].kwargs['headers'], {})
+        self.assertEqual(job.status, 'SUCCESS')
+        with job.file.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b"0123456789ab")
+
+    def test_no_validator_means_no_resume(self):
+        first = self._response(200, [], {'Content-Length': '10'})
+        first.iter_content.return_value = self._broken_stream(b"01234")
+        second = self._response(200, [b"0123456789"], {'Content-Length': '10'})
+        with patch('requests.get', side_effect=[first, second]) as mock_get:
+            run_next_job()
+            ImportJob.objects.filter(pk=self.job.pk).update(next_attempt_at=timezone.now())
+            job = run_next_job()
+        self.assertEqual(mock_get.call_args_list[1].kwargs['headers'], {})
+        self.assertEqual(job.status, 'SUCCESS')
+
+    @override_settings(URL_IMPORT_STALE_AFTER=0)
+    def test_requeued_job_is_not_finished_by_old_worker(self):
+        stale = claim_job()
+        requeue_stale_jobs()
+        current = claim_job()
+        self.assertNotEqual(stale.lease, current.lease)
+
+        with patch('requests.get', return_value=self._response(200, [b"late"], {'Content-Length': '4'})):
+            run_job(stale)
+        current.refresh_from_db()
+        self.assertEqual(current.status, 'RUNNING')
+        self.assertIsNone(current.file)
+        self.assertFalse(UploadedFile.objects.filter(user=self.user).exists())
+
+    def test_heartbeat_keeps_running_job_fresh(self):
+        job = claim_job()
+        ImportJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(days=1))
+        heartbeat([job])
+        self.assertEqual(requeue_stale_jobs(), 0)
+
+    @override_settings(URL_IMPORT_MAX_ATTEMPTS=1)
+    def test_gives_up_after_max_attempts(self):
+        with patch('requests.get', side_effect=requests.ConnectionError("down")):
+            job = run_next_job()
+        self.assertEqual(job.status, 'FAILED')
+
+    def test_jobs_are_claimed_once(self):
+        self.assertEqual(claim_job().pk, self.job.pk)
+        self.assertIsNone(claim_job())
+
+class StorageUsageTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+
+    def _usage(self):
+        return get_user_storage_usage(self.user)
+
+    def test_upload_and_delete_maintain_counters(self):
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("a.txt", b"12345")})
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("b.txt", b"678")})
+        self.assertEqual(self._usage(), {'bytes_used': 8, 'file_count': 2})
+
+        uploaded = UploadedFile.objects.get(original_name="a.txt")
+        self.client.post(reverse('delete_file', args=[uploaded.id]))
+        self.assertEqual(self._usage(), {'bytes_used': 3, 'file_count': 1})
+
+    def test_upload_over_quota_is_refused(self):
+        UserProfile.objects.filter(user=self.user).update(storage_limit_mb=1, bytes_used=1024 * 1024 - 2)
+        response = self.client.post(reverse('upload'), {'file': SimpleUploadedFile("big.txt", b"12345")})
+        self.assertRedirects(response, reverse('upload'), fetch_redirect_response=False)
+        self.assertFalse(UploadedFile.objects.filter(user=self.user).exists())
+        self.assertEqual(self._usage()['bytes_used'], 1024 * 1024 - 2)
+
+    def test_charge_storage_is_conditional(self):
+        UserProfile.objects.filter(user=self.user).update(storage_limit_mb=1)
+        charge_storage(self.user, 1024 * 1024)
+        with self.assertRaises(StorageQuotaExceeded):
+            charge_storage(self.user, 1)
+        self.assertEqual(self._usage(), {'bytes_used': 1024 * 1024, 'file_count': 1})
+
+    def test_share_link_import_counts_against_importer(self):
+        owner = User.objects.create_user(username='owner', password='password')
+        source = UploadedFile.objects.create(
+            user=owner, file=SimpleUploadedFile("s.txt", b"shared"), original_name="s.txt", size=6
+        )
+        link = ShareLink.objects.create(file=source, expires_at=timezone.now() + timedelta(hours=1))
+        self.client.post(reverse('upload_from_url'), {'url': f"http://testserver/s/{link.link_id}/"})
+        self.assertEqual(self._usage(), {'bytes_used': 6, 'file_count': 1})
+
+    def test_reconcile_repairs_drift(self):
+        UploadedFile.objects.create(user=self.user, file=SimpleUploadedFile("x.txt", b"xx"), original_name="x.txt", size=2)
+        UserProfile.objects.filter(user=self.user).update(bytes_used=999, file_count=7)
+
+        call_command('reconcile_storage', stdout=io.StringIO())
+
+        self.assertEqual(self._usage(), {'bytes_used': 2, 'file_count': 1})
+
+class AdminDashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin', password='password')
+        self.client = Client()
+        self.client.login(username='admin', password='password')
+
+    def _add_users(self, count, start=0):
+        for i in range(start, start + count):
+            user = User.objects.create_user(username=f'user{i:03d}', password='password')
+            UserProfile.objects.filter(user=user).update(bytes_used=i * 1024 * 1024, file_count=i)
+
+    def test_query_count_does_not_grow_with_users(self):
+        self._add_users(3)
+        self.client.get(reverse('admin_dashboard'))
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('admin_dashboard'))
+
+        self._add_users(20, start=3)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(len(few), len(many))
+
+    @override_settings(ADMIN_USERS_PER_PAGE=5)
+    def test_users_are_paginated_and_sorted(self):
+        self._add_users(12)
+        response = self.client.get(reverse('admin_dashboard'), {'sort': '-used'})
+        usernames = [u['obj'].username for u in response.context['users']]
+        self.assertEqual(usernames, ['user011', 'user010', 'user009', 'user008', 'user007'])
+        self.assertEqual(response.context['users'][0]['file_count'], 11)
+        self.assertEqual(response.context['users_page'].paginator.num_pages, 3)
+
+        response = self.client.get(reverse('admin_dashboard'), {'sort': 'username', 'page': 3})
+        self.assertEqual([u['obj'].username for u in response.context['users']], ['user009', 'user010', 'user011'])
+
+    def test_snapshot_is_cached(self):
+        self._add_users(2)
+        response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.context['total_users'], 3)
+
+        self._add_users(1, start=5)
+        response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.context['total_users'], 3)
+
+        refresh_dashboard_snapshot()
+        response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.context['total_users'], 4)
+        self.assertEqual(response.context['user_storage_stats'][0], ('user005', 5.0))
+
+class LinkCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', password='password')
+        self.data = b"popular file"
+        self.uploaded_file = UploadedFile.objects.create(
+            user=self.user,
+            original_name="popular.txt",
+            file=SimpleUploadedFile("popular.txt", self.data),
+            size=len(self.data)
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        self.client = Client()
+
+    def test_hot_link_needs_no_queries(self):
+        self.client.get(reverse('share_page', args=[self.link.link_id]))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('share_page', args=[self.link.link_id]))
+        self.assertContains(response, 'popular.txt')
+        self.assertContains(response, 'owner')
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('share_download', args=[self.link.link_id]))
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    @override_settings(CACHE_IS_SHARED=True)
+    def test_shared_tier_survives_local_eviction(self):
+        link_filter.rebuild()
+        resolve_share_link(self.link.link_id)
+        link_cache._local.clear()
+        with self.assertNumQueries(0):
+            link = resolve_share_link(self.link.link_id)
+        self.assertEqual(link.file.original_name, 'popular.txt')
+
+    def test_process_local_cache_is_not_used_as_shared_tier(self):
+        resolve_share_link(self.link.link_id)
+        link_cache._local.clear()
+        self.assertIsNone(cache.get(link_cache._key(self.link.link_id)))
+        with self.assertNumQueries(1):
+            resolve_share_link(self.link.link_id)
+
+    def test_deleting_link_or_file_invalidates(self):
+        url = reverse('share_download', args=[self.link.link_id])
+        self.client.get(url)
+        self.link.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        url = reverse('share_download', args=[link.link_id])
+        self.client.get(url)
+        self.uploaded_file.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_expired_link_is_refused_from_cache(self):
+        url = reverse('share_download', args=[self.link.link_id])
+        self.client.get(url)
+        self.link.expires_at = timezone.now() - timedelta(minutes=1)
+        self.link.save()
+        self.assertEqual(self.client.get(url).status_code, 410)
+
+@override_settings(CACHE_IS_SHARED=True)
+class LinkFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.uploaded_file = UploadedFile.objects.create(
+            user=self.user,
+            original_name="f.txt",
+            file=SimpleUploadedFile("f.txt", b"data"),
+            size=4
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        link_filter.rebuild()
+
+    def test_unknown_token_is_rejected_without_queries(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('share_page', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse('share_page', args=[self.link.link_id])).status_code, 200)
+
+    def test_links_created_elsewhere_are_picked_up(self):
+        other = LinkFilter()
+        other.rebuild()
+        with self.captureOnCommitCallbacks() as callbacks:
+            link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        # Nothing is published before the row commits.
+        self.assertEqual(cache.get('linkfilter:gen', 0), 0)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(other.might_exist(link.link_id))
+        self.assertFalse(other.might_exist(uuid.uuid4()))
+
+        cache.clear()  # An evicted log answers "maybe" and rebuilds in the background.
+        with self.captureOnCommitCallbacks(execute=True):
+            link = ShareLink.objects.create(file=self.uploaded_file, expires_at=timezone.now() + timedelta(hours=1))
+        cache.clear()
+        with patch.object(other, '_rebuild_soon') as rebuild_soon, self.assertNumQueries(0):
+            self.assertTrue(other.might_exist(link.link_id))
+            self.assertTrue(other.might_exist(uuid.uuid4()))
+        rebuild_soon.assert_called()
+        other.rebuild()
+        self.assertTrue(other.might_exist(link.link_id))
+
+    @override_settings(CACHE_IS_SHARED=False)
+    def test_disabled_without_shared_cache(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('share_page', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_error_rate_and_stats(self):
+        bloom = BloomFilter(10000, 0.01)
+        for _ in range(10000):
+            bloom.add(uuid.uuid4().bytes)
+        false_positives = sum(uuid.uuid4().bytes in bloom for _ in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.estimated_error_rate(), 0.01, delta=0.005)
+
+        stats = link_filter.stats()
+        self.assertTrue(stats['built'])
+        self.assertGreaterEqual(stats['items'], 1)
+        self.assertEqual(stats['memory_bytes'], len(link_filter._filter.bits))
+
+class ReaperTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.past = timezone.now() - timedelta(days=2)
+
+    def _file(self, name, data, expires_at):
+        charge_storage(self.user, len(data))
+        return UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile(name, data), original_name=name,
+            size=len(data), expires_at=expires_at
+        )
+
+    def test_reaps_expired_files_and_links(self):
+        live = self._file("live.txt", b"live", timezone.now() + timedelta(days=1))
+        expired = [self._file(f"old{i}.txt", b"expired", self.past) for i in range(5)]
+        paths = [f.file.path for f in expired]
+        old_link = ShareLink.objects.create(file=live, expires_at=self.past)
+        fresh_link = ShareLink.objects.create(file=live, expires_at=timezone.now() - timedelta(minutes=1))
+
+        out = io.StringIO()
+        call_command('reap_expired', '--batch-size', '2', '--rate', '0', '--grace', '3600', stdout=out)
+
+        self.assertIn("Reaped 1 link(s) and 5 file(s).", out.getvalue())
+        self.assertEqual(list(UploadedFile.objects.all()), [live])
+        self.assertEqual(list(ShareLink.objects.all()), [fresh_link])
+        self.assertFalse(ShareLink.objects.filter(pk=old_link.pk).exists())
+        self.assertFalse(any(os.path.exists(p) for p in paths))
+        self.assertEqual(get_user_storage_usage(self.user), {'bytes_used': 4, 'file_count': 1})
+
+    def test_counters_are_released_per_user_not_per_row(self):
+        for i in range(4):
+            self._file(f"old{i}.txt", b"x", self.past)
+        with CaptureQueriesContext(connection) as queries:
+            reap_expired(batch_size=10, rate=0, grace=0)
+        profile_updates = [q for q in queries if q['sql'].startswith('UPDATE "app_userprofile"')]
+        self.assertEqual(len(profile_updates), 1)
+        self.assertEqual(get_user_storage_usage(self.user), {'bytes_used': 0, 'file_count': 0})
+
+    def test_throttle_paces_deletes(self):
+        throttle = Throttle(100)
+        with patch('app.reaper.time.sleep') as sleep:
+            throttle.wait(50)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, delta=0.1)
+
+@override_settings(FILES_PER_PAGE=3)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        now = timezone.now()
+        for i in range(8):
+            f = UploadedFile.objects.create(
+                user=self.user, file=SimpleUploadedFile(f"f{i}.txt", b"x"),
+                original_name=f"file{i % 3}.txt", size=i % 2,
+            )
+            # Shared timestamps and sizes exercise the primary-key tie-breaker.
+            UploadedFile.objects.filter(pk=f.pk).update(uploaded_at=now - timedelta(minutes=i // 2))
+
+    def _walk(self, sort):
+        ids, cursors, cursor = [], [], None
+        while True:
+            params = {'sort': sort, 'format': 'json'}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(reverse('file_list'), params).json()
+            ids.extend(f['id'] for f in data['files'])
+            cursors.append(data['prev_cursor'])
+            cursor = data['next_cursor']
+            if not cursor:
+                return ids, cursors
+
+    def test_pages_cover_every_sort_exactly_once(self):
+        expected = {
+            'date': UploadedFile.objects.order_by('-uploaded_at', '-pk'),
+            'name': UploadedFile.objects.order_by('original_name', 'pk'),
+            'size': UploadedFile.objects.order_by('-size', '-pk'),
+        }
+        for sort, queryset in expected.items():
+            ids, _ = self._walk(sort)
+            self.assertEqual(ids, list(queryset.values_list('pk', flat=True)), sort)
+
+    def test_prev_cursor_returns_previous_page(self):
+        first = self.client.get(reverse('file_list'), {'sort': 'name', 'format': 'json'}).json()
+        second = self.client.get(reverse('file_list'), {'sort': 'name', 'format': 'json', 'cursor': first['next_cursor']}).json()
+        back = self.client.get(reverse('file_list'), {'sort': 'name', 'format': 'json', 'cursor': second['prev_cursor']}).json()
+        self.assertEqual([f['id'] for f in back['files']], [f['id'] for f in first['files']])
+        self.assertIsNone(back['prev_cursor'])
+        self.assertIsNone(first['prev_cursor'])
+
+    def test_no_offset_and_bad_cursor_falls_back(self):
+        first = self.client.get(reverse('file_list'), {'format': 'json'}).json()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('file_list'), {'cursor': first['next_cursor']})
+        self.assertEqual(len(response.context['files']), 3)
+        self.assertFalse(any('OFFSET' in q['sql'] for q in queries))
+        self.assertContains(response, 'cursor=')
+
+        response = self.client.get(reverse('file_list'), {'format': 'json', 'cursor': 'garbage!'})
+        self.assertEqual(response.json()['files'], first['files'])
+
+    def test_link_list_is_paginated(self):
+        file = UploadedFile.objects.first()
+        for i in range(5):
+            ShareLink.objects.create(file=file, expires_at=timezone.now() + timedelta(hours=i))
+        response = self.client.get(reverse('link_list'))
+        self.assertEqual(len(response.context['links']), 3)
+        self.assertIsNotNone(response.context['links'].next_cursor)
+
+class SearchTests(TestCase):
+    def setUp(self):
+        search._indexes.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.other = User.objects.create_user(username='other', password='password')
+        self.client.login(username='testuser', password='password')
+        for name in ("quarterly_report.pdf", "report_draft.docx", "holiday photos.zip", "annual-report-2024.xlsx"):
+            self._file(self.user, name)
+        self._file(self.other, "report_secret.pdf")
+
+    def _file(self, user, name):
+        return UploadedFile.objects.create(user=user, file=SimpleUploadedFile(name, b"x"), original_name=name, size=1)
+
+    def _names(self, term, user=None):
+        user = user or self.user
+        return [f.original_name for f in search_files(UploadedFile.objects.filter(user=user), term, user=user)]
+
+    def test_prefix_ranks_before_substring(self):
+        names = self._names("report")
+        self.assertEqual(names[0], "report_draft.docx")
+        self.assertEqual(set(names), {"report_draft.docx", "quarterly_report.pdf", "annual-report-2024.xlsx"})
+
+    def test_typo_tolerant_and_short_terms(self):
+        self.assertIn("quarterly_report.pdf", self._names("quartrly"))
+        self.assertEqual(self._names("ho"), ["holiday photos.zip"])
+        self.assertEqual(self._names("zzzz"), [])
+
+    def test_index_follows_uploads_and_deletes(self):
+        self._names("report")
+        added = self._file(self.user, "report_final.pdf")
+        self.assertIn("report_final.pdf", self._names("report"))
+        added.delete()
+        self.assertNotIn("report_final.pdf", self._names("report"))
+
+    def test_fallback_indexes_are_bounded(self):
+        with patch.object(search, '_indexes', LRUCache(1)):
+            self._names("report")
+            self._names("report", user=self.other)
+            self.assertEqual(len(search._indexes), 1)
+            self.assertIsNotNone(search._indexes.get(self.other.pk))
+
+    def test_file_list_and_admin_use_search(self):
+        response = self.client.get(reverse('file_list'), {'search': 'quartrly', 'format': 'json'})
+        self.assertEqual([f['name'] for f in response.json()['files']], ["quarterly_report.pdf"])
+
+        admin_user = User.objects.create_superuser(username='admin', password='password')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:app_uploadedfile_changelist'), {'q': 'secrt'})
+        self.assertContains(response, "report_secret.pdf")
+        self.assertNotContains(response, "holiday photos.zip")
+
+@override_settings(FILES_PER_PAGE=5)
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on every query the hot paths issue and fails on a full scan
+    of a table that grows with usage.
+    """
+    LARGE_TABLES = (
+        'app_uploadedfile', 'app_sharelink', 'app_securelink', 'app_importjob',
+        'app_blob', 'app_userprofile', 'app_paymenttransaction', 'app_storagedeletion',
+    )
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        other = User.objects.create_user(username='other', password='password')
+        for owner in (self.user, other):
+            for i in range(20):
+                f = UploadedFile.objects.create(
+                    user=owner, file=SimpleUploadedFile(f"f{i}.txt", b"x"), original_name=f"file{i}.txt", size=i
+                )
+                ShareLink.objects.create(file=f, expires_at=timezone.now() + timedelta(hours=i - 10))
+                ImportJob.objects.create(user=owner, url=f"http://example.com/{i}")
+        self.file = f
+        self.link = ShareLink.objects.filter(file__user=self.user).first()
+        link_filter.rebuild()  # Building the filter reads every link by design.
+
+    def _full_scans(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                steps = [row[0].strip() for row in cursor.fetchall()]
+                return [s for s in steps if 'Seq Scan on' in s and any(t in s for t in self.LARGE_TABLES)]
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            steps = [row[-1] for row in cursor.fetchall()]
+            # SQLite says SEARCH for index lookups; SCAN, with or without an index, reads it all.
+            return [s for s in steps if s.startswith('SCAN ') and s.split()[1] in self.LARGE_TABLES]
+
+    def assertIndexed(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        scans = {}
+        for query in queries:
+            sql = query['sql']
+            if sql.startswith('SELECT') and any(t in sql for t in self.LARGE_TABLES):
+                found = self._full_scans(sql)
+                if found:
+                    scans[sql] = found
+        self.maxDiff = None
+        self.assertEqual(scans, {})
+
+    def test_user_views(self):
+        for sort in ('date', 'name', 'size'):
+            self.assertIndexed(lambda: self.client.get(reverse('file_list'), {'sort': sort}))
+            first = self.client.get(reverse('file_list'), {'sort': sort, 'format': 'json'}).json()
+            self.assertIndexed(lambda: self.client.get(reverse('file_list'), {'sort': sort, 'cursor': first['next_cursor']}))
+        self.assertIndexed(lambda: self.client.get(reverse('dashboard')))
+        self.assertIndexed(lambda: self.client.get(reverse('link_list')))
+        self.assertIndexed(lambda: self.client.get(reverse('file_detail', args=[self.file.id])))
+        self.assertIndexed(lambda: self.client.get(reverse('downloader')))
+
+    def test_public_and_background_paths(self):
+        self.assertIndexed(lambda: self.client.get(reverse('share_page', args=[self.link.link_id])))
+        self.assertIndexed(claim_job)
+        self.assertIndexed(lambda: reap_expired(rate=0, grace=0))
+        self.assertIndexed(lambda: self.client.post(reverse('upload'), {'file': SimpleUploadedFile("new.txt", b"fresh")}))
+
+class BulkOperationsTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.files = []
+        for i in range(6):
+            self.client.post(reverse('upload'), {'file': SimpleUploadedFile(f"f{i}.txt", f"content {i % 3}".encode())})
+        self.files = list(UploadedFile.objects.filter(user=self.user).order_by('pk'))
+        other = User.objects.create_user(username='other', password='password')
+        self.foreign = UploadedFile.objects.create(user=other, file=SimpleUploadedFile("o.txt", b"o"), original_name="o.txt", size=1)
+
+    def _post(self, name, ids, **extra):
+        return self.client.post(reverse(name), json.dumps({'ids': ids, **extra}), content_type='application/json')
+
+    def _delete_queries(self, files):
+        with CaptureQueriesContext(connection) as queries:
+            response = self._post('bulk_delete', [f.pk for f in files])
+        self.assertEqual(response.json()['deleted'], len(files))
+        return len(queries)
+
+    def test_bulk_delete_reports_items_and_releases_storage(self):
+        ShareLink.objects.create(file=self.files[0], expires_at=timezone.now() + timedelta(hours=1))
+        ids = [self.files[0].pk, self.files[3].pk, self.foreign.pk, 999999]
+        response = self._post('bulk_delete', ids)
+
+        self.assertEqual(response.json()['results'], [
+            {'id': self.files[0].pk, 'status': 'deleted'},
+            {'id': self.files[3].pk, 'status': 'deleted'},
+            {'id': self.foreign.pk, 'status': 'not_found'},
+            {'id': 999999, 'status': 'not_found'},
+        ])
+        self.assertTrue(UploadedFile.objects.filter(pk=self.foreign.pk).exists())
+        self.assertFalse(ShareLink.objects.exists())
+        self.assertEqual(get_user_storage_usage(self.user), {'bytes_used': 9 * 4, 'file_count': 4})
+        # files 0 and 3 share content, so their blob went with them and its bytes are queued.
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(StorageDeletion.objects.count(), 1)
+
+    def test_bulk_delete_query_count_is_constant(self):
+        # Every blob here keeps a reference, so both calls take the same path.
+        self.assertEqual(self._delete_queries(self.files[:1]), self._delete_queries(self.files[1:3]))
+
+    def test_bulk_create_links(self):
+        ids = [f.pk for f in self.files[:3]] + [self.foreign.pk]
+        with CaptureQueriesContext(connection) as few:
+            self._post('bulk_create_links', ids[:1])
+        with CaptureQueriesContext(connection) as many:
+            response = self._post('bulk_create_links', ids, expiry='7d')
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(response.status_code, 201)
+
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['created'] * 3 + ['not_found'])
+        link = ShareLink.objects.get(link_id=results[0]['link_id'])
+        self.assertGreater(link.expires_at, timezone.now() + timedelta(days=6))
+        self.assertEqual(self.client.get(reverse('share_page', args=[link.link_id])).status_code, 200)
+
+    def test_rejects_bad_input(self):
+        self.assertEqual(self._post('bulk_delete', []).status_code, 400)
+        self.assertEqual(self._post('bulk_delete', ['x']).status_code, 400)
+        self.assertEqual(self.client.get(reverse('bulk_delete')).status_code, 405)
+        with override_settings(BULK_MAX_ITEMS=2):
+            self.assertEqual(self._post('bulk_delete', [1, 2, 3]).status_code, 400)
+
+class DeletionLogTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("big.bin", b"payload")})
+        self.uploaded = UploadedFile.objects.get(user=self.user)
+        self.path = self.uploaded.file.path
+        self.sha256 = self.uploaded.blob.sha256
+
+    def test_delete_queues_bytes_and_worker_removes_them(self):
+        self.client.post(reverse('delete_file', args=[self.uploaded.id]))
+        self.assertFalse(UploadedFile.objects.exists())
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(StorageDeletion.objects.get().sha256, self.sha256)
+
+        call_command('drain_deletions', '--once')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(StorageDeletion.objects.exists())
+
+    def test_rolled_back_delete_queues_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.uploaded.delete()
+                raise RuntimeError
+        self.assertFalse(StorageDeletion.objects.exists())
+        drain_deletions()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_failures_are_retried_with_backoff(self):
+        self.uploaded.delete()
+        with patch('app.deletion_log.default_storage.delete', side_effect=OSError("backend down")):
+            self.assertEqual(drain_deletions(), 0)
+        entry = StorageDeletion.objects.get()
+        self.assertEqual((entry.attempts, entry.last_error), (1, "backend down"))
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+
+        self.assertEqual(drain_deletions(), 0)  # Not due yet.
+        StorageDeletion.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(drain_deletions(), 1)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_content_reuploaded_after_claim_is_kept(self):
+        self.uploaded.delete()
+        entries = claim_deletions(10)
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("again.bin", b"payload")})
+        self.assertEqual(process_deletions(entries, deletion_log._get_pool()), 1)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_reuploaded_content_is_kept(self):
+        self.uploaded.delete()
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("again.bin", b"payload")})
+        drain_deletions()
+        self.assertFalse(StorageDeletion.objects.exists())
+        self.assertTrue(os.path.exists(self.path))
+
+
+class ZipDownloadTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        for name, content in [("notes.txt", b"hello " * 1000), ("photo.jpg", b"\xff\xd8" * 500), ("notes.txt", b"second")]:
+            self.client.post(reverse('upload'), {'file': SimpleUploadedFile(name, content)})
+        self.files = list(UploadedFile.objects.filter(user=self.user).order_by('pk'))
+
+    def _archive(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_owner_download_streams_zip64_archive(self):
+        response = self.client.get(reverse('download_zip'), {'ids': [f.pk for f in self.files]})
+        archive = self._archive(response)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ["notes.txt", "photo.jpg", "notes (1).txt"])
+        self.assertEqual(archive.read("notes.txt"), b"hello " * 1000)
+        self.assertEqual(archive.getinfo("notes.txt").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo("photo.jpg").compress_type, zipfile.ZIP_STORED)
+
+    def test_stream_yields_while_reading(self):
+        big = UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile("big.bin", os.urandom(300 * 1024)), original_name="big.zip", size=300 * 1024
+        )
+        chunks = list(stream_zip([big]))
+        self.assertGreater(len(chunks), 4)
+        self.assertLessEqual(max(len(c) for c in chunks), 70 * 1024)
+
+    def test_owner_download_skips_other_users_files(self):
+        other = User.objects.create_user(username='other', password='password')
+        foreign = UploadedFile.objects.create(user=other, file=SimpleUploadedFile("o.txt", b"o"), original_name="o.txt", size=1)
+        response = self.client.post(reverse('download_zip'), json.dumps({'ids': [foreign.pk]}), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(
+            reverse('download_zip'), json.dumps({'ids': [foreign.pk, self.files[1].pk]}), content_type='application/json'
+        )
+        self.assertEqual(self._archive(response).namelist(), ["photo.jpg"])
+
+    def test_share_batch_downloads_live_links(self):
+        response = self.client.post(
+            reverse('bulk_create_links'), json.dumps({'ids': [f.pk for f in self.files[:2]]}), content_type='application/json'
+        )
+        zip_url = response.json()['zip_url']
+        self.client.logout()
+
+        self.assertEqual(self._archive(self.client.get(zip_url)).namelist(), ["notes.txt", "photo.jpg"])
+        ShareLink.objects.filter(file=self.files[0]).update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self._archive(self.client.get(zip_url)).namelist(), ["photo.jpg"])
+        ShareLink.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.client.get(zip_url).status_code, 410)
+        self.assertEqual(self.client.get(reverse('share_zip', args=[uuid.uuid4()])).status_code, 404)
+
+
+@override_settings(STORAGE_COMPRESSION=True, STORAGE_COMPRESSION_MIN_SIZE=1024, STORAGE_COMPRESSION_FRAME_SIZE=4096)
+class CompressionAtRestTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.text = b"".join(b"%06d,event,ok\n" % i for i in range(5000))
+
+    def _upload(self, name, content):
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile(name, content)})
+        return UploadedFile.objects.get(original_name=name)
+
+    def test_compressible_upload_is_stored_compressed(self):
+        uploaded = self._upload("log.csv", self.text)
+        blob = uploaded.blob
+        self.assertEqual(uploaded.encoding, default_codec())
+        self.assertEqual(blob.encoding, default_codec())
+        self.assertEqual(uploaded.size, len(self.text))
+        self.assertEqual(os.path.getsize(blob.file.path), blob.stored_size)
+        self.assertLess(blob.stored_size, len(self.text) // 2)
+        self.assertEqual(get_user_storage_usage(self.user)['bytes_used'], len(self.text))
+        self.assertGreater(get_dedup_stats()['compression_ratio'], 2)
+
+        response = self.client.get(reverse('download_file_direct', args=[uploaded.pk]))
+        self.assertEqual(response['Content-Length'], str(len(self.text)))
+        self.assertEqual(b''.join(response.streaming_content), self.text)
+
+    def test_range_requests_decode_only_the_needed_frames(self):
+        uploaded = self._upload("log.csv", self.text)
+        response = self.client.get(reverse('download_file_direct', args=[uploaded.pk]), HTTP_RANGE='bytes=10000-10099,50000-')
+        self.assertEqual(response.status_code, 206)
+        body = b''.join(response.streaming_content)
+        self.assertIn(self.text[10000:10100], body)
+        self.assertIn(self.text[50000:], body)
+
+    def test_incompressible_upload_is_stored_as_is(self):
+        content = os.urandom(32 * 1024)
+        uploaded = self._upload("noise.bin", content)
+        self.assertEqual((uploaded.encoding, uploaded.blob.stored_size), ('', len(content)))
+        with uploaded.file.open('rb') as fh:
+            self.assertEqual(fh.read(), content)
+
+    def test_reader_seeks_across_frames(self):
+        packed = io.BytesIO()
+        write_seekable(io.BytesIO(self.text), packed, default_codec(), 1000)
+        reader = SeekableReader(packed, default_codec())
+        self.assertEqual(reader.size, len(self.text))
+        for offset in (0, 999, 1000, 42424, len(self.text) - 5):
+            reader.seek(offset)
+            self.assertEqual(reader.read(2500), self.text[offset:offset + 2500][:1000 - offset % 1000])
+        reader.seek(-7, io.SEEK_END)
+        self.assertEqual(reader.readall(), self.text[-7:])
+
+
+class PrecompressedVariantTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.text = b"".join(b"%06d,event,ok\n" % i for i in range(2000))
+        self.uploaded = self._upload("log.csv", self.text)
+        self.url = reverse('download_file_direct', args=[self.uploaded.pk])
+        for name in variants.variant_names(self.uploaded.file.name):
+            self.addCleanup(default_storage.delete, name)
+            default_storage.delete(name)
+        # Build synchronously instead of on the background pool.
+        patcher = patch('app.variants.schedule_variant', side_effect=variants.build_variant)
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload(self, name, content):
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile(name, content)})
+        return UploadedFile.objects.get(original_name=name)
+
+    def test_variant_is_built_lazily_then_served(self):
+        first = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertNotIn('Content-Encoding', first)
+        self.assertIn('Accept-Encoding', first['Vary'])
+        self.assertEqual(b"".join(first.streaming_content), self.text)
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        body = b"".join(response.streaming_content)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(gzip.decompress(body), self.text)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(self.schedule.call_count, 1)
+
+        not_modified = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn('Accept-Encoding', not_modified['Vary'])
+        identity = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(identity.status_code, 200)
+        self.assertEqual(identity['ETag'], first['ETag'])
+
+    def test_ranges_and_refused_codings_get_identity(self):
+        variants.build_variant(self.uploaded.file.name, '', self.uploaded.size, 'gzip')
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.text[:10])
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_compressed_types_and_poor_ratios_are_skipped(self):
+        photo = self._upload("photo.jpg", b"\xff\xd8" + os.urandom(4096))
+        response = self.client.get(reverse('download_file_direct', args=[photo.pk]), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Accept-Encoding', response.get('Vary', ''))
+        self.schedule.assert_not_called()
+
+        noise = self._upload("noise.bin", os.urandom(8192))
+        noise_url = reverse('download_file_direct', args=[noise.pk])
+        for _ in range(2):
+            response = self.client.get(noise_url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(self.schedule.call_count, 1)
+
+    def test_choose_coding(self):
+        self.assertEqual(variants.choose_coding('br;q=1.0, gzip;q=0.5'), 'gzip')
+        self.assertEqual(variants.choose_coding('*'), 'gzip')
+        self.assertIsNone(variants.choose_coding('gzip;q=0'))
+        self.assertIsNone(variants.choose_coding('identity, gzip;q=0.5'))
+        self.assertIsNone(variants.choose_coding(''))
+
+    def test_variant_counts_towards_stored_size(self):
+        size = variants.build_variant(self.uploaded.file.name, '', self.uploaded.size, 'gzip')
+        self.assertEqual(Blob.objects.get(pk=self.uploaded.blob_id).stored_size, self.uploaded.size + size)
+        # A second build of the same variant neither replaces it nor counts it again.
+        variants.build_variant(self.uploaded.file.name, '', self.uploaded.size, 'gzip')
+        self.assertEqual(Blob.objects.get(pk=self.uploaded.blob_id).stored_size, self.uploaded.size + size)
+
+    def test_variant_of_dropped_blob_is_not_kept(self):
+        name = self.uploaded.file.name
+        self.uploaded.delete()
+        drain_deletions()
+        with open(default_storage.path(name), 'wb') as fh:
+            fh.write(self.text)  # Bytes still readable when the build started.
+        self.addCleanup(default_storage.delete, name)
+        self.assertIsNone(variants.build_variant(name, '', len(self.text), 'gzip'))
+        self.assertFalse(default_storage.exists(variants.variant_name(name, 'gzip')))
+
+    @override_settings(PRECOMPRESS_MAX_SIZE=1024)
+    def test_large_files_are_not_negotiated(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Accept-Encoding', response.get('Vary', ''))
+        self.schedule.assert_not_called()
+
+    def test_variant_removed_with_blob(self):
+        variants.build_variant(self.uploaded.file.name, '', self.uploaded.size, 'gzip')
+        path = default_storage.path(variants.variant_name(self.uploaded.file.name, 'gzip'))
+        self.assertTrue(os.path.exists(path))
+        self.uploaded.delete()
+        drain_deletions()
+        self.assertFalse(os.path.exists(path))
+
+
+def _png_bytes(size=(800, 600), color=(200, 30, 90)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overrides = override_settings(THUMBNAIL_CACHE_DIR=cache_dir, THUMBNAIL_WORKERS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("photo.png", _png_bytes())})
+        self.photo = UploadedFile.objects.get(original_name="photo.png")
+        self.url = reverse('file_thumbnail', args=[self.photo.pk, 'md'])
+
+    def _image(self, response):
+        from PIL import Image
+        return Image.open(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_thumbnail_is_rendered_once_and_cached(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(self._image(response).size, (256, 192))
+
+        with patch('app.thumbnails.render_thumbnail') as render:
+            again = self.client.get(self.url)
+            self.assertEqual(again.status_code, 200)
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        render.assert_not_called()
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_listing_and_detail_link_previews(self):
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("notes.txt", b"text")})
+        notes = UploadedFile.objects.get(original_name="notes.txt")
+        self.assertContains(self.client.get(reverse('file_detail', args=[self.photo.pk])), self.url)
+        self.assertContains(self.client.get(reverse('file_list')), reverse('file_thumbnail', args=[self.photo.pk, 'sm']))
+        self.assertEqual(self.client.get(reverse('file_thumbnail', args=[notes.pk, 'md'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('file_thumbnail', args=[self.photo.pk, 'huge'])).status_code, 404)
+
+        User.objects.create_user(username='other', password='password')
+        self.client.login(username='other', password='password')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_unreadable_image_is_not_retried(self):
+        self.client.post(reverse('upload'), {'file': SimpleUploadedFile("broken.png", b"not really a png")})
+        broken = UploadedFile.objects.get(original_name="broken.png")
+        url = reverse('file_thumbnail', args=[broken.pk, 'sm'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with patch('app.thumbnails.render_thumbnail') as render:
+            self.assertEqual(self.client.get(url).status_code, 404)
+        render.assert_not_called()
+
+    def test_concurrent_requests_share_one_render(self):
+        import threading
+        import time
+        real_render = thumbnails.render_thumbnail
+        calls = []
+
+        def slow_render(*args):
+            calls.append(args)
+            time.sleep(0.2)
+            return real_render(*args)
+
+        with patch('app.thumbnails.render_thumbnail', side_effect=slow_render):
+            threads = [
+                threading.Thread(target=thumbnails.get_thumbnail, args=(self.photo.file.name, '', 'lg'))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_eviction_drops_least_recently_used(self):
+        paths = []
+        for index, size in enumerate(('sm', 'md', 'lg')):
+            path, _ = thumbnails.get_thumbnail(self.photo.file.name, '', size)
+            os.utime(path, (1000 + index, 1000 + index))
+            paths.append(path)
+        budget = int(os.path.getsize(paths[2]) / 0.9) + 1
+        self.assertEqual(thumbnails.evict(budget), 2)
+        self.assertEqual([p.exists() for p in paths], [False, False, True])
+
+    def test_avatar_is_served_resized_and_versioned(self):
+        profile = self.user.profile
+        profile.avatar = SimpleUploadedFile("me.png", _png_bytes((2000, 2000)))
+        profile.save()
+        page = self.client.get(reverse('profile'))
+        self.assertNotContains(page, profile.avatar.url)
+        self.assertContains(page, reverse('avatar_thumbnail', args=[self.user.pk, 'sm']) + '?v=')
+
+        self.client.logout()
+        response = self.client.get(reverse('avatar_thumbnail', args=[self.user.pk, 'md']))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self._image(response).size, (256, 256))
+
+    @override_settings(THUMBNAIL_WORKERS=1)
+    def test_renders_in_worker_process(self):
+        path, _ = thumbnails.get_thumbnail(self.photo.file.name, '', 'sm')
+        self.assertTrue(path.exists())
+
+    @override_settings(THUMBNAIL_WORKERS=1)
+    def test_broken_worker_pool_is_replaced(self):
+        broken = MagicMock()
+        broken.submit.side_effect = BrokenProcessPool("worker died")
+        with patch.object(thumbnails, '_pool', broken):
+            path, _ = thumbnails.get_thumbnail(self.photo.file.name, '', 'sm')
+        self.assertTrue(path.exists())
+        broken.shutdown.assert_called_once_with(wait=False)
+
+        with patch.object(thumbnails, '_render_in_pool', side_effect=BrokenProcessPool("worker died")):
+            response = self.client.get(reverse('file_thumbnail', args=[self.photo.pk, 'md']))
+        self.assertEqual(response.status_code, 404)
+
+
+class QrCodeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        qr._rendered.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.uploaded = UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile("qr.txt", b"qr"), original_name="qr.txt", size=2
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded, expires_at=timezone.now() + timedelta(hours=1))
+
+    def test_link_creation_writes_no_image(self):
+        response = self.client.post(reverse('generate_secure_link', args=[self.uploaded.pk]), {'expiry': '1h'})
+        link = ShareLink.objects.latest('id')
+        self.assertContains(response, reverse('share_qr', args=[link.link_id, 'svg']))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'qr')))
+
+    def test_qr_is_rendered_once_and_cached_until_expiry(self):
+        url = reverse('share_qr', args=[self.link.link_id, 'svg'])
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+        max_age = int(response['Cache-Control'].split('max-age=')[1].split(',')[0])
+        self.assertTrue(0 < max_age <= 3600)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        with patch('app.qr.render_qr') as render:
+            self.assertEqual(self.client.get(url).content, response.content)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        render.assert_not_called()
+
+        png = self.client.get(reverse('share_qr', args=[self.link.link_id, 'png']))
+        self.assertTrue(png.content.startswith(b'\x89PNG'))
+
+    def test_unknown_expired_and_bad_format(self):
+        self.assertEqual(self.client.get(reverse('share_qr', args=[uuid.uuid4(), 'svg'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('share_qr', args=[self.link.link_id, 'gif'])).status_code, 404)
+        self.link.expires_at = timezone.now() - timedelta(minutes=1)
+        self.link.save()
+        self.assertEqual(self.client.get(reverse('share_qr', args=[self.link.link_id, 'svg'])).status_code, 410)
+
+    def test_secure_link_qr(self):
+        secure = SecureLink.objects.create(file=self.uploaded, expiry_time=timezone.now() + timedelta(hours=1))
+        response = self.client.get(reverse('secure_link_qr', args=[secure.token, 'png']))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        secure.is_active = False
+        secure.save()
+        self.assertEqual(self.client.get(reverse('secure_link_qr', args=[secure.token, 'svg'])).status_code, 404)
+
+
+class BandwidthLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.uploaded = UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile("limited.txt", b"x" * 4096), original_name="limited.txt", size=4096
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded, expires_at=timezone.now() + timedelta(hours=1))
+        self.url = reverse('share_download', args=[self.link.link_id])
+
+    def _limits(self, **overrides):
+        tier = {'link_rate': 0, 'link_concurrency': 1, 'owner_rate': 0, 'owner_concurrency': 0}
+        tier.update(overrides)
+        return {0: tier}
+
+    def test_full_link_answers_429_until_a_download_finishes(self):
+        with override_settings(DOWNLOAD_PLAN_LIMITS=self._limits()):
+            first = self.client.get(self.url)
+            self.assertEqual(first.status_code, 200)
+            busy = self.client.get(self.url)
+            self.assertEqual(busy.status_code, 429)
+            self.assertEqual(busy['Retry-After'], str(settings.DOWNLOAD_RETRY_AFTER))
+
+            self.assertEqual(b"".join(first.streaming_content), b"x" * 4096)
+            second = self.client.get(self.url)
+            self.assertEqual(second.status_code, 200)
+            b"".join(second.streaming_content)
+
+    def test_shaping_can_be_disabled(self):
+        with override_settings(DOWNLOAD_PLAN_LIMITS=self._limits(), DOWNLOAD_SHAPING_ENABLED=False):
+            first = self.client.get(self.url)
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+            b"".join(first.streaming_content)
+
+    def test_limits_follow_the_owner_plan(self):
+        tiers = settings.DOWNLOAD_PLAN_LIMITS
+        self.assertEqual(bandwidth.plan_download_limits(1024), tiers[0])
+        self.assertEqual(bandwidth.plan_download_limits(1024 + 5120), tiers[5120])
+        self.assertEqual(bandwidth.owner_download_limits(self.user), tiers[0])
+
+        self.user.profile.storage_limit_mb = 1024 + 51200
+        self.user.profile.save()
+        link = resolve_share_link(self.link.link_id)
+        with self.assertNumQueries(0):
+            scopes = bandwidth.share_link_scopes(RequestFactory().get('/'), link)
+        self.assertEqual(scopes[0].rate, tiers[51200]['link_rate'])
+        self.assertEqual(scopes[1].concurrency, tiers[51200]['owner_concurrency'])
+
+    def test_rate_is_shared_between_active_downloads(self):
+        scope = bandwidth.Scope('link:test', 1024 * 1024, 2)
+        first = bandwidth.acquire([scope])
+        first.refresh()
+        self.assertEqual(first.buckets['link:test'].rate, 1024 * 1024)
+        second = bandwidth.acquire([scope])
+        first.refresh()
+        self.assertEqual(first.buckets['link:test'].rate, 512 * 1024)
+        with self.assertRaises(bandwidth.DownloadsBusy):
+            bandwidth.acquire([scope])
+
+        # The burst allowance goes out at once, the rest at the shared rate.
+        self.assertEqual(first.delay(512 * 1024), 0)
+        self.assertAlmostEqual(first.delay(256 * 1024), 0.5, places=1)
+        second.release()
+        first.refresh()
+        self.assertEqual(first.buckets['link:test'].rate, 1024 * 1024)
+        bandwidth.acquire([scope]).release()
+        first.release()
+
+    def test_unlimited_concurrency_still_shares_the_rate(self):
+        scope = bandwidth.Scope('user:test', 1024 * 1024, 0)
+        first = bandwidth.acquire([scope])
+        second = bandwidth.acquire([scope])
+        for lease in (first, second):
+            lease.refresh()
+            self.assertEqual(lease.buckets['user:test'].rate, 512 * 1024)
+        self.assertFalse(first.refresh_due())
+        second.release()
+        first.refresh()
+        self.assertEqual(first.buckets['user:test'].rate, 1024 * 1024)
+        first.release()
+
+    def test_client_ip_comes_from_trusted_proxy(self):
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.7')
+        with override_settings(TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(bandwidth.client_ip(request), '203.0.113.7')
+            self.assertEqual(bandwidth.client_ip(factory.get('/', REMOTE_ADDR='10.0.0.1')), '10.0.0.1')
+        with override_settings(TRUSTED_PROXY_COUNT=2):
+            self.assertEqual(bandwidth.client_ip(request), '6.6.6.6')
+        with override_settings(TRUSTED_PROXY_COUNT=0):
+            self.assertEqual(bandwidth.client_ip(request), '10.0.0.1')
+
+    @override_settings(FILE_DELIVERY_MODE='x-accel-redirect')
+    def test_offloaded_download_carries_its_rate(self):
+        limits = self._limits(link_rate=300 * 1024, owner_rate=100 * 1024)
+        with override_settings(DOWNLOAD_PLAN_LIMITS=limits):
+            response = self.client.get(self.url)
+            self.assertEqual(response['X-Accel-Limit-Rate'], str(100 * 1024))
+            # nginx sends the bytes after the view returns, so the slot stays taken until it expires.
+            self.assertEqual(self.client.get(self.url).status_code, 429)
+
+        limits[0]['link_concurrency'] = 2
+        with override_settings(DOWNLOAD_PLAN_LIMITS=limits):
+            response = self.client.get(self.url)
+        # The owner's downloads are unlimited in number but split its rate.
+        self.assertEqual(response['X-Accel-Limit-Rate'], str(50 * 1024))
+
+    def test_zip_download_is_limited(self):
+        batch_id = uuid.uuid4()
+        ShareLink.objects.filter(pk=self.link.pk).update(batch_id=batch_id)
+        url = reverse('share_zip', args=[batch_id])
+        with override_settings(DOWNLOAD_PLAN_LIMITS=self._limits()):
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(self.client.get(url).status_code, 429)
+            b"".join(first.streaming_content)
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    async def test_async_download_is_limited(self):
+        factory = AsyncRequestFactory()
+        with override_settings(DOWNLOAD_PLAN_LIMITS=self._limits()):
+            response = await views_async.download_now(factory.get('/'), self.link.link_id)
+            busy = await views_async.download_now(factory.get('/'), self.link.link_id)
+            self.assertEqual(busy.status_code, 429)
+            body = b"".join([chunk async for chunk in response.streaming_content])
+            self.assertEqual(body, b"x" * 4096)
+            again = await views_async.download_now(factory.get('/'), self.link.link_id)
+            self.assertEqual(again.status_code, 200)
+            async for _ in again.streaming_content:
+                pass
+
+
+@override_settings(ANALYTICS_ENABLED=True)
+class DownloadAnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        analytics._take()
+        patcher = patch('app.analytics._schedule_flush')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='password')
+        self.client.login(username='testuser', password='password')
+        self.data = b"a" * 3000
+        self.uploaded = UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile("stats.txt", self.data), original_name="stats.txt", size=3000
+        )
+        self.link = ShareLink.objects.create(file=self.uploaded, expires_at=timezone.now() + timedelta(hours=1))
+        self.other = ShareLink.objects.create(file=self.uploaded, expires_at=timezone.now() + timedelta(hours=1))
+
+    def _download(self, link, **extra):
+        response = Client().get(reverse('share_download', args=[link.link_id]), **extra)
+        return b"".join(response.streaming_content) if response.streaming else response.content
+
+    def test_hits_are_buffered_then_written_in_one_batch(self):
+        resolve_share_link(self.link.link_id)
+        resolve_share_link(self.other.link_id)
+        with self.assertNumQueries(0):
+            self._download(self.link)
+            self._download(self.link)
+            self._download(self.other, HTTP_RANGE='bytes=1000-')
+        self.assertTrue(self.schedule.called)
+        self.assertEqual(AccessLog.objects.count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(analytics.flush(), 3)
+        writes = [q['sql'] for q in queries if q['sql'].startswith(('UPDATE', 'INSERT'))]
+        self.assertEqual(len(writes), 3)
+
+        self.link.refresh_from_db()
+        self.other.refresh_from_db()
+        self.uploaded.refresh_from_db()
+        self.assertEqual((self.link.download_count, self.link.bytes_served), (2, 6000))
+        # A resumed range is traffic but not another download.
+        self.assertEqual((self.other.download_count, self.other.bytes_served), (0, 2000))
+        self.assertEqual((self.uploaded.download_count, self.uploaded.bytes_served), (2, 8000))
+        self.assertIsNotNone(self.uploaded.last_accessed_at)
+        self.assertEqual(
+            sorted(AccessLog.objects.values_list('status', flat=True)), [200, 200, 206]
+        )
+        self.assertEqual(analytics.flush(), 0)
+
+    def test_head_and_not_modified_are_not_downloads(self):
+        url = reverse('share_download', args=[self.link.link_id])
+        etag = Client().head(url)['ETag']
+        response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        analytics.flush()
+        self.link.refresh_from_db()
+        self.assertEqual((self.link.download_count, self.link.bytes_served), (0, 0))
+        self.assertEqual(sorted(AccessLog.objects.values_list('status', flat=True)), [200, 304])
+
+    def test_last_access_never_moves_back(self):
+        later = timezone.now() + timedelta(hours=1)
+        ShareLink.objects.filter(pk=self.link.pk).update(last_accessed_at=later)
+        self._download(self.link)
+        self._download(self.other)
+        analytics.flush()
+        self.link.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.link.last_accessed_at, later)
+        self.assertIsNotNone(self.other.last_accessed_at)
+
+    def test_abandoned_download_records_bytes_sent(self):
+        big = UploadedFile.objects.create(
+            user=self.user, file=SimpleUploadedFile("big.bin", b"b" * 200000), original_name="big.bin", size=200000
+        )
+        self.link = ShareLink.objects.create(file=big, expires_at=timezone.now() + timedelta(hours=1))
+        response = Client().get(reverse('share_download', args=[self.link.link_id]))
+        next(iter(response.streaming_content))
+        del response
+        gc.collect()
+        analytics.flush()
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.download_count, 1)
+        self.assertTrue(0 < self.link.bytes_served < 200000)
+
+    def test_deleted_link_keeps_file_counts(self):
+        self._download(self.other)
+        self.other.delete()
+        analytics.flush()
+        self.uploaded.refresh_from_db()
+        self.assertEqual(self.uploaded.download_count, 1)
+        self.assertIsNone(AccessLog.objects.get().link_id)
+
+    def test_failed_flush_keeps_the_buffer(self):
+        self._download(self.link)
+        with patch('app.analytics.AccessLog.objects.bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                analytics.flush()
+        self.assertEqual(analytics.flush(), 1)
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.download_count, 1)
+
+    @override_settings(ANALYTICS_FLUSH_SIZE=2)
+    def test_counter_updates_are_sliced(self):
+        for link in (self.link, self.other, self.link):
+            self._download(link)
+        extra = ShareLink.objects.create(file=self.uploaded, expires_at=timezone.now() + timedelta(hours=1))
+        self._download(extra)
+        with CaptureQueriesContext(connection) as queries:
+            analytics.flush()
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "app_sharelink"')]
+        self.assertEqual(len(updates), 2)
+        self.link.refresh_from_db()
+        extra.refresh_from_db()
+        self.assertEqual((self.link.download_count, extra.download_count), (2, 1))
+
+    def test_zip_download_is_counted_per_file(self):
+        batch_id = uuid.uuid4()
+        ShareLink.objects.filter(pk__in=[self.link.pk, self.other.pk]).update(batch_id=batch_id)
+        response = Client().get(reverse('share_zip', args=[batch_id]))
+        sent = len(b"".join(response.streaming_content))
+        del response
+        analytics.flush()
+        self.link.refresh_from_db()
+        self.uploaded.refresh_from_db()
+        self.assertEqual(self.link.download_count, 1)
+        self.assertEqual(self.uploaded.download_count, 2)
+        self.assertAlmostEqual(self.uploaded.bytes_served, sent, delta=1)
+
+    def test_disabled_analytics_schedules_nothing(self):
+        with override_settings(ANALYTICS_ENABLED=False):
+            self._download(self.link)
+        self.schedule.assert_not_called()
+        self.assertEqual(analytics.flush(), 0)
+
+    def test_counts_shown_to_owner(self):
+        self._download(self.link)
+        analytics.flush()
+        response = self.client.get(reverse('file_detail', args=[self.uploaded.pk]))
+        self.assertContains(response, '2.9\xa0KB')
+        response = self.client.get(reverse('link_list'))
+        self.assertContains(response, '1 download ')
@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .compression import SeekableReader
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels for each size a URL may ask for.
+THUMBNAIL_SIZES = {'sm': 64, 'md': 256, 'lg': 512}
+PREVIEW_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_CONTENT_TYPE = 'image/webp'
+FAILURE_TTL = 60 * 60
+TOUCH_INTERVAL = 60 * 60
+
+_pool = None
+_pool_lock = threading.Lock()
+_inflight = {}
+_evicting = threading.Event()
+_last_eviction = 0.0
+
+
+class ThumbnailUnavailable(Exception):
+    pass
+
+
+def is_previewable(name):
+    return os.path.splitext(name or '')[1].lower() in PREVIEW_EXTENSIONS
+
+
+def thumbnail_key(source_name, size):
+    return hashlib.sha1(f"{source_name}:{size}".encode()).hexdigest()
+
+
+def thumbnail_path(key):
+    return Path(settings.THUMBNAIL_CACHE_DIR) / key[:2] / key[2:4] / f"{key}.webp"
+
+
+def render_thumbnail(source_path, encoding, target_path, size):
+    """
+    Writes a thumbnail of the image at source_path fitting size x size.
+    Runs in the worker processes, so it only takes plain arguments.
+    """
+    raw = open(source_path, 'rb')
+    source = SeekableReader(raw, encoding) if encoding else raw
+    with source, Image.open(source) as image:
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, THUMBNAIL_FORMAT, quality=80, method=4)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return os.path.getsize(target_path)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking a threaded web process copies locks other threads hold
+            # (logging, database drivers) into the child, where nothing will
+            # ever release them; spawned workers start clean.
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _render_in_pool(*args):
+    """
+    Runs render_thumbnail on the worker pool. A worker that dies (killed for
+    memory, or crashed by a malformed image) breaks the whole pool, so it is
+    replaced and the render tried once more before giving up on this image.
+    """
+    for attempt in range(2):
+        pool = _get_pool()
+        try:
+            return pool.submit(render_thumbnail, *args).result()
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            if attempt:
+                raise
+
+
+def _generate(key, source_name, encoding, size):
+    """
+    Renders the thumbnail once however many requests ask for it at the same
+    time: the first starts the job and the rest wait on its future.
+    """
+    with _pool_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if owner:
+        try:
+            args = (default_storage.path(source_name), encoding, str(thumbnail_path(key)), size)
+            if settings.THUMBNAIL_WORKERS:
+                future.set_result(_render_in_pool(*args))
+            else:
+                future.set_result(render_thumbnail(*args))
+        except BaseException as exc:
+            future.set_exception(exc)
+        finally:
+            with _pool_lock:
+                _inflight.pop(key, None)
+        _maybe_evict()
+    return future.result()
+
+
+def get_thumbnail(source_name, encoding, size_name):
+    """
+    Returns (path, key) of the cached thumbnail for a stored image, rendering
+    it on first use. Raises ThumbnailUnavailable for unknown sizes, for
+    sources Pillow cannot read and for sources that keep killing the worker.
+    """
+    size = THUMBNAIL_SIZES.get(size_name)
+    if size is None:
+        raise ThumbnailUnavailable(size_name)
+    key = thumbnail_key(source_name, size)
+    path = thumbnail_path(key)
+    try:
+        mtime = path.stat().st_mtime
+    except FileNotFoundError:
+        if cache.get(f"thumbfail:{key}"):
+            raise ThumbnailUnavailable(source_name)
+        try:
+            _generate(key, source_name, encoding, size)
+        except (OSError, ValueError, Image.DecompressionBombError, BrokenProcessPool) as exc:
+            logger.info("No thumbnail for %s: %s", source_name, exc)
+            cache.set(f"thumbfail:{key}", True, FAILURE_TTL)
+            raise ThumbnailUnavailable(source_name) from exc
+    else:
+        # mtime is the recency eviction goes by; refreshed at most hourly.
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(path)
+    return path, key
+
+
+def evict(max_bytes=None):
+    """
+    Removes least recently used thumbnails until the cache fits in
+    max_bytes (THUMBNAIL_CACHE_MAX_BYTES by default), leaving headroom so
+    it does not run again at once. Returns the number removed.
+    """
+    max_bytes = settings.THUMBNAIL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    for root, _, names in os.walk(settings.THUMBNAIL_CACHE_DIR):
+        for name in names:
+            if not name.endswith('.webp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+            total += stat.st_size
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    target = max_bytes * 0.9
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def _evict_in_background():
+    try:
+        evict()
+    except Exception:
+        logger.exception("Thumbnail cache eviction failed")
+    finally:
+        _evicting.clear()
+
+
+def _maybe_evict():
+    global _last_eviction
+    now = time.monotonic()
+    if now - _last_eviction < settings.THUMBNAIL_EVICT_INTERVAL or _evicting.is_set():
+        return
+    _last_eviction = now
+    _evicting.set()
+    threading.Thread(target=_evict_in_background, daemon=True).start()
@@ -0,0 +1,303 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .blobs import reserve_temp, store_path
+from .models import ImportJob, StorageQuotaExceeded, get_user_storage_limit, get_user_storage_used
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 256 * 1024
+PROGRESS_INTERVAL = 1.0  # seconds between progress writes
+
+TRANSIENT_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def filename_from_response(response, parsed_url):
+    filename = None
+    if 'Content-Disposition' in response.headers:
+        fname_match = re.findall('filename="?([^"]+)"?', response.headers['Content-Disposition'])
+        if fname_match:
+            filename = os.path.basename(fname_match[0])
+
+    if not filename:
+        filename = os.path.basename(parsed_url.path)
+
+    return filename or 'downloaded_file'
+
+
+class LeaseLost(Exception):
+    """The job was requeued and claimed again; this worker must stop touching it."""
+
+
+def enqueue_import(user, url):
+    return ImportJob.objects.create(user=user, url=url)
+
+
+def claim_job():
+    """
+    Atomically moves the oldest due QUEUED job to RUNNING. The conditional
+    UPDATE means two workers can never claim the same job.
+    """
+    now = timezone.now()
+    candidates = ImportJob.objects.filter(status='QUEUED', next_attempt_at__lte=now).order_by('created_at')
+    for job in candidates[:10]:
+        claimed = ImportJob.objects.filter(pk=job.pk, status='QUEUED').update(
+            status='RUNNING', attempts=F('attempts') + 1, updated_at=now, lease=uuid.uuid4()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def requeue_stale_jobs():
+    # Workers heartbeat their RUNNING jobs, so only a dead worker's go quiet.
+    # Dropping the lease stops that worker writing if it was merely stuck.
+    cutoff = timezone.now() - timedelta(seconds=settings.URL_IMPORT_STALE_AFTER)
+    return ImportJob.objects.filter(status='RUNNING', updated_at__lt=cutoff).update(status='QUEUED', lease=None)
+
+
+def heartbeat(jobs):
+    if jobs:
+        ImportJob.objects.filter(status='RUNNING', lease__in=[job.lease for job in jobs]).update(
+            updated_at=timezone.now()
+        )
+
+
+def _is_transient(exc):
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return False
+
+
+def _remove_partial(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def _finish(job, **fields):
+    fields['updated_at'] = timezone.now()
+    if not ImportJob.objects.filter(pk=job.pk, lease=job.lease).update(**fields):
+        raise LeaseLost(job.job_id)
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def _validator(response):
+    # If-Range needs a strong validator; a weak ETag would never match.
+    etag = response.headers.get('ETag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified', '')
+
+
+def _range_start(response):
+    match = re.match(r'bytes (\d+)-\d+/(?:\d+|\*)$', response.headers.get('Content-Range', '').strip())
+    return int(match.group(1)) if match else None
+
+
+def _complete_length(response):
+    # A 416 answer names the full length as "bytes */<length>".
+    match = re.match(r'bytes \*/(\d+)$', response.headers.get('Content-Range', '').strip())
+    return int(match.group(1)) if match else None
+
+
+def _already_complete(job, response, offset):
+    """
+    Whether a 416 to our resume means the partial file is the whole file:
+    the server's length matches it and what we expected, and the server's
+    validator, if it sent one, is still the one the bytes came with.
+    """
+    validator = _validator(response)
+    return (
+        _complete_length(response) == offset
+        and job.total_bytes in (None, offset)
+        and (not validator or validator == job.source_validator)
+    )
+
+
+def _open(job):
+    """
+    Requests the rest of the partial download, or the whole file when there
+    is nothing safe to resume. Returns (response, offset); response is None
+    when the partial file already holds everything.
+    """
+    offset = 0
+    if job.partial_path and job.source_validator and os.path.exists(job.partial_path):
+        offset = os.path.getsize(job.partial_path)
+    headers = {'Range': f'bytes={offset}-', 'If-Range': job.source_validator} if offset else {}
+
+    response = requests.get(job.url, stream=True, timeout=30, headers=headers)
+    if offset and response.status_code == 416:
+        # Nothing past the end: usually an attempt that died just before storing.
+        response.close()
+        if _already_complete(job, response, offset):
+            return None, offset
+        response = requests.get(job.url, stream=True, timeout=30, headers={})
+    response.raise_for_status()
+    if offset and response.status_code == 206 and _range_start(response) != offset:
+        # Not the range we asked for; splicing it in would corrupt the file.
+        response.close()
+        response = requests.get(job.url, stream=True, timeout=30, headers={})
+        response.raise_for_status()
+    if response.status_code != 206:
+        offset = 0  # Range ignored, or If-Range saw the file change: start over.
+    return response, offset
+
+
+def _download(job):
+    response, offset = _open(job)
+    try:
+        if not job.filename:
+            job.filename = filename_from_response(response, urlparse(job.url))
+        stale_partial = ''
+        if not offset:
+            # A fresh file each time, so a stalled earlier attempt that still
+            # holds the old one open cannot write into this download.
+            stale_partial = job.partial_path
+            job.source_validator = _validator(response)
+            job.partial_path, fd = reserve_temp(job.filename)
+            os.close(fd)
+
+        if response is None:
+            total = offset
+        else:
+            content_length = response.headers.get('Content-Length')
+            total = offset + int(content_length) if content_length and content_length.isdigit() else None
+        try:
+            _finish(
+                job, filename=job.filename, partial_path=job.partial_path, total_bytes=total, bytes_done=offset,
+                source_validator=job.source_validator,
+            )
+        except LeaseLost:
+            if not offset:
+                _remove_partial(job.partial_path)
+            raise
+        _remove_partial(stale_partial)
+
+        available = get_user_storage_limit(job.user) * 1024 * 1024 - get_user_storage_used(job.user)
+        if total is not None and total > available:
+            raise StorageQuotaExceeded('Not enough storage space for this file.')
+
+        digest = hashlib.sha256()
+        if offset:
+            with open(job.partial_path, 'rb') as partial:
+                digest = hashlib.file_digest(partial, 'sha256')
+
+        written = offset
+        last_report = time.monotonic()
+        with open(job.partial_path, 'ab' if offset else 'wb') as out:
+            for block in response.iter_content(chunk_size=IMPORT_CHUNK_SIZE) if response is not None else ():
+                if not block:
+                    continue
+                written += len(block)
+                if written > available:
+                    raise StorageQuotaExceeded('Not enough storage space for this file.')
+                digest.update(block)
+                out.write(block)
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    out.flush()
+                    _finish(job, bytes_done=written)
+                    last_report = time.monotonic()
+    finally:
+        if response is not None:
+            response.close()
+
+    with transaction.atomic():
+        # Hold the row so the job cannot be requeued between the check and the store.
+        if not ImportJob.objects.select_for_update().filter(pk=job.pk, lease=job.lease).exists():
+            raise LeaseLost(job.job_id)
+        uploaded = store_path(job.user, job.partial_path, job.filename, sha256=digest.hexdigest())
+        _finish(job, status='SUCCESS', file=uploaded, bytes_done=written, partial_path='', error='')
+
+
+def _fail(job, error):
+    # Give up the row first: if the lease is gone, so is our claim on the partial file.
+    partial_path = job.partial_path
+    _finish(job, status='FAILED', error=error, partial_path='')
+    _remove_partial(partial_path)
+
+
+def run_job(job):
+    try:
+        try:
+            _download(job)
+        except StorageQuotaExceeded as e:
+            _fail(job, str(e))
+        except LeaseLost:
+            raise
+        except Exception as e:
+            if _is_transient(e) and job.attempts < settings.URL_IMPORT_MAX_ATTEMPTS:
+                delay = settings.URL_IMPORT_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+                logger.warning("Import job %s failed (attempt %s), retrying in %ss: %s", job.job_id, job.attempts, delay, e)
+                _finish(job, status='QUEUED', error=str(e), next_attempt_at=timezone.now() + timedelta(seconds=delay))
+            else:
+                logger.exception("Import job %s failed", job.job_id)
+                _fail(job, str(e))
+    except LeaseLost:
+        logger.warning("Import job %s was requeued while running; abandoning this attempt", job.job_id)
+    return job
+
+
+def run_next_job():
+    job = claim_job()
+    if job is not None:
+        run_job(job)
+    return job
+
+
+def _run_in_thread(job):
+    try:
+        run_job(job)
+    finally:
+        close_old_connections()
+
+
+def run_worker(concurrency=None, poll_interval=2.0, once=False):
+    """
+    Runs import jobs on a bounded thread pool until interrupted, or until the
+    queue is drained when once=True.
+    """
+    concurrency = concurrency or settings.URL_IMPORT_WORKERS
+    running = {}
+    last_requeue = 0.0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='url-import') as pool:
+        while True:
+            if time.monotonic() - last_requeue > settings.URL_IMPORT_STALE_AFTER / 2:
+                requeue_stale_jobs()
+                last_requeue = time.monotonic()
+
+            while len(running) < concurrency:
+                job = claim_job()
+                if job is None:
+                    break
+                running[pool.submit(_run_in_thread, job)] = job
+
+            if not running:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+            heartbeat(running.values())
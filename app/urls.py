@@ -4,6 +4,14 @@ from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
 from app import views
 from app import views_auth
+from app import views_bulk
+from app import views_chunked
+from app import views_qr
+from app import views_thumbnails
+from app import views_async
+
+# Under ASGI the share downloads stream from async views without a thread per client.
+download_views = views_async if settings.ASYNC_DOWNLOADS else views
 
 urlpatterns = [
     path('', views.landing_page, name='home'),
@@ -17,22 +25,35 @@ urlpatterns = [
     path('profile/', views.profile_page, name='profile'),
     path('profile/<str:username>/', views.profile_page, name='user_profile'),
     path('upload/', views.upload_file, name='upload'), # Consolidated upload path
+    path('upload/chunked/', views_chunked.chunked_upload_init, name='chunked_upload_init'),
+    path('upload/chunked/<uuid:upload_id>/', views_chunked.chunked_upload_status, name='chunked_upload_status'),
+    path('upload/chunked/<uuid:upload_id>/<int:index>/', views_chunked.chunked_upload_chunk, name='chunked_upload_chunk'),
+    path('upload/chunked/<uuid:upload_id>/finalize/', views_chunked.chunked_upload_finalize, name='chunked_upload_finalize'),
     path('payment/initiate/', views.initiate_payment, name='initiate_payment'),
     path('payment/success/', views.payment_success, name='payment_success'),
 
     path('files/', views.file_list, name='file_list'),
+    path('files/bulk/delete/', views_bulk.bulk_delete, name='bulk_delete'),
+    path('files/bulk/links/', views_bulk.bulk_create_links, name='bulk_create_links'),
+    path('files/zip/', views_bulk.download_zip, name='download_zip'),
     path("file/<int:file_id>/", views.file_detail, name="file_detail"),
     path("file/<int:file_id>/delete/", views.delete_file, name="delete_file"),
     path("file/<int:file_id>/generate-link/", views.generate_secure_link, name="generate_secure_link"),
     path("file/<int:file_id>/download-direct/", views.download_file_direct, name="download_file_direct"),
+    path("file/<int:file_id>/thumb/<str:size>/", views_thumbnails.file_thumbnail, name="file_thumbnail"),
+    path("avatars/<int:user_id>/<str:size>/", views_thumbnails.avatar_thumbnail, name="avatar_thumbnail"),
     path("upload-url/", views.upload_from_url, name="upload_from_url"),
+    path("upload-url/jobs/<uuid:job_id>/", views.import_job_status, name="import_job_status"),
     path("downloader/", views.downloader, name="downloader"),
 
     path('links/', views.link_list, name='link_list'),
     path('links/<int:link_id>/delete/', views.delete_secure_link, name='delete_secure_link'),
-    path('download/<uuid:token>/', views.download_file, name='secure_download'),
+    path('download/<uuid:token>/', download_views.download_file, name='secure_download'),
+    path('download/<uuid:token>/qr.<str:fmt>', views_qr.secure_link_qr, name='secure_link_qr'),
     path('s/<uuid:link_id>/', views.download_page, name='share_page'),
-    path('s/<uuid:link_id>/now/', views.download_now, name='share_download'),
+    path('s/<uuid:link_id>/now/', download_views.download_now, name='share_download'),
+    path('s/<uuid:link_id>/qr.<str:fmt>', views_qr.share_qr, name='share_qr'),
+    path('s/zip/<uuid:batch_id>/', views.download_zip, name='share_zip'),
 
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
 
@@ -0,0 +1,228 @@
+import gzip
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from .compression import open_stored_name
+from .models import Blob
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COPY_BLOCK_SIZE = 256 * 1024
+
+# Content-Encoding token -> suffix of the variant stored beside the blob.
+SUFFIXES = {'zstd': 'zst', 'br': 'br', 'gzip': 'gz'}
+
+# Types that are compressed already; a variant would only cost CPU.
+SKIP_TYPE_PREFIXES = ('image/', 'video/', 'audio/', 'font/woff')
+SKIP_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/zstd', 'application/x-7z-compressed', 'application/vnd.rar',
+    'application/x-rar-compressed', 'application/pdf', 'application/epub+zip', 'application/java-archive',
+}
+UNSKIP_TYPES = {'image/svg+xml', 'image/bmp', 'image/x-ms-bmp', 'image/tiff', 'audio/wav', 'audio/x-wav'}
+
+# Mid-range levels: most of the saving of the maximum settings at a fraction
+# of the CPU, which matters because builds share the web process.
+LEVELS = {'zstd': 10, 'br': 5, 'gzip': 6}
+
+Variant = namedtuple('Variant', 'coding name size')
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = set()
+
+
+def available_codings():
+    installed = {'gzip': True, 'br': brotli is not None, 'zstd': zstandard is not None}
+    return [coding for coding in settings.PRECOMPRESS_ENCODINGS if installed.get(coding)]
+
+
+def variant_name(name, coding):
+    return f"{name}.{SUFFIXES[coding]}"
+
+
+def variant_names(name):
+    return [variant_name(name, coding) for coding in SUFFIXES]
+
+
+def is_negotiable(uploaded_file, content_type):
+    """
+    Whether responses for this file depend on Accept-Encoding. Only blob-backed
+    files get variants: they are immutable and removed with their blob.
+    """
+    if not settings.PRECOMPRESS_ENABLED or not uploaded_file.blob_id:
+        return False
+    if not settings.PRECOMPRESS_MIN_SIZE <= uploaded_file.size <= settings.PRECOMPRESS_MAX_SIZE:
+        return False
+    content_type = content_type.split(';')[0].strip().lower()
+    if content_type in UNSKIP_TYPES:
+        return True
+    return not (content_type in SKIP_TYPES or content_type.startswith(SKIP_TYPE_PREFIXES))
+
+
+def parse_accept_encoding(header):
+    """
+    Returns {coding: q} for an Accept-Encoding header. Malformed weights count
+    as 0, so the coding is not chosen.
+    """
+    weights = {}
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.lower()] = q
+    return weights
+
+
+def choose_coding(header):
+    """
+    Picks the content coding to send: the client's highest-weighted one among
+    those we produce, PRECOMPRESS_ENCODINGS order breaking ties. None means
+    identity.
+    """
+    if not header:
+        return None
+    weights = parse_accept_encoding(header)
+    default = weights.get('*', 0.0)
+    best, best_q = None, 0.0
+    for coding in available_codings():
+        q = weights.get(coding, default)
+        if q > best_q:
+            best, best_q = coding, q
+    if best is not None and weights.get('identity', 0.0) > best_q:
+        return None
+    return best
+
+
+def _skip_key(name, coding):
+    return f"variant-skip:{name}:{coding}"
+
+
+def select_variant(request, uploaded_file):
+    """
+    Returns the stored Variant to send for this request, or None to send the
+    identity bytes. A missing variant is queued for building, so the response
+    after this one can use it.
+    """
+    coding = choose_coding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if coding is None:
+        return None
+    name = variant_name(uploaded_file.file.name, coding)
+    try:
+        return Variant(coding, name, os.path.getsize(default_storage.path(name)))
+    except FileNotFoundError:
+        pass
+    if not cache.get(_skip_key(uploaded_file.file.name, coding)):
+        schedule_variant(uploaded_file.file.name, uploaded_file.encoding, uploaded_file.size, coding)
+    return None
+
+
+def _compress(coding, src, dst):
+    if coding == 'gzip':
+        with gzip.GzipFile(filename='', fileobj=dst, mode='wb', compresslevel=LEVELS['gzip'], mtime=0) as out:
+            shutil.copyfileobj(src, out, COPY_BLOCK_SIZE)
+    elif coding == 'br':
+        compressor = brotli.Compressor(quality=LEVELS['br'])
+        while True:
+            block = src.read(COPY_BLOCK_SIZE)
+            if not block:
+                break
+            dst.write(compressor.process(block))
+        dst.write(compressor.finish())
+    else:
+        with zstandard.ZstdCompressor(level=LEVELS['zstd']).stream_writer(dst, closefd=False) as out:
+            shutil.copyfileobj(src, out, COPY_BLOCK_SIZE)
+
+
+def build_variant(name, encoding, size, coding):
+    """
+    Writes the coding variant of the stored file name when it saves at least
+    PRECOMPRESS_MIN_SAVING, otherwise remembers not to try again. The variant's
+    bytes are added to the blob's stored_size. Returns the variant size or None.
+    """
+    target = default_storage.path(variant_name(name, coding))
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open_stored_name(name, encoding) as src, open(tmp_path, 'wb') as dst:
+            _compress(coding, src, dst)
+        variant_size = os.path.getsize(tmp_path)
+        if variant_size > size * (1 - settings.PRECOMPRESS_MIN_SAVING):
+            cache.set(_skip_key(name, coding), True, None)
+            return None
+        try:
+            # A link never replaces, so only one of several concurrent
+            # builds places the variant and counts its bytes.
+            os.link(tmp_path, target)
+        except FileExistsError:
+            return os.path.getsize(target)
+        # The blob may have been dropped, and its variants swept, while this
+        # build ran; a variant placed after that would never be removed.
+        # Blob names end in the content hash (blobs.blob_name).
+        counted = Blob.objects.filter(sha256=os.path.basename(name)).update(
+            stored_size=Coalesce(F('stored_size'), F('size')) + variant_size
+        )
+        if not counted:
+            os.remove(target)
+            return None
+        return variant_size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.PRECOMPRESS_WORKERS, thread_name_prefix='precompress')
+    return _pool
+
+
+def _build_in_background(key, *args):
+    try:
+        build_variant(*args)
+    except Exception:
+        logger.exception("Could not build %s variant of %s", args[3], args[0])
+    finally:
+        with _pool_lock:
+            _pending.discard(key)
+
+
+def schedule_variant(name, encoding, size, coding):
+    # At most one build per variant in this process; across processes the
+    # atomic rename makes a duplicate build harmless.
+    key = (name, coding)
+    with _pool_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    _get_pool().submit(_build_in_background, key, name, encoding, size, coding)
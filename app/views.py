@@ -4,15 +4,29 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import FileResponse, Http404, JsonResponse
+from django.http import Http404, JsonResponse
+from django.urls import reverse
 from django.utils import timezone
+from django.db import transaction
+from django.core.paginator import Paginator
 from django.db.models import Sum
+from django.db.models.functions import Coalesce
 from datetime import timedelta
-import requests
-from django.core.files.base import ContentFile
 from urllib.parse import urlparse
 
-from .models import UploadedFile, SecureLink, ShareLink, get_user_storage_used, get_total_storage, get_user_storage_limit, PaymentTransaction, UserProfile
+from .admin_stats import get_dashboard_snapshot
+from .analytics import track, track_many
+from .bandwidth import limited, plan_download_limits
+from .blobs import share_blob, store_upload
+from .downloads import serve_file
+from .models import UploadedFile, SecureLink, ShareLink, get_user_storage_used, get_user_storage_limit, PaymentTransaction, UserProfile, ImportJob, StorageQuotaExceeded, charge_storage, get_user_storage_usage
+from .fileops import clone_into_storage
+from .link_cache import resolve_share_link
+from .link_filter import link_filter
+from .pagination import KeysetPage, keyset_page
+from .search import search_files
+from .url_import import enqueue_import
+from .zipstream import zip_response
 import razorpay
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
@@ -43,10 +57,11 @@ def dashboard(request):
     user = request.user
     files = UploadedFile.objects.filter(user=user).order_by('-uploaded_at')
 
-    total_files = files.count()
-    total_storage = sum(file.size for file in files)
-    
-    
+    usage = get_user_storage_usage(user)
+    total_files = usage['file_count']
+    total_storage = usage['bytes_used']
+
+
     active_links = ShareLink.objects.filter(
         file__user=user,
         expires_at__gt=timezone.now()
@@ -71,18 +86,25 @@ def dashboard(request):
 @login_required
 def upload_file(request):
     if request.method == 'POST':
-        uploaded_file = request.FILES['file']
-        UploadedFile.objects.create(
-            user=request.user,
-            file=uploaded_file,
-            original_name=uploaded_file.name,
-            size=uploaded_file.size
-        )
+        try:
+            store_upload(request.user, request.FILES['file'])
+        except StorageQuotaExceeded:
+            messages.error(request, 'Not enough storage space for this file.')
+            return redirect('upload')
         messages.success(request, 'File uploaded successfully!')
         return redirect('dashboard')
     return render(request, 'upload.html')
 
 
+LINK_DURATIONS = {
+    '30m': timedelta(minutes=30),
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '48h': timedelta(hours=48),
+    '2d': timedelta(days=2),
+    '7d': timedelta(days=7),
+}
+
 @login_required
 def generate_secure_link(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id, user=request.user)
@@ -90,61 +112,73 @@ def generate_secure_link(request, file_id):
         return render(request, 'create_link.html', {'file': file})
     
     expiry_choice = request.POST.get('expiry', '1h')
-    durations = {
-        '30m': timedelta(minutes=30),
-        '1h': timedelta(hours=1),
-        '24h': timedelta(hours=24),
-        '48h': timedelta(hours=48),
-        '2d': timedelta(days=2),
-        '7d': timedelta(days=7),
-    }
-    expiry_time = timezone.now() + durations.get(expiry_choice, timedelta(hours=1))
+    expiry_time = timezone.now() + LINK_DURATIONS.get(expiry_choice, timedelta(hours=1))
     
     link = ShareLink.objects.create(file=file, expires_at=expiry_time)
     messages.success(request, 'Secure link created!')
-    return render(request, 'link_success.html', {'link': link, 'file': file})
+    return render(request, 'link_success.html', {
+        'link': link,
+        'file': file,
+        'qr_url': reverse('share_qr', args=[link.link_id, 'svg']),
+    })
+
+
+def _get_share_link(link_id):
+    link = resolve_share_link(link_id)
+    if link is None:
+        raise Http404("No ShareLink matches the given query.")
+    return link
 
 
 def download_file(request, token):
-    link = get_object_or_404(ShareLink, link_id=token)
+    link = _get_share_link(token)
     if link.is_expired():
         return render(request, "download/expired.html", status=410)
     
     try:
-        file_handle = link.file.file.open('rb')
-        response = FileResponse(file_handle, as_attachment=True, filename=link.file.original_name)
-        return response
+        return track(request, link, limited(request, link, lambda: serve_file(request, link.file)))
     except FileNotFoundError:
         raise Http404("File not found")
 
 
 def download_page(request, link_id):
-    link = get_object_or_404(ShareLink, link_id=link_id)
+    link = _get_share_link(link_id)
     if link.is_expired():
         return render(request, "download/expired.html", status=410)
     return render(request, "download/download_page.html", {"link": link, "file": link.file})
 
 def download_now(request, link_id):
-    link = get_object_or_404(ShareLink, link_id=link_id)
+    link = _get_share_link(link_id)
     if link.is_expired():
         return render(request, "download/expired.html", status=410)
     
     try:
-        file_handle = link.file.file.open('rb')
-        response = FileResponse(file_handle, as_attachment=True, filename=link.file.original_name)
-        return response
+        return track(request, link, limited(request, link, lambda: serve_file(request, link.file)))
     except FileNotFoundError:
         raise Http404("File not found")
 
 
+def download_zip(request, batch_id):
+    links = list(
+        ShareLink.objects.filter(batch_id=batch_id).select_related('file', 'file__user', 'file__user__profile').order_by('pk')
+    )
+    if not links:
+        raise Http404("Share link not found")
+    live = [link for link in links if not link.is_expired()]
+    if not live:
+        return render(request, "download/expired.html", status=410)
+    # A batch belongs to one owner; the archive counts as a download of its first link.
+    return track_many(request, live, limited(
+        request, live[0], lambda: zip_response([link.file for link in live], f"shared-{str(batch_id)[:8]}.zip")
+    ))
+
+
 @login_required
 def download_file_direct(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id, user=request.user)
     
     try:
-        file_handle = file.file.open('rb')
-        response = FileResponse(file_handle, as_attachment=True, filename=file.original_name)
-        return response
+        return serve_file(request, file)
     except FileNotFoundError:
         messages.error(request, "File not found on server.")
         return redirect('file_list')
@@ -152,7 +186,25 @@ def download_file_direct(request, file_id):
 
 @login_required
 def downloader(request):
-    return render(request, "downloader.html")
+    jobs = ImportJob.objects.filter(user=request.user).order_by('-created_at')[:5]
+    return render(request, "downloader.html", {"jobs": jobs})
+
+@login_required
+def import_job_status(request, job_id):
+    job = get_object_or_404(ImportJob, job_id=job_id, user=request.user)
+    return JsonResponse({
+        'job_id': str(job.job_id),
+        'url': job.url,
+        'status': job.status,
+        'filename': job.filename,
+        'bytes_done': job.bytes_done,
+        'total_bytes': job.total_bytes,
+        'percent': job.percent,
+        'attempts': job.attempts,
+        'error': job.error,
+        'file_id': job.file_id,
+        'finished': job.is_finished,
+    })
 
 @login_required
 def upload_from_url(request):
@@ -185,15 +237,17 @@ def upload_from_url(request):
                         messages.warning(request, 'This is your own file! You already have it in your files.')
                         return redirect('file_list')
                     
-                    with original_file.file.open('rb') as source_file:
-                        content = ContentFile(source_file.read())
-                        
-                        new_file = UploadedFile(
-                            user=request.user,
-                            original_name=original_file.original_name,
-                            size=original_file.size
-                        )
-                        new_file.file.save(original_file.original_name, content, save=True)
+                    if original_file.blob_id:
+                        share_blob(request.user, original_file.blob, original_file.original_name)
+                    else:
+                        with transaction.atomic():
+                            charge_storage(request.user, original_file.size)
+                            UploadedFile.objects.create(
+                                user=request.user,
+                                file=clone_into_storage(original_file.file.name, original_file.original_name),
+                                original_name=original_file.original_name,
+                                size=original_file.size
+                            )
                     
                     messages.success(request, f'File "{original_file.original_name}" successfully copied to your vault from share link!')
                     return redirect('file_list')
@@ -202,31 +256,8 @@ def upload_from_url(request):
                     messages.error(request, 'Invalid share link.')
                     return redirect('file_list')
             
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            filename = None
-            if 'Content-Disposition' in response.headers:
-                fname_match = re.findall('filename="?([^"]+)"?', response.headers['Content-Disposition'])
-                if fname_match:
-                    filename = fname_match[0]
-            
-            if not filename:
-                filename = os.path.basename(parsed_url.path)
-            
-            if not filename:
-                filename = 'downloaded_file'
-
-            content = ContentFile(response.content)
-            
-            uploaded_file = UploadedFile(
-                user=request.user,
-                original_name=filename,
-                size=len(response.content)
-            )
-            uploaded_file.file.save(filename, content, save=True)
-
-            messages.success(request, 'File downloaded from external URL successfully!')
+            enqueue_import(request.user, url)
+            messages.success(request, 'Import queued! Track its progress in the Download Center.')
         except Exception as e:
             messages.error(request, f'Failed to download file: {str(e)}')
             
@@ -234,6 +265,13 @@ def upload_from_url(request):
     return redirect_back(request, default='file_list')
 
 
+def _download_limits_display(storage_limit_mb):
+    limits = plan_download_limits(storage_limit_mb)
+    return {
+        "link_mbps": round(limits["link_rate"] / (1024 * 1024), 1),
+        "link_concurrency": limits["link_concurrency"],
+    }
+
 
 @login_required
 def profile_page(request, username=None):
@@ -290,6 +328,8 @@ def profile_page(request, username=None):
         {"mb": 10240, "name": "10 GB", "price": 180}, # 180 INR
         {"mb": 51200, "name": "50 GB", "price": 800}, # 800 INR
     ]
+    for plan in plans:
+        plan["download"] = _download_limits_display(limit_mb + plan["mb"])
     
     transactions = None
     if is_viewing_other:
@@ -306,6 +346,7 @@ def profile_page(request, username=None):
         "percent": percent,
         "remaining_mb": remaining_mb,
         "plans": plans,
+        "download": _download_limits_display(limit_mb),
         "razorpay_key_id": settings.RAZORPAY_KEY_ID,
     })
 
@@ -376,35 +417,50 @@ def payment_success(request):
 def admin_required(view_func):
     return user_passes_test(lambda u: u.is_superuser)(view_func)
 
+ADMIN_USER_SORTS = {
+    'username': 'username',
+    'used': 'used_bytes',
+    'files': 'file_count',
+    'limit': 'limit_mb',
+    'joined': 'date_joined',
+}
+
 @admin_required
 def admin_dashboard(request):
-    total_users = User.objects.count()
-    total_storage = round(get_total_storage() / (1024 * 1024), 2)
-    total_files = UploadedFile.objects.count()
-    recent_files = UploadedFile.objects.order_by('-uploaded_at')[:10]
-    
-    users_list = []
-    users = User.objects.all()
-    for u in users:
-        used = get_user_storage_used(u)
-        limit = get_user_storage_limit(u)
-        users_list.append({
-            'obj': u,
-            'used_mb': round(used / (1024 * 1024), 2),
-            'limit_mb': limit,
-            'file_count': UploadedFile.objects.filter(user=u).count()
-        })
-    
-    chart_labels = [u.username for u in users]
-    chart_data = [round(get_user_storage_used(u) / (1024 * 1024), 2) for u in users]
-    
+    snapshot = get_dashboard_snapshot()
+    recent_files = UploadedFile.objects.select_related('user').order_by('-uploaded_at')[:10]
+
+    sort = request.GET.get('sort', '-used')
+    field = ADMIN_USER_SORTS.get(sort.lstrip('-'))
+    if field is None:
+        sort, field = '-used', 'used_bytes'
+    direction = '-' if sort.startswith('-') else ''
+
+    users = User.objects.annotate(
+        used_bytes=Coalesce('profile__bytes_used', 0),
+        limit_mb=Coalesce('profile__storage_limit_mb', 1024.0),
+        file_count=Coalesce('profile__file_count', 0),
+    ).order_by(f'{direction}{field}', f'{direction}id')
+    page = Paginator(users, settings.ADMIN_USERS_PER_PAGE).get_page(request.GET.get('page'))
+
+    users_list = [{
+        'obj': u,
+        'used_mb': round(u.used_bytes / (1024 * 1024), 2),
+        'limit_mb': u.limit_mb,
+        'file_count': u.file_count,
+    } for u in page]
+
     return render(request, "admin/admin_dashboard.html", {
-        "total_users": total_users,
-        "total_storage": total_storage,
-        "total_files": total_files,
+        "total_users": snapshot['total_users'],
+        "total_storage": snapshot['total_storage'],
+        "total_files": snapshot['total_files'],
         "recent_files": recent_files,
+        "dedup": snapshot['dedup'],
+        "link_filter": link_filter.stats(),
         "users": users_list,
-        "user_storage_stats": zip(chart_labels, chart_data)
+        "users_page": page,
+        "current_sort": sort,
+        "user_storage_stats": snapshot['chart'],
     })
 
 
@@ -415,23 +471,42 @@ def custom_500(request):
     return render(request, "errors/error_500.html", status=500)
 
 
+# sort key -> (field, descending); the primary key breaks ties
+FILE_LIST_SORTS = {
+    'date': ('uploaded_at', True),
+    'name': ('original_name', False),
+    'size': ('size', True),
+}
+
 @login_required
 def file_list(request):
     search = request.GET.get('search', '')
     sort = request.GET.get('sort', 'date')
-    
+    if sort not in FILE_LIST_SORTS:
+        sort = 'date'
+
     files = UploadedFile.objects.filter(user=request.user)
     if search:
-        files = files.filter(original_name__icontains=search)
-    
-    if sort == 'name':
-        files = files.order_by('original_name')
-    elif sort == 'size':
-        files = files.order_by('-size')
+        # Search results are ranked by relevance and capped rather than paginated.
+        page = KeysetPage(list(search_files(files, search, user=request.user)[:settings.SEARCH_MAX_RESULTS]))
     else:
-        files = files.order_by('-uploaded_at')
-        
-    return render(request, "my_files.html", {"files": files, "current_sort": sort})
+        field, descending = FILE_LIST_SORTS[sort]
+        page = keyset_page(files, field, descending, request.GET.get('cursor'), settings.FILES_PER_PAGE)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'files': [{
+                'id': f.id,
+                'name': f.original_name,
+                'size': f.size,
+                'uploaded_at': f.uploaded_at.isoformat(),
+                'expires_at': f.expires_at.isoformat(),
+                'download_url': reverse('download_file_direct', args=[f.id]),
+            } for f in page],
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor,
+        })
+    return render(request, "my_files.html", {"files": page, "current_sort": sort})
 
 @login_required
 def file_detail(request, file_id):
@@ -442,14 +517,13 @@ def file_detail(request, file_id):
 
 @login_required
 def link_list(request):
-    links = ShareLink.objects.filter(file__user=request.user).order_by('-expires_at')
-    return render(request, "link_list.html", {"links": links})
+    links = ShareLink.objects.filter(file__user=request.user).select_related('file')
+    page = keyset_page(links, 'expires_at', True, request.GET.get('cursor'), settings.FILES_PER_PAGE)
+    return render(request, "link_list.html", {"links": page})
 
 @login_required
 def delete_file(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id, user=request.user)
-    if file.file:
-        file.file.delete()
     file.delete()
     messages.success(request, "File deleted successfully.")
     return redirect_back(request, default='file_list')
@@ -0,0 +1,35 @@
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from django.shortcuts import render
+
+from .analytics import track
+from .bandwidth import alimited
+from .downloads import serve_file
+from .link_cache import resolve_share_link
+
+
+async def _get_share_link(link_id):
+    link = await sync_to_async(resolve_share_link)(link_id)
+    if link is None:
+        raise Http404("No ShareLink matches the given query.")
+    return link
+
+
+async def _serve_share_link(request, link_id):
+    link = await _get_share_link(link_id)
+    if link.is_expired():
+        return await sync_to_async(render)(request, "download/expired.html", status=410)
+
+    try:
+        response = await alimited(request, link, lambda: serve_file(request, link.file, asynchronous=True))
+        return track(request, link, response)
+    except FileNotFoundError:
+        raise Http404("File not found")
+
+
+async def download_file(request, token):
+    return await _serve_share_link(request, token)
+
+
+async def download_now(request, link_id):
+    return await _serve_share_link(request, link_id)
@@ -0,0 +1,126 @@
+import json
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from .link_filter import link_filter
+from .models import ShareLink, UploadedFile, batched_storage_cleanup
+from .views import LINK_DURATIONS
+from .zipstream import zip_response
+
+
+def _requested_ids(request):
+    """
+    Returns (ids, payload) from a JSON body ({"ids": [...]}) or repeated `ids`
+    form fields, de-duplicated in request order. ids is None when malformed.
+    """
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return None, {}
+        if not isinstance(payload, dict):
+            return None, {}
+        raw = payload.get('ids', [])
+    else:
+        payload = request.POST
+        raw = payload.getlist('ids')
+    try:
+        ids = list(dict.fromkeys(int(i) for i in raw))
+    except (TypeError, ValueError):
+        return None, payload
+    return ids, payload
+
+
+def _parse_request(request):
+    if request.method != 'POST':
+        return None, None, JsonResponse({'error': 'Invalid request'}, status=405)
+    ids, payload = _requested_ids(request)
+    if not ids:
+        return None, None, JsonResponse({'error': 'A list of file ids is required.'}, status=400)
+    if len(ids) > settings.BULK_MAX_ITEMS:
+        return None, None, JsonResponse({'error': f'At most {settings.BULK_MAX_ITEMS} files per request.'}, status=400)
+    return ids, payload, None
+
+
+@login_required
+def bulk_delete(request):
+    ids, _, error = _parse_request(request)
+    if error:
+        return error
+
+    # One lookup and one DELETE ... WHERE id IN for the lot; counters, blob
+    # references and the deletion log are all written in bulk.
+    with transaction.atomic(), batched_storage_cleanup() as batch:
+        owned = set(UploadedFile.objects.filter(user=request.user, pk__in=ids).values_list('pk', flat=True))
+        if owned:
+            UploadedFile.objects.filter(pk__in=owned).delete()
+        batch.apply()
+
+    return JsonResponse({
+        'deleted': len(owned),
+        'results': [{'id': pk, 'status': 'deleted' if pk in owned else 'not_found'} for pk in ids],
+    })
+
+
+@login_required
+def bulk_create_links(request):
+    ids, payload, error = _parse_request(request)
+    if error:
+        return error
+
+    expires_at = timezone.now() + LINK_DURATIONS.get(payload.get('expiry', '1h'), timedelta(hours=1))
+    owned = set(UploadedFile.objects.filter(user=request.user, pk__in=ids).values_list('pk', flat=True))
+    batch_id = uuid.uuid4()
+    links = ShareLink.objects.bulk_create(
+        [ShareLink(file_id=pk, expires_at=expires_at, batch_id=batch_id) for pk in ids if pk in owned]
+    )
+    link_filter.add_many([link.link_id for link in links])
+    by_file = {link.file_id: link for link in links}
+
+    results = []
+    for pk in ids:
+        link = by_file.get(pk)
+        if link is None:
+            results.append({'id': pk, 'status': 'not_found'})
+            continue
+        results.append({
+            'id': pk,
+            'status': 'created',
+            'link_id': str(link.link_id),
+            'url': request.build_absolute_uri(reverse('share_page', args=[link.link_id])),
+            'expires_at': expires_at.isoformat(),
+        })
+    response = {'created': len(links), 'results': results}
+    if links:
+        response['zip_url'] = request.build_absolute_uri(reverse('share_zip', args=[batch_id]))
+    return JsonResponse(response, status=201 if links else 200)
+
+
+@login_required
+def download_zip(request):
+    if request.method == 'GET':
+        # Plain links like ?ids=1&ids=2 so the browser handles the download.
+        try:
+            ids = list(dict.fromkeys(int(i) for i in request.GET.getlist('ids')))
+        except ValueError:
+            ids = None
+        if not ids:
+            return JsonResponse({'error': 'A list of file ids is required.'}, status=400)
+        if len(ids) > settings.BULK_MAX_ITEMS:
+            return JsonResponse({'error': f'At most {settings.BULK_MAX_ITEMS} files per request.'}, status=400)
+    else:
+        ids, _, error = _parse_request(request)
+        if error:
+            return error
+
+    by_id = UploadedFile.objects.filter(user=request.user, pk__in=ids).in_bulk()
+    if not by_id:
+        return JsonResponse({'error': 'No such files.'}, status=404)
+    return zip_response([by_id[pk] for pk in ids if pk in by_id], 'files.zip')
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+
+from .blobs import reserve_temp, store_path
+from .fileops import append_file
+from .models import StorageQuotaExceeded, UploadSession, get_user_storage_used, get_user_storage_limit
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def _session_dir(session):
+    return session.part_dir
+
+
+def _part_path(session, index):
+    return os.path.join(_session_dir(session), f"{index}.part")
+
+
+def _received_chunks(session):
+    received = []
+    for index in range(session.chunk_count):
+        try:
+            size = os.path.getsize(_part_path(session, index))
+        except OSError:
+            continue
+        if size == session.expected_chunk_size(index):
+            received.append(index)
+    return received
+
+
+def _received_ranges(session, chunks):
+    ranges = []
+    for index in chunks:
+        start = index * session.chunk_size
+        end = start + session.expected_chunk_size(index) - 1
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+@login_required
+def chunked_upload_init(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=405)
+
+    filename = os.path.basename(request.POST.get('filename', '').strip())
+    try:
+        total_size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': 'A valid file size is required.'}, status=400)
+    if not filename or total_size < 0:
+        return JsonResponse({'error': 'A file name and size are required.'}, status=400)
+
+    limit_bytes = get_user_storage_limit(request.user) * 1024 * 1024
+    if get_user_storage_used(request.user) + total_size > limit_bytes:
+        return JsonResponse({'error': 'Not enough storage space for this file.'}, status=413)
+
+    session = UploadSession.objects.create(
+        user=request.user,
+        filename=filename,
+        total_size=total_size,
+        chunk_size=settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+    )
+    os.makedirs(_session_dir(session), exist_ok=True)
+
+    return JsonResponse({
+        'upload_id': str(session.upload_id),
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+    }, status=201)
+
+
+@login_required
+def chunked_upload_status(request, upload_id):
+    session = get_object_or_404(UploadSession, upload_id=upload_id, user=request.user)
+    chunks = _received_chunks(session)
+    return JsonResponse({
+        'upload_id': str(session.upload_id),
+        'size': session.total_size,
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'chunks': chunks,
+        'ranges': _received_ranges(session, chunks),
+        'complete': len(chunks) == session.chunk_count,
+    })
+
+
+@login_required
+def chunked_upload_chunk(request, upload_id, index):
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'Invalid request'}, status=405)
+
+    session = get_object_or_404(UploadSession, upload_id=upload_id, user=request.user)
+    if index >= session.chunk_count:
+        return JsonResponse({'error': 'Chunk index out of range.'}, status=400)
+
+    expected = session.expected_chunk_size(index)
+    os.makedirs(_session_dir(session), exist_ok=True)
+    tmp_path = os.path.join(_session_dir(session), f"{index}.{uuid.uuid4().hex}.tmp")
+    written = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                block = request.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                written += len(block)
+                if written > expected:
+                    break
+                out.write(block)
+        if written != expected:
+            os.remove(tmp_path)
+            return JsonResponse({'error': f'Chunk {index} must be exactly {expected} bytes.'}, status=400)
+        os.replace(tmp_path, _part_path(session, index))
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return JsonResponse({'index': index, 'size': written})
+
+
+@login_required
+def chunked_upload_finalize(request, upload_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=405)
+
+    with transaction.atomic():
+        session = get_object_or_404(
+            UploadSession.objects.select_for_update(), upload_id=upload_id, user=request.user
+        )
+        missing = sorted(set(range(session.chunk_count)) - set(_received_chunks(session)))
+        if missing:
+            return JsonResponse({'error': 'Upload is incomplete.', 'missing': missing}, status=409)
+
+        path, fd = reserve_temp(session.filename)
+        digest = hashlib.sha256()
+        try:
+            try:
+                for index in range(session.chunk_count):
+                    append_file(fd, _part_path(session, index), digest)
+            finally:
+                os.close(fd)
+            uploaded_file = store_path(request.user, path, session.filename, sha256=digest.hexdigest())
+        except StorageQuotaExceeded as e:
+            return JsonResponse({'error': str(e)}, status=413)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        session.delete()
+
+    shutil.rmtree(_session_dir(session), ignore_errors=True)
+    return JsonResponse({
+        'file_id': uploaded_file.id,
+        'name': uploaded_file.original_name,
+        'size': uploaded_file.size,
+    }, status=201)
@@ -2,10 +2,12 @@ import re
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import redirect
 from django.contrib import messages
+from django.db import transaction
 from urllib.parse import urlparse
-import requests
-from django.core.files.base import ContentFile
-from .models import UploadedFile, ShareLink
+from .models import UploadedFile, ShareLink, charge_storage
+from .blobs import share_blob
+from .fileops import clone_into_storage
+from .url_import import enqueue_import
 
 @login_required
 def upload_from_url(request):
@@ -37,15 +39,17 @@ def upload_from_url(request):
                         messages.warning(request, 'This is your own file! You already have it in your files.')
                         return redirect('file_list')
                     
-                    with original_file.file.open('rb') as source_file:
-                        content = ContentFile(source_file.read())
-                        
-                        new_file = UploadedFile(
-                            user=request.user,
-                            original_name=original_file.original_name,
-                            size=original_file.size
-                        )
-                        new_file.file.save(original_file.original_name, content, save=True)
+                    if original_file.blob_id:
+                        share_blob(request.user, original_file.blob, original_file.original_name)
+                    else:
+                        with transaction.atomic():
+                            charge_storage(request.user, original_file.size)
+                            UploadedFile.objects.create(
+                                user=request.user,
+                                file=clone_into_storage(original_file.file.name, original_file.original_name),
+                                original_name=original_file.original_name,
+                                size=original_file.size
+                            )
                     
                     messages.success(request, f'File "{original_file.original_name}" successfully copied to your vault from share link!')
                     return redirect('file_list')
@@ -54,31 +58,8 @@ def upload_from_url(request):
                     messages.error(request, 'Invalid share link.')
                     return redirect('file_list')
             
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            filename = None
-            if 'Content-Disposition' in response.headers:
-                fname_match = re.findall('filename="?([^"]+)"?', response.headers['Content-Disposition'])
-                if fname_match:
-                    filename = fname_match[0]
-            
-            if not filename:
-                filename = os.path.basename(parsed_url.path)
-            
-            if not filename:
-                filename = 'downloaded_file'
-
-            content = ContentFile(response.content)
-            
-            uploaded_file = UploadedFile(
-                user=request.user,
-                original_name=filename,
-                size=len(response.content)
-            )
-            uploaded_file.file.save(filename, content, save=True)
-
-            messages.success(request, 'File downloaded from external URL successfully!')
+            enqueue_import(request.user, url)
+            messages.success(request, 'Import queued! Track its progress in the Download Center.')
         except Exception as e:
             messages.error(request, f'Failed to download file: {str(e)}')
             
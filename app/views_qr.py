@@ -0,0 +1,52 @@
+import hashlib
+
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .link_cache import resolve_share_link
+from .link_filter import link_might_exist
+from .models import SecureLink
+from .qr import QR_CONTENT_TYPES, get_qr
+
+
+def _qr_response(request, path, fmt, expires_at):
+    if fmt not in QR_CONTENT_TYPES:
+        raise Http404("Unknown QR format")
+    remaining = int((expires_at - timezone.now()).total_seconds())
+    if remaining <= 0:
+        return HttpResponse(status=410)
+
+    data = request.build_absolute_uri(path)
+    etag = f'"{hashlib.sha1(f"{data}|{fmt}".encode()).hexdigest()}"'
+    headers = HttpResponse()
+    headers['ETag'] = etag
+    # The image for a link never changes; caches may keep it until the link expires.
+    headers['Cache-Control'] = f'public, max-age={remaining}, immutable'
+    headers['Expires'] = http_date(expires_at.timestamp())
+    conditional = get_conditional_response(request, etag=etag, response=headers)
+    if conditional is not headers:
+        return conditional
+
+    response = HttpResponse(get_qr(data, fmt, expires_at), content_type=QR_CONTENT_TYPES[fmt])
+    for header in ('ETag', 'Cache-Control', 'Expires'):
+        response[header] = headers[header]
+    return response
+
+
+def share_qr(request, link_id, fmt):
+    link = resolve_share_link(link_id)
+    if link is None:
+        raise Http404("No ShareLink matches the given query.")
+    return _qr_response(request, reverse('share_page', args=[link.link_id]), fmt, link.expires_at)
+
+
+def secure_link_qr(request, token, fmt):
+    link = None
+    if link_might_exist(token):
+        link = SecureLink.objects.filter(token=token, is_active=True).only('token', 'expiry_time').first()
+    if link is None:
+        raise Http404("No SecureLink matches the given query.")
+    return _qr_response(request, reverse('secure_download', args=[link.token]), fmt, link.expiry_time)
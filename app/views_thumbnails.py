@@ -0,0 +1,56 @@
+from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+
+from .models import UploadedFile, UserProfile
+from .thumbnails import (
+    THUMBNAIL_CONTENT_TYPE, THUMBNAIL_SIZES, ThumbnailUnavailable, get_thumbnail, is_previewable, thumbnail_key,
+)
+
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+def _thumbnail_response(request, source_name, encoding, size, scope):
+    if size not in THUMBNAIL_SIZES:
+        raise Http404("Unknown thumbnail size")
+    # Thumbnails of a given source never change, so a revalidation needs no rendering.
+    etag = f'"{thumbnail_key(source_name, THUMBNAIL_SIZES[size])}"'
+    headers = HttpResponse()
+    headers['ETag'] = etag
+    headers['Cache-Control'] = f'{scope}, max-age={MAX_AGE}, immutable'
+    conditional = get_conditional_response(request, etag=etag, response=headers)
+    if conditional is not headers:
+        return conditional
+
+    for _ in range(2):
+        try:
+            path, _ = get_thumbnail(source_name, encoding, size)
+            response = FileResponse(open(path, 'rb'), content_type=THUMBNAIL_CONTENT_TYPE)
+            break
+        except ThumbnailUnavailable:
+            raise Http404("No preview available")
+        except FileNotFoundError:
+            # Evicted between rendering and opening; render it again.
+            continue
+    else:
+        raise Http404("No preview available")
+    for header in ('ETag', 'Cache-Control'):
+        response[header] = headers[header]
+    return response
+
+
+@login_required
+def file_thumbnail(request, file_id, size):
+    file = get_object_or_404(UploadedFile, id=file_id, user=request.user)
+    if not is_previewable(file.original_name):
+        raise Http404("No preview available")
+    return _thumbnail_response(request, file.file.name, file.encoding, size, 'private')
+
+
+def avatar_thumbnail(request, user_id, size):
+    profile = get_object_or_404(UserProfile, user_id=user_id)
+    if not profile.avatar:
+        raise Http404("No avatar")
+    # Avatar URLs carry a version (see the avatar_url filter), so they can be cached publicly.
+    return _thumbnail_response(request, profile.avatar.name, '', size, 'public')
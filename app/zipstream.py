@@ -0,0 +1,104 @@
+import io
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from .compression import open_stored
+
+ZIP_READ_SIZE = 64 * 1024
+
+# Already-compressed formats gain nothing from deflate; store them as-is.
+STORED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.mp4', '.mkv', '.mov', '.avi', '.webm',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk', '.pdf',
+}
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Write-only sink for ZipFile. It is not seekable, so zipfile writes data
+    descriptors after each entry instead of seeking back to patch headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _archive_names(files):
+    seen = set()
+    for uploaded in files:
+        name = os.path.basename(uploaded.original_name or uploaded.file.name) or f"file-{uploaded.pk}"
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate in seen:
+            candidate = f"{stem} ({n}){ext}"
+            n += 1
+        seen.add(candidate)
+        yield uploaded, candidate
+
+
+def _zip_info(uploaded, arcname):
+    stamp = timezone.localtime(uploaded.uploaded_at) if uploaded.uploaded_at else timezone.localtime()
+    info = zipfile.ZipInfo(arcname, date_time=max(stamp.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+    stored = os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS
+    info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    info.file_size = uploaded.size
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def stream_zip(files):
+    """
+    Yields a ZIP64 archive of files (UploadedFile instances) while reading
+    them, holding at most one read block in memory and writing nothing to disk.
+    """
+    out = _StreamBuffer()
+    with zipfile.ZipFile(out, 'w', allowZip64=True) as archive:
+        for uploaded, arcname in _archive_names(files):
+            try:
+                src = open_stored(uploaded)
+            except FileNotFoundError:
+                # Headers are already sent; leave out what is gone rather than break the archive.
+                continue
+            with src, archive.open(_zip_info(uploaded, arcname), 'w', force_zip64=True) as dst:
+                while True:
+                    block = src.read(ZIP_READ_SIZE)
+                    if not block:
+                        break
+                    dst.write(block)
+                    data = out.drain()
+                    if data:
+                        yield data
+            yield out.drain()
+    yield out.drain()
+
+
+def zip_response(files, filename):
+    # The length depends on how well entries deflate, so it goes out chunked.
+    response = StreamingHttpResponse(stream_zip(files), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Cache-Control'] = 'private, no-store'
+    response['X-Accel-Buffering'] = 'no'
+    return response
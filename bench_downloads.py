@@ -0,0 +1,87 @@
+"""
+Benchmark concurrent slow downloaders against the WSGI and ASGI download paths.
+
+Start the two servers against the same database, then point this script at a
+share link on each:
+
+    # ASGI: set ASYNC_DOWNLOADS = True in web_share/settings.py first
+    uvicorn web_share.asgi:application --port 8001
+    # WSGI: threads from the server pool serve each download
+    uvicorn --interface wsgi web_share.wsgi:application --port 8002
+
+    python bench_downloads.py --clients 500 --rate 262144 \
+        ASGI=http://127.0.0.1:8001/s/<uuid>/now/ WSGI=http://127.0.0.1:8002/s/<uuid>/now/
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+READ_SIZE = 64 * 1024
+
+
+async def fetch(url, rate, timeout):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or 80), timeout
+    )
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+
+    started = time.perf_counter()
+    status_line = await asyncio.wait_for(reader.readline(), timeout)
+    first_byte = time.perf_counter() - started
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+
+    received = 0
+    while True:
+        block = await asyncio.wait_for(reader.read(READ_SIZE), timeout)
+        if not block:
+            break
+        received += len(block)
+        if rate:
+            # Pace the reads so each client looks like a slow downloader.
+            expected = received / rate
+            elapsed = time.perf_counter() - started
+            if expected > elapsed:
+                await asyncio.sleep(expected - elapsed)
+    writer.close()
+    return int(status_line.split()[1]), received, first_byte
+
+
+async def run(label, url, clients, rate, timeout):
+    started = time.perf_counter()
+    results = await asyncio.gather(*(fetch(url, rate, timeout) for _ in range(clients)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if not isinstance(r, Exception) and r[0] == 200]
+    failed = len(results) - len(ok)
+    total_bytes = sum(r[1] for r in ok)
+    ttfb = sorted(r[2] for r in ok)
+
+    print("=" * 60)
+    print(f"{label}: {url}")
+    print(f"  clients ok/failed : {len(ok)}/{failed}")
+    print(f"  wall time         : {elapsed:.2f}s")
+    print(f"  throughput        : {total_bytes / elapsed / (1024 * 1024):.2f} MB/s")
+    if ttfb:
+        print(f"  ttfb p50 / p99    : {ttfb[len(ttfb) // 2] * 1000:.0f}ms / {ttfb[int(len(ttfb) * 0.99) - 1] * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='+', help="LABEL=URL pairs, e.g. ASGI=http://127.0.0.1:8001/s/<uuid>/now/")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rate', type=int, default=256 * 1024, help="Per-client read rate in bytes/s (0 = unlimited)")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    for target in args.targets:
+        label, _, url = target.partition('=')
+        asyncio.run(run(label, url, args.clients, args.rate, args.timeout))
+
+
+if __name__ == '__main__':
+    main()
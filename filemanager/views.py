@@ -4,8 +4,12 @@ from django.contrib import messages
 from django.utils import timezone
 from datetime import timedelta
 import uuid
-import qrcode
-from app.models import UploadedFile, SecureLink, ShareLink, get_user_storage_used
+from django.conf import settings
+from django.urls import reverse
+from app.blobs import store_upload
+from app.pagination import KeysetPage, keyset_page
+from app.search import search_files
+from app.models import UploadedFile, SecureLink, ShareLink, StorageQuotaExceeded, get_user_storage_used
 
 
 @login_required
@@ -13,12 +17,11 @@ def upload_file(request):
     if request.method == "POST":
         file = request.FILES.get("file")
         if file:
-            UploadedFile.objects.create(
-                user=request.user,
-                file=file,
-                original_name=file.name,
-                size=file.size
-            )
+            try:
+                store_upload(request.user, file)
+            except StorageQuotaExceeded:
+                messages.error(request, "Not enough storage space for this file.")
+                return redirect("upload")
             messages.success(request, "File uploaded successfully!")
             return redirect("upload")
 
@@ -27,23 +30,26 @@ def upload_file(request):
     return render(request, "upload.html")
 
 
+FILES_LIST_SORTS = {
+    "name": ("original_name", False),
+    "size": ("size", False),
+    "date": ("uploaded_at", True),
+}
+
+
 @login_required
 def files_list(request):
     search = request.GET.get("search", "")
     files = UploadedFile.objects.filter(user=request.user)
 
-    if search:
-        files = files.filter(original_name__icontains=search)
-
     sort = request.GET.get("sort")
-    if sort == "name":
-        files = files.order_by("original_name")
-    elif sort == "size":
-        files = files.order_by("size")
-    elif sort == "date":
-        files = files.order_by("-uploaded_at")
+    if search:
+        page = KeysetPage(list(search_files(files, search, user=request.user)[:settings.SEARCH_MAX_RESULTS]))
+    else:
+        field, descending = FILES_LIST_SORTS.get(sort, ("uploaded_at", True))
+        page = keyset_page(files, field, descending, request.GET.get("cursor"), settings.FILES_PER_PAGE)
 
-    return render(request, "files_list.html", {"files": files})
+    return render(request, "files_list.html", {"files": page, "current_sort": sort})
 
 
 @login_required
@@ -116,16 +122,11 @@ def generate_secure_link(request, file_id):
         expiry_time=expires_at
     )
 
-    qr_img = qrcode.make(
-        request.build_absolute_uri(f"/download/{secure_link.token}/")
-    )
-    qr_path = f"media/qr/{secure_link.token}.png"
-    qr_img.save(qr_path)
-
+    # Rendered on request by the QR endpoint; nothing is written here.
     return render(request, "link_success.html", {
         "file": file,
         "link": secure_link,
-        "qr_path": "/" + qr_path
+        "qr_url": reverse("secure_link_qr", args=[secure_link.token, "svg"]),
     })
 
 
@@ -27,6 +27,9 @@ CSRF_TRUSTED_ORIGINS = ['https://*.ngrok-free.dev']
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 USE_X_FORWARDED_HOST = True
 USE_X_FORWARDED_PORT = True
+# Proxies in front of Django that append to X-Forwarded-For; per-IP download
+# limits and access logs read the client address from there. 0 uses REMOTE_ADDR.
+TRUSTED_PROXY_COUNT = 1
 
 # Session and CSRF Security for Production/Ngrok
 SESSION_COOKIE_AGE = 172800  # 48 hours in seconds
@@ -45,6 +48,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'app',
     'filemanager'
 ]
@@ -91,6 +95,18 @@ DATABASES = {
     }
 }
 
+# Link lookups, the link filter and download slots are shared between worker
+# processes through this cache, so it must not be the per-process default.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',  # UPDATE THIS WITH YOUR REDIS URL
+    }
+}
+# None decides from the backend (LocMem and Dummy are per-process). Features
+# that need a shared cache switch themselves off when it is not.
+CACHE_IS_SHARED = None
+
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -134,6 +150,123 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # File Upload Settings
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
+FILE_UPLOAD_HANDLERS = [
+    'app.upload_handlers.HashingMemoryFileUploadHandler',
+    'app.upload_handlers.HashingTemporaryFileUploadHandler',
+]
 
 RAZORPAY_KEY_ID = 'rzp_test_YOUR_KEY'  # Replace with actual key
 RAZORPAY_KEY_SECRET = 'YOUR_SECRET_KEY'  # Replace with actual secret
+
+# Chunked (resumable) uploads: parts are spooled here until finalize
+CHUNKED_UPLOAD_DIR = BASE_DIR / 'chunked_uploads'
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+CHUNKED_UPLOAD_SESSION_TTL = 24 * 60 * 60    # seconds without a new chunk before reap_expired drops an upload
+
+# How download views deliver file bytes:
+#   'stream'           - Python streams the file (default, works everywhere)
+#   'x-accel-redirect' - nginx sends it; map the prefix to MEDIA_ROOT as internal:
+#                            location /protected-media/ { internal; alias /path/to/media/; }
+#   'x-sendfile'       - Apache mod_xsendfile / lighttpd send the absolute path
+FILE_DELIVERY_MODE = 'stream'
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'
+
+# Serve share-link downloads from async views; enable when running under ASGI
+# (e.g. `uvicorn web_share.asgi:application`). Under WSGI keep this False.
+ASYNC_DOWNLOADS = False
+
+# Background URL imports (run workers with `python manage.py run_import_worker`)
+URL_IMPORT_WORKERS = 4           # concurrent downloads per worker process
+URL_IMPORT_MAX_ATTEMPTS = 5
+URL_IMPORT_RETRY_BACKOFF = 30    # seconds, doubled after every failed attempt
+URL_IMPORT_STALE_AFTER = 600     # requeue RUNNING jobs silent for this long
+
+# Admin dashboard totals are cached and rebuilt in the background after this many seconds
+ADMIN_SNAPSHOT_TTL = 60
+ADMIN_USERS_PER_PAGE = 25
+
+# Public share-link lookups are cached in-process (short TTL) and, when CACHES
+# is shared between processes, in CACHES too
+LINK_CACHE_TTL = 300
+LINK_CACHE_LOCAL_TTL = 5
+LINK_CACHE_LOCAL_SIZE = 10000
+
+# Bloom filter of every link token; unknown tokens 404 without a database query.
+# Only used with a shared cache, which carries new links to the other processes.
+LINK_FILTER_ENABLED = True
+LINK_FILTER_ERROR_RATE = 0.001
+LINK_FILTER_MIN_CAPACITY = 100000
+LINK_FILTER_REBUILD_INTERVAL = 3600  # seconds; also drops deleted links
+
+# Expired links and files are purged by `python manage.py reap_expired [--loop]`
+REAPER_BATCH_SIZE = 500
+REAPER_WORKERS = 4                   # threads removing stored bytes
+REAPER_MAX_DELETES_PER_SECOND = 200  # 0 = unthrottled
+REAPER_GRACE_PERIOD = 24 * 60 * 60   # expired links keep answering 410 this long
+
+# File and link listings are keyset-paginated (?cursor=...) at this page size
+FILES_PER_PAGE = 50
+
+# File-name search: pg_trgm on Postgres, an in-process trigram index elsewhere
+SEARCH_MAX_RESULTS = 200
+SEARCH_SIMILARITY_THRESHOLD = 0.5  # share of query trigrams a typo match needs (fallback only)
+SEARCH_INDEX_TTL = 300             # seconds before the fallback index is rebuilt
+SEARCH_INDEX_MAX_USERS = 256       # fallback indexes kept per process, least recently used dropped
+
+# Bulk file endpoints (files/bulk/...)
+BULK_MAX_ITEMS = 1000
+
+# Deleted bytes go through a durable log drained by `python manage.py drain_deletions`
+STORAGE_DELETE_DRAIN_ON_COMMIT = True  # also start a drain thread right after each delete
+STORAGE_DELETE_WORKERS = 4             # parallel storage deletes per drain
+STORAGE_DELETE_BATCH_SIZE = 200
+STORAGE_DELETE_LEASE = 300             # seconds before an unfinished claim is retried
+STORAGE_DELETE_RETRY_BACKOFF = 30      # seconds, doubled after every failed attempt
+
+# Opt-in compression at rest for new blobs: zstd when the zstandard package is
+# installed, zlib otherwise, in seekable frames so Range requests stay cheap
+STORAGE_COMPRESSION = False
+STORAGE_COMPRESSION_MIN_SIZE = 4096           # smaller uploads are stored as-is
+STORAGE_COMPRESSION_MIN_SAVING = 0.1          # sampled share of bytes compression must save
+STORAGE_COMPRESSION_FRAME_SIZE = 1024 * 1024  # uncompressed bytes per independently decodable frame
+
+# Full downloads negotiate Accept-Encoding and send a precompressed copy of the
+# blob, built in the background on first request (br/zstd need brotli/zstandard)
+PRECOMPRESS_ENABLED = True
+PRECOMPRESS_ENCODINGS = ['zstd', 'br', 'gzip']  # preference order on equal weights
+PRECOMPRESS_MIN_SIZE = 1024
+PRECOMPRESS_MAX_SIZE = 256 * 1024 * 1024       # larger files are always sent as stored
+PRECOMPRESS_MIN_SAVING = 0.2                   # keep a variant only if it is this much smaller
+PRECOMPRESS_WORKERS = 2
+
+# Image and avatar thumbnails, rendered on first request in worker processes
+THUMBNAIL_CACHE_DIR = BASE_DIR / 'cache' / 'thumbnails'
+THUMBNAIL_CACHE_MAX_BYTES = 512 * 1024 * 1024  # least recently used are evicted past this
+THUMBNAIL_EVICT_INTERVAL = 300                 # seconds between size checks
+THUMBNAIL_WORKERS = 2                          # 0 renders in the request thread
+
+# Share-link QR codes are rendered on request and kept in-process until the link expires
+QR_CACHE_SIZE = 2048
+
+# Share-link downloads are capped per link, per owner and per client IP.
+# Rates are bytes per second, concurrency counts downloads; 0 means unlimited.
+DOWNLOAD_SHAPING_ENABLED = True
+DOWNLOAD_PLAN_LIMITS = {  # keyed by the owner's storage_limit_mb, highest threshold reached wins
+    0: {'link_rate': 2 * 1024 * 1024, 'link_concurrency': 4, 'owner_rate': 5 * 1024 * 1024, 'owner_concurrency': 10},
+    5120: {'link_rate': 5 * 1024 * 1024, 'link_concurrency': 8, 'owner_rate': 12 * 1024 * 1024, 'owner_concurrency': 25},
+    10240: {'link_rate': 10 * 1024 * 1024, 'link_concurrency': 16, 'owner_rate': 25 * 1024 * 1024, 'owner_concurrency': 50},
+    51200: {'link_rate': 25 * 1024 * 1024, 'link_concurrency': 32, 'owner_rate': 60 * 1024 * 1024, 'owner_concurrency': 100},
+}
+DOWNLOAD_IP_RATE = 0            # bytes per second per client address
+DOWNLOAD_IP_CONCURRENCY = 16
+DOWNLOAD_SLOT_TTL = 120         # seconds a slot outlives its last heartbeat
+DOWNLOAD_RETRY_AFTER = 15       # seconds, sent with 429 responses
+DOWNLOAD_BURST_SECONDS = 1      # seconds of rate a stream may send at once
+DOWNLOAD_RATE_REFRESH = 1       # seconds between recomputing a stream's share of each rate
+
+# Share-link downloads are counted in process memory and written in batches:
+# one UPDATE per table for the summed counters plus a bulk insert of access-log rows
+ANALYTICS_ENABLED = True
+ANALYTICS_FLUSH_INTERVAL = 5    # seconds a hit may wait in the buffer
+ANALYTICS_FLUSH_SIZE = 500      # flush at once when this many hits are waiting
+ANALYTICS_MAX_PENDING = 50000   # access-log rows kept while the database is unreachable